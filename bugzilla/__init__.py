@@ -11,6 +11,7 @@
 
 from logging import getLogger
 import sys
+import threading
 
 if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
     # pylint: disable=F0401
@@ -22,33 +23,42 @@ from .apiversion import version, __version__
 from .base import BugzillaBase as _BugzillaBase
 from .base import BugzillaError
 from .base import RequestsTransport as _RequestsTransport
+from .base import _BugzillaBatch, _BugzillaCache
 from .bugzilla3 import Bugzilla3, Bugzilla32, Bugzilla34, Bugzilla36
 from .bugzilla4 import Bugzilla4, Bugzilla42, Bugzilla44
+from .bugzilla5 import Bugzilla5
 from .nvlbugzilla import NovellBugzilla
 from .rhbugzilla import RHBugzilla, RHBugzilla3, RHBugzilla4
 
 log = getLogger(__name__)
 
 
-def _getBugzillaClassForURL(url, sslverify):
-    url = Bugzilla3.fix_url(url)
-    log.debug("Detecting subclass for %s", url)
-    s = ServerProxy(url, _RequestsTransport(url, sslverify=sslverify))
+def _detectBugzillaClass(url, sslverify, multicall=False):
+    '''
+    Return the bugzilla class to use for url, and whether the server
+    takes system.multicall. multicall is passed to _BugzillaBatch: with
+    None, the probes are tried in a single multicall, with False they
+    are sent one by one, and the returned value stays False.
+    '''
     rhbz = False
     bzversion = ''
     c = None
 
-    if "bugzilla.redhat.com" in url:
-        log.info("Using RHBugzilla for URL containing bugzilla.redhat.com")
-        return RHBugzilla
-    if "bugzilla.novell.com" in url:
-        log.info("Using NovellBugzilla for URL containing novell.com")
-        return NovellBugzilla
+    transport = _RequestsTransport(url, sslverify=sslverify)
+    s = ServerProxy(url, transport)
+    try:
+        log.debug("Checking for Red Hat Bugzilla extension and "
+                  "return value of Bugzilla.version()")
+        batch = _BugzillaBatch(s, multicall)
+        extret = batch.Bugzilla.extensions()
+        versionret = batch.Bugzilla.version()
+        batch.send()
+    finally:
+        transport.close()
 
     # Check for a Red Hat extension
     try:
-        log.debug("Checking for Red Hat Bugzilla extension")
-        extensions = s.Bugzilla.extensions()
+        extensions = extret.result()
         if extensions.get('extensions', {}).get('RedHat', False):
             rhbz = True
     except Fault:
@@ -57,9 +67,7 @@ def _getBugzillaClassForURL(url, sslverify):
 
     # Try to get the bugzilla version string
     try:
-        log.debug("Checking return value of Bugzilla.version()")
-        r = s.Bugzilla.version()
-        bzversion = r['version']
+        bzversion = versionret.result()['version']
     except Fault:
         pass
     log.debug("bzversion='%s'", str(bzversion))
@@ -67,6 +75,9 @@ def _getBugzillaClassForURL(url, sslverify):
     # note preference order: RHBugzilla* wins if available
     if rhbz:
         c = RHBugzilla
+    elif bzversion.startswith("5."):
+        # Prefer the REST API where available
+        c = Bugzilla5
     elif bzversion.startswith("4."):
         if bzversion.startswith("4.0"):
             c = Bugzilla4
@@ -86,7 +97,61 @@ def _getBugzillaClassForURL(url, sslverify):
             log.debug("No explicit match for %s, fall through", bzversion)
             c = Bugzilla3
 
-    return c
+    return c, batch.multicall
+
+
+def _getBugzillaClassForURL(url, sslverify, cachedir=None, cachettl=None):
+    url = Bugzilla3.fix_url(url)
+    log.debug("Detecting subclass for %s", url)
+
+    if "bugzilla.redhat.com" in url:
+        log.info("Using RHBugzilla for URL containing bugzilla.redhat.com")
+        return RHBugzilla
+    if "bugzilla.novell.com" in url:
+        log.info("Using NovellBugzilla for URL containing novell.com")
+        return NovellBugzilla
+
+    # Stock bugzilla has no system.multicall, where batching the probes
+    # would cost an extra request. So only batch them once multicall
+    # is known to work
+    if not cachedir:
+        return _detectBugzillaClass(url, sslverify)[0]
+
+    cache = _BugzillaCache(cachedir, url)
+    multicall, fresh = cache.lookup("multicall")
+    if not fresh:
+        multicall = None
+
+    def _detect(use_multicall):
+        c, works = _detectBugzillaClass(url, sslverify, use_multicall)
+        cache.set("autodetect", c.__name__, cachettl)
+        if use_multicall is not False:
+            # It was tried, so now we know
+            cache.set("multicall", works, cachettl)
+        return c
+
+    def _background_detect():
+        try:
+            # Nobody waits for this one, so find out about multicall
+            # here if it's unknown
+            _detect(multicall)
+        except Exception:
+            log.debug("Background Bugzilla autodetection failed",
+                      exc_info=True)
+
+    name, fresh = cache.lookup("autodetect")
+    if name not in classlist:
+        return _detect(multicall or False)
+
+    if not fresh:
+        # Keep using the old result, but refresh it for next time
+        log.debug("Cached autodetection result is stale, reprobing")
+        thread = threading.Thread(target=_background_detect)
+        thread.daemon = True
+        thread.start()
+
+    log.debug("Using cached autodetection result %s", name)
+    return globals()[name]
 
 
 class Bugzilla(_BugzillaBase):
@@ -94,11 +159,12 @@ class Bugzilla(_BugzillaBase):
     Magical Bugzilla class that figures out which Bugzilla implementation
     to use and uses that.
     '''
-    def _init_class_from_url(self, url, sslverify):
+    def _init_class_from_url(self, url, sslverify, cachedir):
         if url is None:
             raise TypeError("You must pass a valid bugzilla URL")
 
-        c = _getBugzillaClassForURL(url, sslverify)
+        c = _getBugzillaClassForURL(url, sslverify, cachedir,
+                                    self.cache_ttl["autodetect"])
         if not c:
             raise ValueError("Couldn't determine Bugzilla version for %s" %
                              url)
@@ -112,7 +178,7 @@ class Bugzilla(_BugzillaBase):
 # bin/bugzilla uses it for the --bztype field
 classlist = [
     "Bugzilla3", "Bugzilla32", "Bugzilla34", "Bugzilla36",
-    "Bugzilla4", "Bugzilla42", "Bugzilla44",
+    "Bugzilla4", "Bugzilla42", "Bugzilla44", "Bugzilla5",
     "RHBugzilla3", "RHBugzilla4", "RHBugzilla",
     "NovellBugzilla",
 ]
@@ -0,0 +1,304 @@
+#
+# Copyright (C) 2015 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+'''
+asyncio client, requires python 3.5 or later. Not imported by default,
+use:
+
+    from bugzilla.asyncbugzilla import AsyncBugzilla
+'''
+
+import asyncio
+import concurrent.futures
+from io import BytesIO
+import itertools
+from logging import getLogger
+import ssl
+from urllib.parse import urlparse
+from xmlrpc.client import ProtocolError
+
+import requests
+
+from .base import BugzillaError
+from .bug import _Bug
+
+log = getLogger(__name__)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+    log.debug("aiohttp not available, AsyncBugzilla will use threads")
+
+
+class _AIOHTTPClient(object):
+    '''
+    Makes HTTP requests with aiohttp, over a pool of at most 'limit'
+    keep-alive connections.
+    '''
+    def __init__(self, transport, limit):
+        self._transport = transport
+        self._limit = limit
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            sslcontext = None
+            defaults = self._transport.request_defaults
+            if self._transport.use_https:
+                if defaults["verify"]:
+                    sslcontext = ssl.create_default_context()
+                    if defaults["cert"]:
+                        sslcontext.load_cert_chain(defaults["cert"])
+                else:
+                    sslcontext = False
+
+            connector = aiohttp.TCPConnector(limit=self._limit,
+                                             ssl=sslcontext)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def request(self, method, url, data=None, headers=None):
+        cookies = {}
+        for cookie in self._transport.session.cookies:
+            cookies[cookie.name] = cookie.value
+
+        try:
+            async with self._get_session().request(
+                    method, url, data=data, headers=headers,
+                    cookies=cookies) as response:
+                body = await response.read()
+                return response.status, response.headers, body
+        except aiohttp.ClientError as e:
+            raise BugzillaError(str(e))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class _ThreadedClient(object):
+    '''
+    Fallback if aiohttp isn't installed: makes the HTTP requests with the
+    connection pooling requests session of the synchronous transport, on
+    a pool of at most 'limit' threads.
+    '''
+    def __init__(self, transport, limit):
+        self._transport = transport
+        self._executor = concurrent.futures.ThreadPoolExecutor(limit)
+
+    def _request(self, method, url, data, headers):
+        defaults = self._transport.request_defaults.copy()
+        defaults["headers"] = headers
+        try:
+            response = self._transport.session.request(
+                method, url, data=data, **defaults)
+        except requests.RequestException as e:
+            raise BugzillaError(str(e))
+        return response.status_code, response.headers, response.content
+
+    async def request(self, method, url, data=None, headers=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, self._request, method, url, data, headers)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncBugzilla(object):
+    '''
+    asyncio counterpart of a Bugzilla object. Wraps an already set up
+    (and possibly logged in) Bugzilla instance, which is used for its
+    configuration, login token, build_query() and build_update(), and
+    the conversion of results:
+
+        bz = bugzilla.Bugzilla(url=...)
+        async with AsyncBugzilla(bz) as abz:
+            bugs = await abz.query(bz.build_query(product="Fedora"))
+
+    Calls are made over the XMLRPC or JSONRPC API, whichever transport
+    bz uses. At most max_concurrency requests are in flight at once.
+    HTTP is done with aiohttp if it's installed, otherwise with the
+    blocking requests session on a pool of max_concurrency threads.
+
+    Bug objects returned are tied to bz, and have autorefresh disabled
+    since a refresh would block the event loop.
+    '''
+    def __init__(self, bz, max_concurrency=10, use_aiohttp=None):
+        if not bz.url:
+            raise BugzillaError("Bugzilla object is not connected")
+        self.bz = bz
+        self.max_concurrency = max_concurrency
+
+        if use_aiohttp is None:
+            use_aiohttp = aiohttp is not None
+        if use_aiohttp:
+            if aiohttp is None:
+                raise BugzillaError("aiohttp is not installed")
+            self._http = _AIOHTTPClient(bz._transport, max_concurrency)
+        else:
+            self._http = _ThreadedClient(bz._transport, max_concurrency)
+
+        # Created on first use, so it belongs to the running loop
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        ignore = args
+        await self.close()
+
+    async def close(self):
+        '''Close any open connections'''
+        await self._http.close()
+
+    def build_query(self, *args, **kwargs):
+        return self.bz.build_query(*args, **kwargs)
+
+    def build_update(self, *args, **kwargs):
+        return self.bz.build_update(*args, **kwargs)
+
+    async def _request(self, method, url, data=None, headers=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            status, headers, body = await self._http.request(
+                method, url, data=data, headers=headers)
+        if status >= 400:
+            raise ProtocolError(url, status, "HTTP error %s" % status,
+                                headers)
+        return headers, body
+
+    async def _call(self, methodname, *params):
+        '''
+        The async equivalent of bz._proxy.<methodname>(*params)
+        '''
+        proxy = self.bz._proxy
+        transport = self.bz._transport
+        request = proxy._dumps(methodname, params)
+
+        urlparts = urlparse(self.bz.url)
+        url, request = transport._prepare_request(
+            urlparts[1], urlparts[2], request)
+
+        log.debug("Calling %s asynchronously", methodname)
+        ignore, body = await self._request(
+            "POST", url, data=request,
+            headers=transport.request_defaults["headers"])
+
+        ret = transport.parse_data(body)
+        if len(ret) == 1:
+            ret = ret[0]
+        proxy._save_token(ret)
+        return ret
+
+    def _bug(self, data):
+        return _Bug(self.bz, dict=data, autorefresh=False)
+
+
+    ###################
+    # getbug* methods #
+    ###################
+
+    async def _getbugs(self, idlist, permissive=True, **kwargs):
+        idlist, getbugdata = self.bz._getbugs_data(
+            idlist, permissive=permissive, **kwargs)
+
+        calls = []
+        for ids in self.bz._getbugs_chunks(idlist):
+            chunkdata = getbugdata.copy()
+            chunkdata["ids"] = ids
+            calls.append(self._call("Bug.get", chunkdata))
+        results = await asyncio.gather(*calls)
+
+        return self.bz._getbugs_result(
+            idlist, itertools.chain(*[r["bugs"] for r in results]))
+
+    async def getbug(self, objid,
+            include_fields=None, exclude_fields=None, extra_fields=None):
+        '''Async version of Bugzilla.getbug()'''
+        data = await self._getbugs([objid], permissive=False,
+            include_fields=include_fields, exclude_fields=exclude_fields,
+            extra_fields=extra_fields)
+        return self._bug(data[0])
+
+    async def getbugs(self, idlist,
+            include_fields=None, exclude_fields=None, extra_fields=None):
+        '''Async version of Bugzilla.getbugs(). Long ID lists are split
+        in the same chunks, which are fetched concurrently.'''
+        data = await self._getbugs(idlist,
+            include_fields=include_fields, exclude_fields=exclude_fields,
+            extra_fields=extra_fields)
+        return [(b and self._bug(b)) or None for b in data]
+
+
+    #################
+    # query methods #
+    #################
+
+    async def query(self, query):
+        '''Async version of Bugzilla.query()'''
+        r = await self._call("Bug.search", query)
+        log.debug("Query returned %s bugs", len(r['bugs']))
+        return [self._bug(b) for b in r['bugs']]
+
+
+    #######################################
+    # Methods for modifying existing bugs #
+    #######################################
+
+    async def update_bugs(self, ids, updates):
+        '''Async version of Bugzilla.update_bugs()'''
+        tmp = updates.copy()
+        tmp["ids"] = self.bz._listify(ids)
+        return await self._call("Bug.update", tmp)
+
+    async def update_flags(self, idlist, flags):
+        '''Async version of Bugzilla.update_flags()'''
+        return await self._call("Flag.update",
+            {"ids": self.bz._listify(idlist), "updates": flags})
+
+
+    ########################################
+    # Methods for working with attachments #
+    ########################################
+
+    async def attachfile(self, idlist, attachfile, description, **kwargs):
+        '''Async version of Bugzilla.attachfile(). The file is read
+        synchronously.'''
+        kwargs = self.bz._attachfile_data(idlist, attachfile, description,
+                                          **kwargs)
+        ret = await self._call("Bug.add_attachment", kwargs)
+        return self.bz._attachfile_result(ret)
+
+    async def openattachment(self, attachid):
+        '''Async version of Bugzilla.openattachment()'''
+        headers = self.bz._transport.request_defaults["headers"].copy()
+        del(headers["Content-Type"])
+
+        headers, body = await self._request(
+            "GET", self.bz._attachment_uri(attachid), headers=headers)
+        ret = BytesIO(body)
+        ret.name = self.bz._attachment_filename(attachid, headers)
+        return ret
+
+
+    ##############################
+    # Methods for handling Users #
+    ##############################
+
+    async def getusers(self, userlist):
+        '''Async version of Bugzilla.getusers()'''
+        ret = await self._call("User.get",
+                               {"names": self.bz._listify(userlist)})
+        return self.bz._getusers_result(userlist, ret)
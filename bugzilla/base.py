@@ -9,13 +9,25 @@
 # option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
 # the full text of the license.
 
+import base64
+import codecs
+import datetime
+import hashlib
+import inspect
+import itertools
+import json
 import locale
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import sys
+import tempfile
+import threading
+import time
 
 from getpass import getpass
-from io import BytesIO
+from io import BytesIO, TextIOBase
 
 if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
     # pylint: disable=F0401,E0611
@@ -23,18 +35,22 @@ if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
     from http.cookiejar import LoadError, LWPCookieJar, MozillaCookieJar
     from urllib.parse import urlparse, parse_qsl
     from xmlrpc.client import (
-        Binary, Fault, ProtocolError, ServerProxy, Transport)
+        Binary, DateTime, ExpatParser, Fault, ProtocolError, ServerProxy,
+        Transport, Unmarshaller, dumps)
 else:
     from ConfigParser import SafeConfigParser
     from cookielib import LoadError, LWPCookieJar, MozillaCookieJar
     from urlparse import urlparse, parse_qsl
     from xmlrpclib import (
-        Binary, Fault, ProtocolError, ServerProxy, Transport)
+        Binary, DateTime, ExpatParser, Fault, ProtocolError, ServerProxy,
+        Transport, Unmarshaller, dumps)
 
 import requests
 
 from .apiversion import __version__
-from .bug import _Bug, _User
+from .bug import (_AutorefreshRecorder, _Bug, _BugSchema, _CompactBug,
+                  _ResultSet, _User)
+from .columns import _ColumnBuilder
 
 log = getLogger(__name__)
 
@@ -112,6 +128,7 @@ class _BugzillaToken(object):
     def __init__(self, uri, tokenfilename):
         self.tokenfilename = tokenfilename
         self.tokenfile = SafeConfigParser()
+        self._lock = threading.Lock()
         self.domain = urlparse(uri)[1]
 
         if self.tokenfilename:
@@ -129,23 +146,107 @@ class _BugzillaToken(object):
 
     @value.setter
     def value(self, value):
-        if self.value == value:
-            return
+        with self._lock:
+            if self.value == value:
+                return
 
-        if value is None:
-            self.tokenfile.remove_option(self.domain, 'token')
-        else:
-            self.tokenfile.set(self.domain, 'token', value)
+            if value is None:
+                self.tokenfile.remove_option(self.domain, 'token')
+            else:
+                self.tokenfile.set(self.domain, 'token', value)
 
-        if self.tokenfilename:
-            with open(self.tokenfilename, 'w') as tokenfile:
-                log.debug("Saving to tokenfile")
-                self.tokenfile.write(tokenfile)
+            if self.tokenfilename:
+                with open(self.tokenfilename, 'w') as tokenfile:
+                    log.debug("Saving to tokenfile")
+                    self.tokenfile.write(tokenfile)
 
     def __repr__(self):
         return '<Bugzilla Token :: %s>' % (self.value)
 
 
+def _save_json(filename, data):
+    '''
+    Write data to filename as JSON. The file is replaced atomically, so
+    concurrent users never read a partially written one.
+    '''
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                   prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, default=_json_default)
+        os.rename(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+class _BugzillaCache(object):
+    '''
+    Disk cache for bugzilla metadata like products and components, one
+    JSON file per bugzilla URL. Every entry expires after its own TTL.
+    The file is replaced atomically, so concurrent users never read a
+    partially written one. Errors reading or writing are only logged.
+    '''
+    def __init__(self, cachedir, url):
+        name = re.sub(r"[^\w.-]", "_", url.split("://", 1)[-1])
+        self.filename = os.path.join(cachedir, name + ".json")
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        dirname = os.path.dirname(self.filename)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0o700)
+            _save_json(self.filename, data)
+        except (IOError, OSError):
+            log.debug("Error writing cache %s", self.filename, exc_info=True)
+
+    def lookup(self, key):
+        '''
+        Return a (value, fresh) tuple for key, where fresh is False if
+        the entry has expired. value is None if there's no entry.
+        '''
+        entry = self._load().get(key)
+        if not entry:
+            return None, False
+        return entry["value"], entry["expires"] >= time.time()
+
+    def get(self, key):
+        '''Return the cached value for key, or None if missing or stale'''
+        value, fresh = self.lookup(key)
+        if not fresh:
+            return None
+        log.debug("Using cached '%s' from %s", key, self.filename)
+        return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            data = self._load()
+            data[key] = {"expires": time.time() + ttl, "value": value}
+            self._save(data)
+
+    def update(self, key, cb):
+        '''
+        Replace the value for key with cb(value), without changing when
+        it expires. Does nothing if there's no valid entry for key.
+        '''
+        with self._lock:
+            data = self._load()
+            entry = data.get(key)
+            if not entry or entry["expires"] < time.time():
+                return
+
+            entry["value"] = cb(entry["value"])
+            self._save(data)
+
+
 class _BugzillaServerProxy(ServerProxy):
     def __init__(self, uri, tokenfile, *args, **kwargs):
         # pylint: disable=super-init-not-called
@@ -156,28 +257,595 @@ class _BugzillaServerProxy(ServerProxy):
     def clear_token(self):
         self.token.value = None
 
-    def _ServerProxy__request(self, methodname, params):
+    def _add_token(self, methodname, params):
         if self.token.value is not None:
             if len(params) == 0:
                 params = ({}, )
 
-            if 'Bugzilla_token' not in params[0]:
+            if methodname == "system.multicall":
+                # Every call bundled in the multicall needs its own token
+                for call in params[0]:
+                    if not call["params"]:
+                        call["params"] = [{}]
+                    if 'Bugzilla_token' not in call["params"][0]:
+                        call["params"][0]['Bugzilla_token'] = self.token.value
+            elif 'Bugzilla_token' not in params[0]:
                 params[0]['Bugzilla_token'] = self.token.value
+        return params
+
+    def _ServerProxy__request(self, methodname, params):
+        # Like ServerProxy's, but the request is encoded by _dumps()
+        request = self._dumps(methodname, params)
 
         # pylint: disable=maybe-no-member
-        ret = ServerProxy._ServerProxy__request(self, methodname, params)
+        ret = self._ServerProxy__transport.request(
+            self._ServerProxy__host, self._ServerProxy__handler,
+            request, verbose=self._ServerProxy__verbose)
         # pylint: enable=maybe-no-member
 
+        if len(ret) == 1:
+            ret = ret[0]
+        self._save_token(ret)
+        return ret
+
+    def _save_token(self, ret):
         if isinstance(ret, dict) and 'token' in ret.keys():
             self.token.value = ret.get('token')
+
+    def _dumps(self, methodname, params):
+        '''
+        Return the encoded request body for methodname(*params), with the
+        login token added. That's XMLRPC, unless the transport has its
+        own dumps_request()
+        '''
+        params = self._add_token(methodname, params)
+        # pylint: disable=maybe-no-member
+        transport = self._ServerProxy__transport
+        if hasattr(transport, "dumps_request"):
+            return transport.dumps_request(methodname, params)
+
+        encoding = self._ServerProxy__encoding
+        request = dumps(params, methodname, encoding=encoding,
+                        allow_none=self._ServerProxy__allow_none)
+        # pylint: enable=maybe-no-member
+        if not isinstance(request, bytes):
+            # python3 ServerProxy does this too
+            request = request.encode(encoding, "xmlcharrefreplace")
+        return request
+
+    def _iter_request(self, methodname, params, key):
+        '''
+        Make the call methodname(*params), and return an iterator over
+        the list stored in the result struct under 'key', which yields
+        the elements as soon as they are unmarshalled.
+        '''
+        request = self._dumps(methodname, params)
+        # pylint: disable=maybe-no-member
+        return self._ServerProxy__transport.iter_request(
+            self._ServerProxy__host, self._ServerProxy__handler,
+            request, key)
+        # pylint: enable=maybe-no-member
+
+    def _upload_request(self, methodname, params, key, fileobj):
+        '''
+        Make the call methodname(params), with the contents of fileobj
+        sent as the Binary params[key]. The file is read and encoded
+        while the request is sent, rather than loaded into memory.
+        '''
+        params = params.copy()
+        # pylint: disable=maybe-no-member
+        transport = self._ServerProxy__transport
+        if not hasattr(transport, "upload_request"):
+            # Plain xmlrpclib transport, it needs the whole request
+            data = fileobj.read()
+            if not isinstance(data, bytes):
+                data = data.encode(locale.getpreferredencoding())
+            params[key] = Binary(data)
+            return getattr(self, methodname)(params)
+
+        placeholder = os.urandom(30)
+        params[key] = Binary(placeholder)
+        request = self._dumps(methodname, (params,))
+        ret = transport.upload_request(
+            self._ServerProxy__host, self._ServerProxy__handler,
+            request, placeholder, fileobj)
+        # pylint: enable=maybe-no-member
+
+        if len(ret) == 1:
+            ret = ret[0]
+        self._save_token(ret)
         return ret
 
 
+class _BatchResult(object):
+    '''
+    Placeholder for the result of a call queued in a _BugzillaBatch.
+    The result is available once the batch has been sent.
+    '''
+    def __init__(self, methodname):
+        self.methodname = methodname
+        self._done = False
+        self._value = None
+        self._fault = None
+
+    def _set(self, value=None, fault=None):
+        self._value = value
+        self._fault = fault
+        self._done = True
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''
+        Return the value returned by the call, or raise the Fault
+        the server reported for it.
+        '''
+        if not self._done:
+            raise BugzillaError("Result of %s requested before the batch "
+                                "was sent" % self.methodname)
+        if self._fault:
+            raise self._fault
+        return self._value
+
+
+class _BatchMethod(object):
+    def __init__(self, batch, name):
+        self._batch = batch
+        self._name = name
+
+    def __getattr__(self, name):
+        return _BatchMethod(self._batch, "%s.%s" % (self._name, name))
+
+    def __call__(self, *args):
+        # pylint: disable=protected-access
+        return self._batch._queue(self._name, args)
+
+
+class _BugzillaBatch(object):
+    '''
+    Queue up XMLRPC calls and send them to the server in a single
+    system.multicall request. Calls are made just like with the
+    ServerProxy, but return a _BatchResult:
+
+      with bz.batch() as b:
+          ret = b.Bug.get({"ids": [123456]})
+      print(ret.result())
+
+    If the server doesn't support system.multicall, the calls are
+    sent one by one instead.
+    '''
+    def __init__(self, proxy, multicall=None):
+        self._proxy = proxy
+        self._calls = []
+
+        # Whether the server takes system.multicall, None until that's
+        # known. If False, calls are sent one by one without trying
+        self.multicall = multicall
+
+    def __getattr__(self, name):
+        return _BatchMethod(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        ignore = exc_value
+        ignore = tb
+        if exc_type is None:
+            self.send()
+
+    def _queue(self, methodname, params):
+        log.debug("Queueing %s for multicall with: %s", methodname, params)
+        ret = _BatchResult(methodname)
+        self._calls.append((methodname, params, ret))
+        return ret
+
+    def _send_one_by_one(self, calls):
+        for methodname, params, ret in calls:
+            try:
+                # pylint: disable=protected-access
+                ret._set(getattr(self._proxy, methodname)(*params))
+            except Fault:
+                ret._set(fault=sys.exc_info()[1])
+
+    def send(self):
+        '''
+        Send all queued calls in one request. This is done automatically
+        when leaving the 'with' block.
+        '''
+        calls = self._calls
+        self._calls = []
+        if not calls:
+            return
+        if self.multicall is False:
+            self._send_one_by_one(calls)
+            return
+
+        multicall = [{"methodName": methodname, "params": list(params)}
+                     for methodname, params, ignore in calls]
+        log.debug("Calling system.multicall with %d calls", len(multicall))
+        try:
+            results = self._proxy.system.multicall(multicall)
+        except Fault:
+            log.debug("system.multicall failed, sending calls one by one",
+                      exc_info=True)
+            self.multicall = False
+            self._send_one_by_one(calls)
+            return
+
+        self.multicall = True
+        for (ignore, ignore, ret), result in zip(calls, results):
+            # pylint: disable=protected-access
+            if isinstance(result, dict):
+                ret._set(fault=Fault(result["faultCode"],
+                                     result["faultString"]))
+            else:
+                ret._set(result[0])
+
+
+class _BugzillaPlan(object):
+    '''
+    Collects changes to many bugs, merged per bug, and makes them with as
+    few calls as possible. See BugzillaBase.plan()
+    '''
+    def __init__(self, bz, max_workers):
+        self.bz = bz
+        self.max_workers = max_workers
+        self.clear()
+
+    def clear(self):
+        '''Forget all planned changes'''
+        # {bug id: merged build_update() dict}
+        self._updates = {}
+        # {bug id: [flag dicts]}
+        self._flags = {}
+        # {bug id: {"add": [tags], "remove": [tags]}}
+        self._tags = {}
+        # {bug id: [ExternalBugs.add_external_bug external_bugs dicts]}
+        self._external = {}
+
+    def _ids(self, ids):
+        ret = []
+        # pylint: disable=protected-access
+        for i in self.bz._listify(ids):
+            try:
+                ret.append(int(i))
+            except ValueError:
+                # String aliases can be passed as well
+                ret.append(i)
+        return ret
+
+    def _merge_update(self, bugid, vals):
+        dest = self._updates.setdefault(bugid, {})
+        for key, val in vals.items():
+            if key not in dest:
+                if type(val) is dict:
+                    val = dict([(k, type(v) is list and v[:] or v)
+                                for k, v in val.items()])
+                dest[key] = val
+                continue
+
+            old = dest[key]
+            addremove = ["add", "remove"]
+            if (type(old) is dict and type(val) is dict and
+                not [k for k in list(old) + list(val)
+                     if k not in addremove]):
+                for k in addremove:
+                    for v in val.get(k, []):
+                        if v not in old.setdefault(k, []):
+                            old[k].append(v)
+            elif old != val:
+                raise ValueError("Conflicting updates of '%s' for bug %s: "
+                                 "%s and %s" % (key, bugid, old, val))
+
+    def update(self, ids, **kwargs):
+        '''
+        Plan a Bug.update for ids, with the same arguments as
+        build_update(). Additions and removals, like keywords_add, are
+        merged with earlier ones for the same bug. Setting a field to
+        two different values raises ValueError.
+        '''
+        self.update_dict(ids, self.bz.build_update(**kwargs))
+
+    def update_dict(self, ids, vals):
+        '''Like update(), but with a dict returned by build_update()'''
+        for bugid in self._ids(ids):
+            self._merge_update(bugid, vals)
+
+    def update_flags(self, ids, flags):
+        '''Plan a Flag.update for ids, see update_flags()'''
+        for bugid in self._ids(ids):
+            planned = self._flags.setdefault(bugid, [])
+            for flag in flags:
+                # The last change to a flag wins
+                planned[:] = [f for f in planned
+                              if f.get("name") != flag.get("name")]
+                planned.append(flag)
+
+    def update_tags(self, ids, tags_add=None, tags_remove=None):
+        '''Plan a Bug.update_tags for ids, see update_tags()'''
+        # pylint: disable=protected-access
+        for bugid in self._ids(ids):
+            planned = self._tags.setdefault(bugid, {})
+            for key, tags in [("add", tags_add), ("remove", tags_remove)]:
+                for tag in self.bz._listify(tags) or []:
+                    if tag not in planned.setdefault(key, []):
+                        planned[key].append(tag)
+
+    def add_external_tracker(self, ids, type_desc, external_id):
+        '''
+        Plan adding an external tracker to ids, see
+        RHBugzilla.add_external_tracker()
+        '''
+        for bugid in self._ids(ids):
+            self._external.setdefault(bugid, []).append({
+                "ext_type_description": type_desc,
+                "ext_bz_bug_id": external_id})
+
+    def _group(self, perbug):
+        groups = {}
+        for bugid in sorted(perbug):
+            key = json.dumps(perbug[bugid], sort_keys=True,
+                             default=_json_default)
+            groups.setdefault(key, (perbug[bugid], []))[1].append(bugid)
+        return sorted(groups.values(), key=lambda g: g[1])
+
+    def calls(self):
+        '''
+        Return the calls execute() makes, as a list of (method name,
+        bug IDs, arguments) tuples. Bugs with identical changes share a
+        call.
+        '''
+        ret = []
+        for methodname, perbug in [
+                ("Bug.update", self._updates),
+                ("Flag.update", self._flags),
+                ("Bug.update_tags", self._tags),
+                ("ExternalBugs.add_external_bug", self._external)]:
+            for args, ids in self._group(perbug):
+                ret.append((methodname, ids, args))
+        return ret
+
+    def _call(self, methodname, ids, args):
+        if methodname == "Bug.update":
+            return self.bz.update_bugs(ids, args)
+        if methodname == "Flag.update":
+            return self.bz.update_flags(ids, args)
+        if methodname == "Bug.update_tags":
+            return self.bz.update_tags(ids, args.get("add"),
+                                       args.get("remove"))
+        # pylint: disable=protected-access
+        return self.bz._proxy.ExternalBugs.add_external_bug(
+            {"bug_ids": ids, "external_bugs": args})
+
+    def dry_run(self):
+        '''Print the calls execute() would make, and return them'''
+        calls = self.calls()
+        for methodname, ids, args in calls:
+            print("%s %s: %s" % (methodname,
+                                 ",".join([str(i) for i in ids]),
+                                 json.dumps(args, sort_keys=True,
+                                            default=_json_default)))
+        return calls
+
+    def execute(self):
+        '''
+        Make the planned calls, up to max_workers at once, and clear the
+        plan. Returns a {bug id: error} dict, where error is None if all
+        the calls for that bug succeeded, or else the Fault or
+        BugzillaError raised by the one that failed.
+        '''
+        calls = self.calls()
+        self.clear()
+
+        def _run(call):
+            try:
+                self._call(*call)
+            except (Fault, BugzillaError):
+                log.debug("%s for %s failed", call[0], call[1],
+                          exc_info=True)
+                return sys.exc_info()[1]
+            return None
+
+        workers = min(self.max_workers or 1, len(calls))
+        log.debug("Making %d planned calls, %d at once",
+                  len(calls), workers)
+        if workers <= 1:
+            errors = [_run(call) for call in calls]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                errors = pool.map(_run, calls)
+            finally:
+                pool.terminate()
+
+        ret = {}
+        for (ignore, ids, ignore), error in zip(calls, errors):
+            for bugid in ids:
+                if ret.get(bugid) is None:
+                    ret[bugid] = error
+        return ret
+
+
+class _StreamingUnmarshaller(Unmarshaller):
+    '''
+    Unmarshaller that takes the elements of the list stored under 'key'
+    in the top level result struct off the stack as soon as they are
+    complete, and collects them in self.items for the caller to consume.
+    '''
+    def __init__(self, key):
+        Unmarshaller.__init__(self)
+        self._key = key
+        self.items = []
+
+    def end(self, tag):
+        Unmarshaller.end(self, tag)
+
+        # While inside the list, the stack looks like
+        #   [key, <list mark> item]
+        # with a mark for the top level struct and one for the list
+        if (tag == "value" and
+            len(self._marks) == 2 and
+            len(self._stack) > self._marks[1] and
+            self._stack[self._marks[1] - 1] == self._key):
+            self.items.append(self._stack.pop())
+
+
+def _remaining_size(fileobj):
+    '''
+    Return how many bytes are left to read from fileobj, or None if that
+    can't be told up front, like for text mode or unseekable files
+    '''
+    if isinstance(fileobj, TextIOBase):
+        return None
+    if "b" not in getattr(fileobj, "mode", "b"):
+        return None
+
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(0, 2)
+        end = fileobj.tell()
+        fileobj.seek(pos)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return end - pos
+
+
+class _Base64Body(object):
+    '''
+    Request body made of prefix, the contents of fileobj base64 encoded
+    block by block as it's sent, and suffix, so the file is never loaded
+    into memory in full. Text read from fileobj is encoded with the
+    locale's encoding.
+
+    Bugzilla runs as a CGI and wants a Content-Length, so if the size of
+    the file can't be told up front it's spooled to a temporary file first.
+    '''
+    # A multiple of 3, so the encoded blocks can be simply concatenated
+    blocksize = 3 * 64 * 1024
+
+    def __init__(self, prefix, fileobj, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+        self._spooled = None
+
+        self.size = _remaining_size(fileobj)
+        if self.size is None:
+            self._spooled = tempfile.TemporaryFile()
+            for data in self._iter_blocks(fileobj):
+                self._spooled.write(data)
+            self.size = self._spooled.tell()
+            self._spooled.seek(0)
+            fileobj = self._spooled
+        self.fileobj = fileobj
+
+        self._iter = None
+        self._buf = b""
+        self._pos = 0
+
+    def _iter_blocks(self, fileobj):
+        while True:
+            data = fileobj.read(self.blocksize)
+            if not data:
+                break
+            if not isinstance(data, bytes):
+                data = data.encode(locale.getpreferredencoding())
+            yield data
+
+    def close(self):
+        if self._spooled:
+            self._spooled.close()
+            self._spooled = None
+
+    def __len__(self):
+        return (len(self.prefix) + (self.size + 2) // 3 * 4 +
+                len(self.suffix))
+
+    def __iter__(self):
+        yield self.prefix
+
+        count = 0
+        leftover = b""
+        for data in self._iter_blocks(self.fileobj):
+            count += len(data)
+            if count > self.size:
+                break
+            if leftover or len(data) % 3:
+                # Short read, only encode whole 3 byte groups for now
+                data = leftover + data
+                cut = len(data) - len(data) % 3
+                data, leftover = data[:cut], data[cut:]
+            yield base64.b64encode(data)
+        yield base64.b64encode(leftover)
+
+        if count != self.size:
+            raise BugzillaError("File size changed from %d bytes while "
+                                "it was being uploaded" % self.size)
+        yield self.suffix
+
+    def read(self, size=-1):
+        '''File-like interface, for the http libraries'''
+        if self._iter is None:
+            self._iter = iter(self)
+
+        ret = []
+        while size != 0:
+            if self._pos >= len(self._buf):
+                self._buf = next(self._iter, b"")
+                self._pos = 0
+                if not self._buf:
+                    break
+
+            if size < 0:
+                end = len(self._buf)
+            else:
+                end = self._pos + size
+                size -= min(size, len(self._buf) - self._pos)
+            ret.append(self._buf[self._pos:end])
+            self._pos = end
+        return b"".join(ret)
+
+
+class _AttachmentFile(object):
+    '''
+    Read only file-like object returned by openattachment(). Data is
+    read from the HTTP response as it's asked for, and the connection is
+    handed back once everything was read or close() is called.
+    '''
+    def __init__(self, response, name):
+        self._response = response
+        self.name = name
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = None
+        return self._response.raw.read(size, decode_content=True)
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        ignore = args
+        self.close()
+
+
 class RequestsTransport(Transport):
     user_agent = 'Python/Bugzilla'
 
+    # Size of the blocks the response is read and parsed in
+    chunk_size = 64 * 1024
+
     def __init__(self, url, cookiejar=None,
-                 sslverify=True, sslcafile=None, debug=0):
+                 sslverify=True, sslcafile=None, debug=0, pool_size=None):
         # pylint: disable=W0231
         # pylint does not handle multiple import of Transport well
         if hasattr(Transport, "__init__"):
@@ -185,6 +853,25 @@ class RequestsTransport(Transport):
 
         self.verbose = debug
         self._cookiejar = cookiejar
+        self._cookiejar_lock = threading.Lock()
+
+        # Total size of the response bodies received
+        self.bytes_received = 0
+        self._bytes_lock = threading.Lock()
+
+        # A single long lived session, so connections are kept alive
+        # and reused across XMLRPC calls instead of doing a new TCP/SSL
+        # handshake for every request.
+        self.session = requests.Session()
+        if cookiejar is not None:
+            # Share the user's jar, so there's a single copy of the
+            # cookies the server sets
+            self.session.cookies = cookiejar
+        if pool_size:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
 
         # transport constructor needs full url too, as xmlrpc does not pass
         # scheme to request
@@ -196,7 +883,6 @@ class RequestsTransport(Transport):
 
         self.request_defaults = {
             'cert': sslcafile if self.use_https else None,
-            'cookies': cookiejar,
             'verify': sslverify,
             'headers': {
                 'Content-Type': 'text/xml',
@@ -204,10 +890,59 @@ class RequestsTransport(Transport):
             }
         }
 
+    def close(self):
+        """
+        Close the underlying session, dropping any pooled connections
+        """
+        self.session.close()
+
+    def _count_bytes(self, count):
+        with self._bytes_lock:
+            self.bytes_received += count
+
+    def _iter_response_items(self, response, key):
+        """
+        Parse the XMLRPC response, yielding the elements of the result's
+        'key' list as they are unmarshalled. The list in the final result
+        is left empty.
+        """
+        unmarshaller = _StreamingUnmarshaller(key)
+        parser = ExpatParser(unmarshaller)
+        for chunk in self._iter_response(response):
+            parser.feed(chunk)
+            items, unmarshaller.items = unmarshaller.items, []
+            for item in items:
+                yield item
+        parser.close()
+        # Raises any Fault
+        unmarshaller.close()
+
+    def _iter_response(self, response):
+        """
+        Yield the response body in utf-8 encoded blocks, as it arrives.
+        """
+        # We expect utf-8 from the server, but replace any invalid
+        # bytes like response.text would
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            self._count_bytes(len(chunk))
+            yield decoder.decode(chunk).encode("utf-8")
+        yield decoder.decode(b"", True).encode("utf-8")
+
+    def parse_data(self, data):
+        """ Parse a complete XMLRPC response body """
+        parser, unmarshaller = self.getparser()
+        parser.feed(data.decode("utf-8", "replace").encode("utf-8"))
+        parser.close()
+        return unmarshaller.close()
+
     def parse_response(self, response):
         """ Parse XMLRPC response """
+        # Feed the parser incrementally, so we never hold a full copy
+        # of the response body in memory
         parser, unmarshaller = self.getparser()
-        parser.feed(response.text.encode('utf-8'))
+        for chunk in self._iter_response(response):
+            parser.feed(chunk)
         parser.close()
         return unmarshaller.close()
 
@@ -216,25 +951,33 @@ class RequestsTransport(Transport):
         A helper method to assist in making a request and provide a parsed
         response.
         """
+        def _parse(response):
+            yield self.parse_response(response)
+        return list(self._iter_request_helper(url, request_body, _parse))[0]
+
+    def _iter_request_helper(self, url, request_body, parse):
+        """
+        Make the request and yield whatever parse(response) yields. The
+        connection is held until the generator is exhausted or closed.
+        """
         response = None
         try:
-            response = requests.post(
-                url, data=request_body, **self.request_defaults)
+            response = self.session.post(
+                url, data=request_body, stream=True, **self.request_defaults)
 
             # We expect utf-8 from the server
             response.encoding = 'UTF-8'
 
-            # update/set any cookies
-            if self._cookiejar is not None:
-                for cookie in response.cookies:
-                    self._cookiejar.set_cookie(cookie)
-
-                if self._cookiejar.filename is not None:
-                    # Save is required only if we have a filename
+            # The session put any new cookies in the jar, save them.
+            # Save is required only if we have a filename
+            if (self._cookiejar is not None and response.cookies and
+                self._cookiejar.filename is not None):
+                with self._cookiejar_lock:
                     self._cookiejar.save()
 
             response.raise_for_status()
-            return self.parse_response(response)
+            for ret in parse(response):
+                yield ret
         except requests.RequestException:
             e = sys.exc_info()[1]
             if not response:
@@ -248,9 +991,12 @@ class RequestsTransport(Transport):
             e = BugzillaError(str(sys.exc_info()[1]))
             e.__traceback__ = sys.exc_info()[2]
             raise e
+        finally:
+            # Hand the connection back to the pool
+            if response is not None:
+                response.close()
 
-    def request(self, host, handler, request_body, verbose=0):
-        self.verbose = verbose
+    def _prepare_request(self, host, handler, request_body):
         url = "%s://%s%s" % (self.scheme, host, handler)
 
         # xmlrpclib fails to escape \r
@@ -260,8 +1006,127 @@ class RequestsTransport(Transport):
         # Content-Type error later for the POST request
         request_body = request_body.decode('utf-8')
 
+        return url, request_body
+
+    def request(self, host, handler, request_body, verbose=0):
+        # Don't store 'verbose' like xmlrpclib does, the transport is
+        # shared between threads
+        ignore = verbose
+        url, request_body = self._prepare_request(host, handler, request_body)
         return self._request_helper(url, request_body)
 
+    def iter_request(self, host, handler, request_body, key):
+        """
+        Like request(), but return a generator over the elements of the
+        'key' list in the result struct, yielded as they are parsed.
+        """
+        url, request_body = self._prepare_request(host, handler, request_body)
+        return self._iter_request_helper(url, request_body,
+            lambda response: self._iter_response_items(response, key))
+
+    def upload_request(self, host, handler, request_body, placeholder,
+                       fileobj):
+        """
+        Like request(), but the Binary(placeholder) value in request_body
+        is replaced by the contents of fileobj, encoded while it's sent.
+        """
+        url, request_body = self._prepare_request(host, handler, request_body)
+        marker = base64.b64encode(placeholder).decode("ascii")
+        prefix, suffix = request_body.split(marker, 1)
+
+        body = _Base64Body(prefix.encode("utf-8"), fileobj,
+                           suffix.encode("utf-8"))
+        try:
+            return self._request_helper(url, body)
+        finally:
+            body.close()
+
+
+_json_datetime_re = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}:\d{2}:\d{2})Z$")
+
+
+def _json_default(obj):
+    # Convert xmlrpclib parameter types to what bugzilla's JSONRPC
+    # interface expects
+    if isinstance(obj, DateTime):
+        v = obj.value
+        return "%s-%s-%sT%sZ" % (v[0:4], v[4:6], v[6:8], v[9:])
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+    if isinstance(obj, Binary):
+        return base64.b64encode(obj.data).decode("ascii")
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def _json_object_hook(obj):
+    # Convert JSON results to the types xmlrpclib would give us, so
+    # API users can't tell the difference
+    for key, val in obj.items():
+        if isinstance(val, type(u"")):
+            match = _json_datetime_re.match(val)
+            if match:
+                obj[key] = DateTime("%s%s%sT%s" % match.groups())
+        elif isinstance(val, list):
+            for idx, item in enumerate(val):
+                if not isinstance(item, type(u"")):
+                    continue
+                match = _json_datetime_re.match(item)
+                if match:
+                    val[idx] = DateTime("%s%s%sT%s" % match.groups())
+
+    if "file_name" in obj and isinstance(obj.get("data"), type(u"")):
+        # Attachment contents
+        obj["data"] = Binary(base64.b64decode(obj["data"]))
+    return obj
+
+
+class JSONRPCTransport(RequestsTransport):
+    '''
+    Transport that sends the calls made through the XMLRPC ServerProxy
+    to bugzilla's jsonrpc.cgi instead, encoded straight to JSON by
+    dumps_request(). Same method names, same results,
+    errors are raised as xmlrpclib Fault, but large responses are much
+    cheaper to parse.
+    '''
+    def __init__(self, *args, **kwargs):
+        RequestsTransport.__init__(self, *args, **kwargs)
+        self.request_defaults["headers"]["Content-Type"] = "application/json"
+        self._ids = itertools.count(1)
+
+    def parse_data(self, data):
+        """ Parse a complete JSONRPC response body """
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        ret = json.loads(data, object_hook=_json_object_hook)
+        error = ret.get("error")
+        if error:
+            raise Fault(error.get("code"), error.get("message"))
+        return (ret["result"],)
+
+    def parse_response(self, response):
+        """ Parse JSONRPC response """
+        self._count_bytes(len(response.content))
+        return self.parse_data(response.text)
+
+    def dumps_request(self, methodname, params):
+        """ Encode the call methodname(*params) as a JSONRPC request """
+        return json.dumps({
+            "method": methodname,
+            "params": list(params),
+            "id": next(self._ids),
+        }, default=_json_default).encode("utf-8")
+
+    def _prepare_request(self, host, handler, request_body):
+        handler = handler.replace("xmlrpc.cgi", "jsonrpc.cgi")
+        url = "%s://%s%s" % (self.scheme, host, handler)
+        return url, request_body.decode("utf-8")
+
+    def iter_request(self, host, handler, request_body, key):
+        # There's no incremental JSON parser to hook into, so this
+        # fetches the whole result
+        return iter(self.request(host, handler, request_body)[0][key])
+
 
 class BugzillaError(Exception):
     '''Error raised in the Bugzilla client code.'''
@@ -324,6 +1189,28 @@ class BugzillaBase(object):
         to keep giving the library your username and password.  This defaults
         to ~/.bugzillacookies.  If set to None, the library won't save the
         cookies persistently.
+    :kwarg pool_size: Maximum number of keep-alive connections held open
+        to the bugzilla instance. Defaults to the python-requests default.
+    :kwarg transport: 'xmlrpc' (the default) or 'jsonrpc'. The latter talks
+        to bugzilla's jsonrpc.cgi, which is much faster to parse for large
+        query results. The API behaves the same either way.
+    :kwarg cachedir: Directory to cache product, component and bug field
+        info in, so it doesn't need to be downloaded every time. -1 uses
+        $XDG_CACHE_HOME/python-bugzilla. The default None disables the
+        disk cache. How long entries are valid is set by cache_ttl.
+
+    Connections are kept alive between calls. Call close() when done with
+    the object, or use it as a context manager:
+      with Bugzilla(url=...) as bz:
+          ...
+
+    A single connected instance can be shared between threads, so
+    several threads can make calls at the same time over the same
+    login. Saving the login token and cookies is serialized, and cached
+    product and component info is replaced wholesale, never modified in
+    place. Set up the instance first: connect(), login(), logout() and
+    close() shouldn't race with other calls. Bug objects themselves
+    aren't locked, so don't modify the same Bug from several threads.
     '''
 
     # bugzilla version that the class is targetting. filled in by
@@ -335,6 +1222,23 @@ class BugzillaBase(object):
     # unused and basically worthless since we don't plan on breaking API.
     version = "0.1"
 
+    # Seconds that entries in the disk cache (see 'cachedir') are used for
+    cache_ttl = {
+        "autodetect": 24 * 60 * 60,
+        "products": 24 * 60 * 60,
+        "components": 24 * 60 * 60,
+        "bugfields": 7 * 24 * 60 * 60,
+    }
+
+    # Transports that can be selected with the 'transport' init option
+    transports = {
+        "xmlrpc": RequestsTransport,
+        "jsonrpc": JSONRPCTransport,
+    }
+
+    # Size of the blocks attachments are downloaded and written in
+    attachment_chunk_size = 1024 * 1024
+
     @staticmethod
     def url_to_query(url):
         '''
@@ -383,10 +1287,16 @@ class BugzillaBase(object):
         return url
 
     def __init__(self, url=None, user=None, password=None, cookiefile=-1,
-                 sslverify=True, tokenfile=-1):
+                 sslverify=True, tokenfile=-1, pool_size=None,
+                 transport="xmlrpc", cachedir=None):
+        if cachedir == -1:
+            cachedir = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                                    os.path.expanduser("~/.cache"),
+                                    "python-bugzilla")
+
         # Hook to allow Bugzilla autodetection without weirdly overriding
         # __init__
-        if self._init_class_from_url(url, sslverify):
+        if self._init_class_from_url(url, sslverify, cachedir):
             kwargs = locals().copy()
             del(kwargs["self"])
 
@@ -402,9 +1312,31 @@ class BugzillaBase(object):
         self._transport = None
         self._cookiejar = None
         self._sslverify = bool(sslverify)
+        self._pool_size = pool_size
+
+        if transport not in self.transports:
+            raise ValueError("Unknown transport '%s', must be one of: %s" %
+                             (transport, ", ".join(sorted(self.transports))))
+        self._transport_class = self.transports[transport]
 
         self.bug_autorefresh = True
 
+        # If a field is missing from a bug returned by query() or
+        # getbugs(), autorefresh fetches it for all bugs of the result
+        # at once
+        self.bug_autorefresh_batch = True
+
+        # See record_autorefresh()
+        self.autorefresh_recorder = None
+
+        # Fields that batched autorefresh already warned about
+        self._autorefresh_warned = set()
+
+        # getbugs() splits long ID lists into Bug.get calls of at most
+        # getbugs_chunk_size IDs, running up to getbugs_workers at once
+        self.getbugs_chunk_size = 500
+        self.getbugs_workers = 4
+
         # Bugzilla object state info that users shouldn't mess with
         self._proxy = None
         self._products = None
@@ -417,6 +1349,8 @@ class BugzillaBase(object):
             cookiefile = os.path.expanduser('~/.bugzillacookies')
         if tokenfile == -1:
             tokenfile = os.path.expanduser("~/.bugzillatoken")
+        log.debug("Using cachedir=%s", cachedir)
+        self._cachedir = cachedir
         log.debug("Using tokenfile=%s", tokenfile)
         self.cookiefile = cookiefile
         self.tokenfile = tokenfile
@@ -425,6 +1359,7 @@ class BugzillaBase(object):
         # names to actual upstream values. Used for createbug() and
         # query include_fields at least.
         self._field_aliases = []
+        self._alias_index = None
         self._add_field_alias('summary', 'short_desc')
         self._add_field_alias('description', 'comment')
         self._add_field_alias('platform', 'rep_platform')
@@ -447,9 +1382,10 @@ class BugzillaBase(object):
         if url:
             self.connect(url)
 
-    def _init_class_from_url(self, url, sslverify):
+    def _init_class_from_url(self, url, sslverify, cachedir):
         ignore = url
         ignore = sslverify
+        ignore = cachedir
 
     def _init_private_data(self):
         '''initialize private variables used by this bugzilla instance.'''
@@ -458,6 +1394,8 @@ class BugzillaBase(object):
         self._bugfields = None
         self._components = {}
         self._components_details = {}
+        self._product_index = None
+        self._cache = None
 
     def _get_user_agent(self):
         ret = ('Python-urllib bugzilla.py/%s %s' %
@@ -487,30 +1425,71 @@ class BugzillaBase(object):
             return val
         return [val]
 
+    def _get_product_index(self):
+        '''
+        Return ({id: product}, {name: product}) dicts for self.products.
+        They are rebuilt whenever the products list is replaced.
+        '''
+        products = self.products
+        index = self._product_index
+        if index is None or index[0] is not products:
+            byid = {}
+            byname = {}
+            for p in products:
+                # First match wins, like the old linear search
+                byid.setdefault(p.get('id'), p)
+                byname.setdefault(p.get('name'), p)
+            index = (products, byid, byname)
+            self._product_index = index
+        return index[1], index[2]
+
     def _product_id_to_name(self, productid):
         '''Convert a product ID (int) to a product name (str).'''
-        for p in self.products:
-            if p['id'] == productid:
-                return p['name']
-        raise ValueError('No product with id #%i' % productid)
+        p = self._get_product_index()[0].get(productid)
+        if p is None:
+            raise ValueError('No product with id #%i' % productid)
+        return p['name']
 
     def _product_name_to_id(self, product):
         '''Convert a product name (str) to a product ID (int).'''
-        for p in self.products:
-            if p['name'] == product:
-                return p['id']
-        raise ValueError('No product named "%s"' % product)
+        p = self._get_product_index()[1].get(product)
+        if p is None:
+            raise ValueError('No product named "%s"' % product)
+        return p['id']
 
     def _add_field_alias(self, *args, **kwargs):
         self._field_aliases.append(_FieldAlias(*args, **kwargs))
+        self._alias_index = None
+
+    def _get_alias_index(self):
+        '''
+        Return (bug aliases, api aliases, {oldname: bug alias newnames}),
+        built once from _field_aliases and cached until the next
+        _add_field_alias call.
+        '''
+        index = self._alias_index
+        if index is None:
+            bugaliases = tuple([(f.newname, f.oldname)
+                                for f in self._field_aliases if f.is_bug])
+            apialiases = tuple([(f.newname, f.oldname)
+                                for f in self._field_aliases if f.is_api])
+            oldnames = {}
+            for newname, oldname in bugaliases:
+                oldnames.setdefault(oldname, ())
+                oldnames[oldname] += (newname,)
+            index = (bugaliases, apialiases, oldnames)
+            self._alias_index = index
+        return index
 
     def _get_bug_aliases(self):
-        return [(f.newname, f.oldname)
-                for f in self._field_aliases if f.is_bug]
+        return self._get_alias_index()[0]
 
     def _get_api_aliases(self):
-        return [(f.newname, f.oldname)
-                for f in self._field_aliases if f.is_api]
+        return self._get_alias_index()[1]
+
+    def _get_bug_alias_newnames(self, oldname):
+        '''Return the modern Bug attribute names for old name oldname'''
+        return self._get_alias_index()[2].get(oldname, ())
 
 
     ###################
@@ -586,13 +1565,18 @@ class BugzillaBase(object):
             url = self.url
         url = self.fix_url(url)
 
-        self._transport = RequestsTransport(
-            url, self._cookiejar, sslverify=self._sslverify)
+        if self._transport:
+            self._transport.close()
+        self._transport = self._transport_class(
+            url, self._cookiejar, sslverify=self._sslverify,
+            pool_size=self._pool_size)
         self._transport.user_agent = self.user_agent
         self._proxy = _BugzillaServerProxy(url, self.tokenfile,
             self._transport)
 
         self.url = url
+        if self._cachedir:
+            self._cache = _BugzillaCache(self._cachedir, url)
         # we've changed URLs - reload config
         self.readconfig()
 
@@ -607,6 +1591,102 @@ class BugzillaBase(object):
         # clears all the connection state
         self._init_private_data()
 
+    def close(self):
+        '''
+        Disconnect and close any keep-alive connections to the bugzilla
+        instance. Call connect() to use the object again.
+        '''
+        self.disconnect()
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        ignore = args
+        self.close()
+
+
+    def batch(self):
+        '''
+        Return an object that collects XMLRPC calls and sends them all
+        in a single system.multicall request, saving a round trip per
+        call. Use it as a context manager, calls are made with the same
+        syntax as on the XMLRPC proxy and each returns a result object:
+
+          with bz.batch() as b:
+              flagret = b.Flag.update({"ids": [123456], "updates": flags})
+              bugret = b.Bug.update({"ids": [123456], "status": "POST"})
+          print(bugret.result())
+
+        result() raises the Fault for that particular call, if the server
+        returned one.
+        '''
+        return _BugzillaBatch(self._proxy)
+
+    def plan(self, max_workers=None):
+        '''
+        Return an object that collects changes to many bugs, and then
+        makes them with as few calls as possible:
+
+          plan = bz.plan()
+          for bug in bugs:
+              plan.update(bug.id, status="POST", keywords_add="Triaged")
+              plan.update_flags(bug.id, [{"name": "needinfo",
+                                          "status": "X"}])
+          errors = plan.execute()
+
+        Changes to the same bug are merged, and bugs ending up with the
+        same changes share one Bug.update, Flag.update, Bug.update_tags
+        or ExternalBugs.add_external_bug call. Up to max_workers calls
+        run at once, getbugs_workers by default. execute() returns a
+        {bug id: error} dict, with None for bugs where all calls
+        succeeded. plan.dry_run() prints the calls instead.
+        '''
+        if max_workers is None:
+            max_workers = self.getbugs_workers
+        return _BugzillaPlan(self, max_workers)
+
+    def flush_all(self, bugs):
+        '''
+        Send the fields assigned on each of bugs, see Bug.flush(), with
+        bugs that have identical changes sharing a Bug.update. Returns
+        the {bug id: error} dict of plan().execute(). Bugs whose update
+        failed keep their changes.
+        '''
+        plan = self.plan()
+        for bug in bugs:
+            vals = bug.get_changes()
+            if vals:
+                plan.update_dict(bug.bug_id, vals)
+
+        errors = plan.execute()
+        for bug in bugs:
+            if errors.get(bug.bug_id) is None:
+                # pylint: disable=protected-access
+                bug._clear_changes()
+        return errors
+
+    def record_autorefresh(self):
+        '''
+        Start recording the implicit refreshes done when a Bug attribute
+        is missing, to find out what include_fields are lacking. Returns
+        the recorder, also available as bz.autorefresh_recorder:
+
+          recorder = bz.record_autorefresh()
+          ... run the script ...
+          print(recorder.report())
+
+        The report lists how often each attribute was refreshed at each
+        call site, with the time and response bytes it took, and the
+        include_fields recommended for each query shape. Set
+        bz.autorefresh_recorder = None to stop recording.
+        '''
+        self.autorefresh_recorder = _AutorefreshRecorder(self)
+        return self.autorefresh_recorder
+
 
     def _login(self, user, password):
         '''Backend login method for Bugzilla3'''
@@ -729,19 +1809,33 @@ class BugzillaBase(object):
         raise RuntimeError("This bugzilla version does not support listing "
             "bug fields.")
 
+    def _cache_get(self, key):
+        if not self._cache:
+            return None
+        return self._cache.get(key)
+
+    def _cache_set(self, kind, key, value):
+        if self._cache:
+            self._cache.set(key, value, self.cache_ttl[kind])
+
     def getbugfields(self, force_refresh=False):
         '''
         Calls getBugFields, which returns a list of fields in each bug
         for this bugzilla instance. This can be used to set the list of attrs
         on the Bug object.
         '''
-        if force_refresh or self._bugfields is None:
+        bugfields = self._bugfields
+        if not force_refresh and bugfields is None:
+            bugfields = self._cache_get("bugfields")
+        if force_refresh or bugfields is None:
             log.debug("Refreshing bugfields")
-            self._bugfields = self._getbugfields()
-            self._bugfields.sort()
-            log.debug("bugfields = %s", self._bugfields)
+            bugfields = self._getbugfields()
+            bugfields.sort()
+            log.debug("bugfields = %s", bugfields)
+            self._cache_set("bugfields", "bugfields", bugfields)
+        self._bugfields = bugfields
 
-        return self._bugfields
+        return bugfields
     bugfields = property(fget=lambda self: self.getbugfields(),
                          fdel=lambda self: setattr(self, '_bugfields', None))
 
@@ -751,22 +1845,45 @@ class BugzillaBase(object):
         Refresh a product's cached info
         Takes same arguments as _getproductinfo
         """
-        if self._products is None:
-            self._products = []
-
-        for product in self._getproductinfo(**kwargs):
-            added = False
-            for current in self._products[:]:
-                if (current.get("id", -1) != product.get("id", -2) and
-                    current.get("name", -1) != product.get("name", -2)):
-                    continue
-
-                self._products.remove(current)
-                self._products.append(product)
-                added = True
-                break
-            if not added:
-                self._products.append(product)
+        newproducts = self._getproductinfo(**kwargs)
+
+        def _merge(oldproducts):
+            # Build a new list and swap it in, so other threads never see
+            # a half updated one
+            products = list(oldproducts or [])
+            byid = {}
+            byname = {}
+
+            def _add(idx, product):
+                byid.setdefault(product.get("id", -1), idx)
+                byname.setdefault(product.get("name", -1), idx)
+
+            for idx, current in enumerate(products):
+                _add(idx, current)
+
+            for product in newproducts:
+                # Replace the first product matching by id or name. The
+                # replaced slot is blanked, and the update appended
+                matches = [idx for idx in
+                           (byid.get(product.get("id", -2)),
+                            byname.get(product.get("name", -2)))
+                           if idx is not None]
+                if matches:
+                    idx = min(matches)
+                    current = products[idx]
+                    products[idx] = None
+                    for index, key in ((byid, current.get("id", -1)),
+                                       (byname, current.get("name", -1))):
+                        if index.get(key) == idx:
+                            del(index[key])
+
+                _add(len(products), product)
+                products.append(product)
+            return [p for p in products if p is not None]
+
+        self._products = _merge(self._products)
+        if self._cache:
+            self._cache.update("products", _merge)
 
     def getproducts(self, force_refresh=False, **kwargs):
         '''Get product data: names, descriptions, etc.
@@ -776,9 +1893,18 @@ class BugzillaBase(object):
 
         Any method that requires a 'product' can be given either the
         id or the name.'''
-        if force_refresh or not self._products:
-            self._products = self._getproducts(**kwargs)
-        return self._products
+        products = self._products
+        cachekey = "products"
+        if kwargs:
+            cachekey += ":" + json.dumps(kwargs, sort_keys=True)
+
+        if not force_refresh and not products:
+            products = self._cache_get(cachekey)
+        if force_refresh or not products:
+            products = self._getproducts(**kwargs)
+            self._cache_set("products", cachekey, products)
+        self._products = products
+        return products
 
     products = property(fget=lambda self: self.getproducts(),
                         fdel=lambda self: setattr(self, '_products', None))
@@ -789,16 +1915,25 @@ class BugzillaBase(object):
         for the given product. The keys of the dict are component names. For
         each component, the value is a dict with the following keys:
         description, initialowner, initialqacontact'''
-        if force_refresh or product not in self._components_details:
-            clist = self._getcomponentsdetails(product)
-            cdict = {}
-            for item in clist:
-                name = item['component']
-                del item['component']
-                cdict[name] = item
-            self._components_details[product] = cdict
-
-        return self._components_details[product]
+        cdict = self._components_details.get(product)
+        if force_refresh or cdict is None:
+            cachekey = "componentsdetails:%s" % product
+            if not force_refresh:
+                cdict = self._cache_get(cachekey)
+            if cdict is None:
+                clist = self._getcomponentsdetails(product)
+                cdict = {}
+                for item in clist:
+                    name = item['component']
+                    del item['component']
+                    cdict[name] = item
+                self._cache_set("components", cachekey, cdict)
+
+            details = self._components_details.copy()
+            details[product] = cdict
+            self._components_details = details
+
+        return cdict
 
     def getcomponentdetails(self, product, component, force_refresh=False):
         '''Get details for a single component. Returns a dict with the
@@ -809,9 +1944,19 @@ class BugzillaBase(object):
 
     def getcomponents(self, product, force_refresh=False):
         '''Return a dict of components:descriptions for the given product.'''
-        if force_refresh or product not in self._components:
-            self._components[product] = self._getcomponents(product)
-        return self._components[product]
+        comps = self._components.get(product)
+        if force_refresh or comps is None:
+            cachekey = "components:%s" % product
+            if not force_refresh:
+                comps = self._cache_get(cachekey)
+            if comps is None:
+                comps = self._getcomponents(product)
+                self._cache_set("components", cachekey, comps)
+
+            components = self._components.copy()
+            components[product] = comps
+            self._components = components
+        return comps
 
     def _component_data_convert(self, data, update=False):
         if type(data['product']) is int:
@@ -930,19 +2075,26 @@ class BugzillaBase(object):
                                "fetching component details.")
 
         comps = None
-        if self._products is None:
-            self._products = []
 
         def _find_comps():
-            for p in self._products:
+            for p in self._products or []:
                 if p["name"] != product:
                     continue
                 return p.get("components", None)
 
         comps = _find_comps()
         if comps is None:
+            include_fields = ["name", "id", "components"]
+            if self._check_version(4, 4):
+                # Only ask for what we need, for products with lots of
+                # components this is a big difference
+                include_fields = ["name", "id",
+                                  "components.name",
+                                  "components.description",
+                                  "components.default_assigned_to",
+                                  "components.default_qa_contact"]
             self.refresh_products(names=[product],
-                                  include_fields=["name", "id", "components"])
+                                  include_fields=include_fields)
             comps = _find_comps()
 
         if comps is None:
@@ -974,13 +2126,11 @@ class BugzillaBase(object):
     _getbug_extra_fields = []
     _supports_getbug_extra_fields = False
 
-    def _getbugs(self, idlist, simple=False, permissive=True,
+    def _getbugs_data(self, idlist, simple=False, permissive=True,
             include_fields=None, exclude_fields=None, extra_fields=None):
         '''
-        Return a list of dicts of full bug info for each given bug id.
-        bug ids that couldn't be found will return None instead of a dict.
-
-        @simple: If True, don't ask for any large extra_fields.
+        Return the normalized idlist, and the Bug.get parameters to
+        fetch it with. See _getbugs for the arguments.
         '''
         oldidlist = idlist
         idlist = []
@@ -1000,19 +2150,59 @@ class BugzillaBase(object):
             getbugdata["permissive"] = 1
         if self.bz_ver_major >= 4:
             if include_fields:
-                getbugdata["include_fields"] = self._listify(include_fields)
+                getbugdata["include_fields"] = (
+                    self._convert_include_field_list(
+                        self._listify(include_fields)[:]))
             if exclude_fields:
                 getbugdata["exclude_fields"] = self._listify(exclude_fields)
         if self._supports_getbug_extra_fields:
             getbugdata["extra_fields"] = extra_fields
+        return idlist, getbugdata
 
-        log.debug("Calling Bug.get with: %s", getbugdata)
-        r = self._proxy.Bug.get(getbugdata)
+    def _getbugs_chunks(self, idlist):
+        '''Split idlist into lists of at most getbugs_chunk_size IDs'''
+        chunksize = max(self.getbugs_chunk_size or len(idlist), 1)
+        return [idlist[i:i + chunksize]
+                for i in range(0, len(idlist), chunksize)] or [idlist]
+
+    def _getbugs(self, idlist, simple=False, permissive=True,
+            include_fields=None, exclude_fields=None, extra_fields=None):
+        '''
+        Return a list of dicts of full bug info for each given bug id.
+        bug ids that couldn't be found will return None instead of a dict.
+
+        @simple: If True, don't ask for any large extra_fields.
+        '''
+        idlist, getbugdata = self._getbugs_data(idlist, simple=simple,
+            permissive=permissive, include_fields=include_fields,
+            exclude_fields=exclude_fields, extra_fields=extra_fields)
 
+        def _get_chunk(ids):
+            chunkdata = getbugdata.copy()
+            chunkdata["ids"] = ids
+            return self._bug_get(chunkdata)["bugs"]
+
+        chunks = self._getbugs_chunks(idlist)
+        if len(chunks) <= 1 or self.getbugs_workers <= 1:
+            results = [_get_chunk(ids) for ids in chunks]
+        else:
+            log.debug("Fetching %d bugs in %d chunks",
+                      len(idlist), len(chunks))
+            pool = ThreadPool(min(self.getbugs_workers, len(chunks)))
+            try:
+                results = pool.map(_get_chunk, chunks)
+            finally:
+                pool.terminate()
+        return self._getbugs_result(idlist, itertools.chain(*results))
+
+    def _getbugs_result(self, idlist, bugs):
+        '''
+        Match up the bugs returned by Bug.get with the requested idlist
+        '''
         if self.bz_ver_major >= 4:
-            bugdict = dict([(b['id'], b) for b in r['bugs']])
+            bugdict = dict([(b['id'], b) for b in bugs])
         else:
-            bugdict = dict([(b['id'], b['internals']) for b in r['bugs']])
+            bugdict = dict([(b['id'], b['internals']) for b in bugs])
 
         ret = []
         for i in idlist:
@@ -1030,6 +2220,11 @@ class BugzillaBase(object):
 
         return ret
 
+    def _bug_get(self, getbugdata):
+        '''Backend Bug.get call, returns the raw result'''
+        log.debug("Calling Bug.get with: %s", getbugdata)
+        return self._proxy.Bug.get(getbugdata)
+
     def _getbug(self, objid, simple=False,
             include_fields=None, exclude_fields=None, extra_fields=None):
         '''Return a dict of full bug info for the given bug id'''
@@ -1046,15 +2241,16 @@ class BugzillaBase(object):
         return _Bug(self, dict=data, autorefresh=self.bug_autorefresh)
 
     def getbugs(self, idlist,
-        include_fields=None, exclude_fields=None, extra_fields=None):
+        include_fields=None, exclude_fields=None, extra_fields=None,
+        compact=False):
         '''Return a list of Bug objects with the full complement of bug data
         already loaded. If there's a problem getting the data for a given id,
-        the corresponding item in the returned list will be None.'''
+        the corresponding item in the returned list will be None.
+        If compact is True, return memory saving bugs, see query().'''
         data = self._getbugs(idlist, include_fields=include_fields,
             exclude_fields=exclude_fields, extra_fields=extra_fields)
-        return [(b and _Bug(self, dict=b,
-                            autorefresh=self.bug_autorefresh)) or None
-                for b in data]
+        newbug = self._bug_factory(compact, "getbugs()", include_fields)
+        return [(b and newbug(b)) or None for b in data]
 
     # Since for so long getbugsimple was just getbug, I don't think we can
     # remove any fields without possibly causing a slowdown for some
@@ -1202,17 +2398,249 @@ class BugzillaBase(object):
         log.debug("Calling Bug.search with: %s", query)
         return self._proxy.Bug.search(query)
 
-    def query(self, query):
+    def _query_origin(self, query):
+        '''Describe the shape of a query, for _AutorefreshRecorder'''
+        ignore = ["include_fields", "exclude_fields", "extra_fields",
+                  "limit", "offset", "order", "Bugzilla_token"]
+        return "query(%s)" % ", ".join(
+            sorted([k for k in query if k not in ignore]))
+
+    def _bug_factory(self, compact=False, origin=None, include_fields=None):
+        '''
+        Return a function that makes Bug objects from the bug dicts of
+        one result set. With compact, they are _CompactBugs sharing a
+        schema. With autorefresh, they share a _ResultSet, which records
+        their origin and include_fields.
+        '''
+        if not compact:
+            newbug = lambda data: _Bug(self, dict=data,
+                                       autorefresh=self.bug_autorefresh)
+        else:
+            schema = _BugSchema()
+            newbug = lambda data: _CompactBug(self, dict=data,
+                                              autorefresh=self.bug_autorefresh,
+                                              schema=schema)
+
+        if not self.bug_autorefresh:
+            return newbug
+        resultset = _ResultSet(self, origin,
+                               self._listify(include_fields) or None)
+        return lambda data: resultset.add(newbug(data))
+
+    def query(self, query, page_size=None, compact=False):
         '''Query bugzilla and return a list of matching bugs.
         query must be a dict with fields like those in in querydata['fields'].
         Returns a list of Bug objects.
+        If page_size is specified, the results are fetched in several
+        requests of that many bugs, see iterquery_paged().
+        If compact is True, the bugs store their fields in a layout shared
+        by the whole result, and share repeated values like statuses and
+        emails. This takes a fraction of the memory for big results, at
+        the cost of somewhat slower attribute access.
         Also see the _query() method for details about the underlying
         implementation.
         '''
+        if page_size:
+            return list(self.iterquery_paged(query, page_size=page_size,
+                                             compact=compact))
+
         r = self._query(query)
         log.debug("Query returned %s bugs", len(r['bugs']))
-        return [_Bug(self, dict=b,
-                autorefresh=self.bug_autorefresh) for b in r['bugs']]
+        newbug = self._bug_factory(compact, self._query_origin(query),
+                                   query.get("include_fields"))
+        return [newbug(b) for b in r['bugs']]
+
+    def _iterquery(self, query):
+        log.debug("Calling Bug.search incrementally with: %s", query)
+        return self._proxy._iter_request("Bug.search", (query,), "bugs")
+
+    def iterquery(self, query, compact=False):
+        '''Like query(), but return a generator that yields each Bug
+        as soon as it is parsed from the response, rather than waiting
+        for the whole result. Memory use doesn't grow with the number
+        of matching bugs, as long as the caller doesn't keep them around.
+
+        The connection to bugzilla is held until the generator is
+        exhausted or closed.
+        '''
+        newbug = self._bug_factory(compact, self._query_origin(query),
+                                   query.get("include_fields"))
+        for b in self._iterquery(query):
+            yield newbug(b)
+
+    def query_columns(self, query, fields, use_numpy=None):
+        '''Run a query and return the requested fields of the matching
+        bugs as columns, for analysing big results: a numpy structured
+        array if numpy is installed, otherwise a dict mapping each field
+        name to a column. No Bug objects are created.
+
+        Integer fields (like id and dupe_of) become integer columns, with
+        0 for bugs that lack the value. Timestamps become datetime64[s],
+        or datetime.datetime without numpy. Strings are interned, so the
+        many copies of values like statuses and emails are shared.
+        Other values are returned as Bug.search gave them.
+
+        Pass use_numpy=False to get the dict even if numpy is available.
+        '''
+        fields = self._listify(fields)
+        newnames = dict([(oldname, newname)
+                         for newname, oldname in self._get_api_aliases()])
+        colfields = [(name, newnames.get(name, name)) for name in fields]
+
+        query = query.copy()
+        query["include_fields"] = [name for ignore, name in colfields]
+
+        builder = _ColumnBuilder(colfields)
+        for b in self._iterquery(query):
+            builder.add(b)
+        return builder.result(use_numpy=use_numpy)
+
+    def mirror(self, query, dbpath=None, comments=False):
+        '''Return a BugzillaMirror, which keeps a local SQLite copy of
+        the bugs matching query, and only fetches what changed when
+        updated with its sync() method:
+
+          mirror = bz.mirror(bz.build_query(product="Fedora"))
+          mirror.sync()
+          for bug in mirror.bugs():
+              ...
+
+        dbpath defaults to a file per URL and query in the cachedir, or
+        $XDG_CACHE_HOME/python-bugzilla if no cachedir is set. With
+        comments=True, bug comments are mirrored as well.
+
+        With query=None, the existing mirror at dbpath is opened with
+        the query it was made for. mirror.query() runs build_query()
+        style queries against the local copy, without the server.
+        '''
+        # Imported here, bugzilla.mirror needs this module
+        from .mirror import BugzillaMirror
+
+        if query is None and not dbpath:
+            raise ValueError("dbpath is needed to open a mirror without "
+                             "a query")
+        if not dbpath:
+            cachedir = self._cachedir
+            if not cachedir or cachedir == -1:
+                cachedir = os.path.join(
+                    os.environ.get("XDG_CACHE_HOME") or
+                    os.path.expanduser("~/.cache"), "python-bugzilla")
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+
+            querysum = hashlib.sha1(json.dumps(
+                query, sort_keys=True, default=str).encode("utf-8"))
+            dbpath = os.path.join(cachedir, "%s-mirror-%s.sqlite" % (
+                re.sub(r"[^\w.-]", "_", self.url.split("://", 1)[-1]),
+                querysum.hexdigest()[:12]))
+
+        return BugzillaMirror(self, query, dbpath, comments=comments)
+
+    def iterquery_paged(self, query, page_size=1000, prefetch=True,
+                        compact=False):
+        '''Like iterquery(), but walk the results page_size bugs at a
+        time, so no single request is big enough to hit server timeouts.
+        page_size should not exceed the server's maximum number of search
+        results.
+
+        Unless the query specifies an order, results are sorted by bug
+        ID, and each page asks for the bugs after the last ID seen. Bugs
+        that enter or leave the results between requests then can't make
+        others be skipped or returned twice.
+
+        Queries with their own order, or whose boolean charts are joined
+        with j_top=OR, and servers older than Bugzilla 4.4, which ignore
+        custom search charts, are paged with limit and offset instead. There a
+        bug dropping out of the results between requests shifts the later
+        pages, and a bug may be skipped. Bugs that show up on more than
+        one page are only returned once.
+
+        A limit or offset in the query applies to the whole result.
+
+        If prefetch is True, the next page is requested in the background
+        while the caller works through the current one.
+        '''
+        query = query.copy()
+        offset = query.pop("offset", None) or 0
+        limit = query.pop("limit", None) or None
+        sort_by_id = not query.get("order")
+        if sort_by_id:
+            query["order"] = "bug_id"
+        keyset = (sort_by_id and query.get("j_top", "AND") == "AND" and
+                  self._check_version(4, 4))
+
+        # First boolean chart number not used by the query
+        chart = 1 + max([int(k[1:]) for k in query
+                         if re.match(r"^[fovnj]\d+$", k)] or [0])
+
+        def _fetch(pageoffset, afterid):
+            pagequery = query.copy()
+            pagequery["limit"] = page_size
+            pagequery["offset"] = pageoffset
+            if afterid is not None:
+                pagequery["f%d" % chart] = "bug_id"
+                pagequery["o%d" % chart] = "greaterthan"
+                pagequery["v%d" % chart] = afterid
+            return self._query(pagequery)["bugs"]
+
+        newbug = self._bug_factory(compact, self._query_origin(query),
+                                   query.get("include_fields"))
+        pool = None
+        if prefetch:
+            pool = ThreadPool(1)
+
+        # With our own ordering, the last ID is enough to spot
+        # duplicates, and memory use stays flat
+        lastid = None
+        seen = set()
+        count = 0
+        try:
+            nextpage = None
+            nextargs = (offset, None)
+            while True:
+                if nextpage:
+                    page = nextpage.get()
+                else:
+                    page = _fetch(*nextargs)
+                log.debug("Query page returned %s bugs", len(page))
+
+                if keyset:
+                    afterid = nextargs[1]
+                    maxid = max([b["id"] for b in page] or [afterid])
+                    if (len(page) >= page_size and afterid is not None and
+                        maxid <= afterid):
+                        # Asking again would return the same page forever
+                        raise BugzillaError("Server ignored the bug_id "
+                            "search chart, can't page the query by bug ID")
+                    nextargs = (0, maxid)
+                else:
+                    nextargs = (nextargs[0] + page_size, None)
+
+                nextpage = None
+                if (pool and len(page) >= page_size and
+                    (limit is None or count + len(page) < limit)):
+                    nextpage = pool.apply_async(_fetch, nextargs)
+
+                for b in page:
+                    if sort_by_id:
+                        if lastid is not None and b["id"] <= lastid:
+                            continue
+                        lastid = b["id"]
+                    else:
+                        if b["id"] in seen:
+                            continue
+                        seen.add(b["id"])
+
+                    yield newbug(b)
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+
+                if len(page) < page_size:
+                    return
+        finally:
+            if pool:
+                pool.terminate()
 
     def simplequery(self, product, version='', component='',
                     string='', matchtype='allwordssubstr'):
@@ -1252,6 +2680,92 @@ class BugzillaBase(object):
         '''
         return self._proxy.Bug.history({'ids': bug_ids})
 
+    def changes_since(self, query, since=None, interval=None,
+                      statefile=None):
+        '''
+        Generator yielding a (bug_id, history) tuple for every bug matching
+        query that changed at or after since, which can be a datetime, an
+        xmlrpclib DateTime, or a string like 20150102T03:04:05. history
+        is the list of Bug.history entries made since then, like
+        {"when": ..., "who": ..., "changes": [{"field_name": ...,
+        "removed": ..., "added": ...}]}. It's empty for bugs where only
+        comments were added.
+
+        Each poll is a search for just the id and last_change_time of
+        the bugs changed since the newest change seen so far, followed
+        by Bug.history calls for getbugs_chunk_size bugs at a time. With
+        interval, poll again every interval seconds forever, otherwise
+        stop after one poll.
+
+        With statefile, the position is saved there after each poll,
+        and used instead of since when the same query is run again, so
+        a restarted poller continues where it left off. The bugs of a
+        poll that was interrupted are yielded again.
+        '''
+        def _timestamp(val):
+            # DateTime values, or ISO 8601 strings over JSON-RPC
+            return re.sub(r"[-Z]", "", str(getattr(val, "value", val)))
+
+        querystr = json.dumps(query, sort_keys=True, default=_json_default)
+        state = {}
+        if statefile and os.path.exists(statefile):
+            with open(statefile) as f:
+                state = json.load(f)
+            if state.get("query") != querystr:
+                log.info("changes_since query changed, ignoring state in %s",
+                         statefile)
+                state = {}
+
+        mark = state.get("last_change_time")
+        seen = set(state.get("seen", []))
+        if mark is None:
+            if since is None:
+                raise ValueError("since is needed when there's no saved "
+                                 "state to continue from")
+            mark = _timestamp(DateTime(since))
+
+        while True:
+            search = query.copy()
+            search["include_fields"] = ["id", "last_change_time"]
+            search["last_change_time"] = DateTime(mark)
+            found = self._query(search)["bugs"]
+
+            # Bugs changed in the second of the mark show up again, skip
+            # the ones already reported
+            changed = sorted([(_timestamp(b["last_change_time"]), b["id"])
+                              for b in found])
+            changed = [(t, bugid) for t, bugid in changed
+                       if t > mark or bugid not in seen]
+            log.debug("changes_since %s: %d changed bugs", mark, len(changed))
+
+            for chunk in changed and self._getbugs_chunks(changed) or []:
+                ret = self._proxy.Bug.history({
+                    "ids": [bugid for ignore, bugid in chunk],
+                    "new_since": DateTime(mark)})
+                history = dict([(int(b["id"]), b["history"])
+                                for b in ret["bugs"]])
+
+                for ignore, bugid in chunk:
+                    yield bugid, [h for h in history.get(bugid, [])
+                                  if _timestamp(h["when"]) >= mark]
+
+            # Every chunk needs the history since the start of the poll,
+            # so only move the mark once they're all done
+            if changed:
+                newmark = changed[-1][0]
+                if newmark != mark:
+                    seen = set()
+                mark = newmark
+                seen.update([bugid for t, bugid in changed if t == mark])
+                if statefile:
+                    _save_json(statefile, {"query": querystr,
+                                           "last_change_time": mark,
+                                           "seen": sorted(seen)})
+
+            if interval is None:
+                break
+            time.sleep(interval)
+
     #######################################
     # Methods for modifying existing bugs #
     #######################################
@@ -1266,12 +2780,15 @@ class BugzillaBase(object):
         The dictionary passed to this function should be generated with
         build_update(), otherwise we cannot guarantee back compatibility.
         """
-        tmp = updates.copy()
-        tmp["ids"] = self._listify(ids)
-
+        tmp = self._update_bugs_args(ids, updates)
         log.debug("Calling Bug.update with: %s", tmp)
         return self._proxy.Bug.update(tmp)
 
+    def _update_bugs_args(self, ids, updates):
+        tmp = updates.copy()
+        tmp["ids"] = self._listify(ids)
+        return tmp
+
     def update_flags(self, idlist, flags):
         '''
         Updates the flags associated with a bug report.
@@ -1279,27 +2796,60 @@ class BugzillaBase(object):
         [{"name": "needinfo", "status": "+", "requestee": "foo@bar.com"},
          {"name": "devel_ack", "status": "-"}, ...]
         '''
-        d = {"ids": self._listify(idlist), "updates": flags}
+        d = self._update_flags_args(idlist, flags)
         log.debug("Calling Flag.update with: %s", d)
         return self._proxy.Flag.update(d)
 
+    def _update_flags_args(self, idlist, flags):
+        return {"ids": self._listify(idlist), "updates": flags}
+
     def update_tags(self, idlist, tags_add=None, tags_remove=None):
         '''
         Updates the 'tags' field for a bug.
         '''
+        d = self._update_tags_args(idlist, tags_add, tags_remove)
+        log.debug("Calling Bug.update_tags with: %s", d)
+        return self._proxy.Bug.update_tags(d)
+
+    def _update_tags_args(self, idlist, tags_add=None, tags_remove=None):
         tags = {}
         if tags_add:
             tags["add"] = self._listify(tags_add)
         if tags_remove:
             tags["remove"] = self._listify(tags_remove)
 
-        d = {
+        return {
             "ids": self._listify(idlist),
             "tags": tags,
         }
 
-        log.debug("Calling Bug.update_tags with: %s", d)
-        return self._proxy.Bug.update_tags(d)
+    # XMLRPC method called by each of the update methods above
+    _update_methods = {
+        "update_bugs": "Bug.update",
+        "update_flags": "Flag.update",
+        "update_tags": "Bug.update_tags",
+    }
+
+    def _can_batch_updates(self, *names):
+        '''
+        Return True if the named update methods are the plain XMLRPC ones
+        above, and not replaced by a subclass (like the REST based
+        Bugzilla5.update_bugs), so _batch_update() can queue them
+        '''
+        for name in names:
+            owner = [c for c in type(self).__mro__ if name in c.__dict__][0]
+            if owner is not BugzillaBase:
+                return False
+        return True
+
+    def _batch_update(self, batch, name, *args):
+        '''
+        Queue the self.name(*args) update call in batch, and return its
+        result placeholder. Check _can_batch_updates() first.
+        '''
+        params = getattr(self, "_%s_args" % name)(*args)
+        # pylint: disable=protected-access
+        return batch._queue(self._update_methods[name], (params,))
 
 
     def build_update(self,
@@ -1439,6 +2989,31 @@ class BugzillaBase(object):
 
         return ret
 
+    # build_update() arguments that aren't bug fields
+    _update_nonfields = frozenset(["comment", "comment_private",
+                                   "reset_assigned_to", "reset_qa_contact"])
+    _update_fields = None
+
+    def _get_update_fields(self):
+        '''
+        Return the bug fields build_update() can change, which are the
+        ones bug.flush() tracks, as {field: False if it can only be
+        changed with add/remove deltas, else True}
+        '''
+        if BugzillaBase._update_fields is None:
+            # pylint: disable=deprecated-method
+            getargspec = (getattr(inspect, "getfullargspec", None) or
+                          inspect.getargspec)
+            fields = {}
+            for arg in getargspec(BugzillaBase.build_update)[0][1:]:
+                if arg in self._update_nonfields:
+                    continue
+                field = re.sub("_(add|remove|set)$", "", arg)
+                canset = field == arg or arg.endswith("_set")
+                fields[field] = fields.get(field, False) or canset
+            BugzillaBase._update_fields = fields
+        return BugzillaBase._update_fields
+
 
     ########################################
     # Methods for working with attachments #
@@ -1475,9 +3050,41 @@ class BugzillaBase(object):
 
         Returns the list of attachment ids that were added. If only one
         attachment was added, we return the single int ID for back compat
+
+        The file contents are base64 encoded while the request is being
+        sent, so they are never held in memory in full.
+        '''
+        kwargs, f = self._attachfile_args(idlist, attachfile, description,
+                                          **kwargs)
+        try:
+            ret = self._proxy._upload_request(
+                "Bug.add_attachment", kwargs, "data", f)
+        finally:
+            if f is not attachfile:
+                f.close()
+        return self._attachfile_result(ret)
+
+    def _attachfile_data(self, idlist, attachfile, description, **kwargs):
+        '''Build the Bug.add_attachment parameters for attachfile()'''
+        kwargs, f = self._attachfile_args(idlist, attachfile, description,
+                                          **kwargs)
+        try:
+            data = f.read()
+        finally:
+            if f is not attachfile:
+                f.close()
+        if not isinstance(data, bytes):
+            data = data.encode(locale.getpreferredencoding())
+        kwargs['data'] = Binary(data)
+        return kwargs
+
+    def _attachfile_args(self, idlist, attachfile, description, **kwargs):
+        '''
+        Return the Bug.add_attachment parameters without the data, and
+        the file object to read it from
         '''
         if isinstance(attachfile, str):
-            f = open(attachfile)
+            f = open(attachfile, "rb")
         elif hasattr(attachfile, 'read'):
             f = attachfile
         else:
@@ -1494,12 +3101,6 @@ class BugzillaBase(object):
             kwargs["file_name"] = kwargs.pop("filename")
 
         kwargs['summary'] = description
-
-        data = f.read()
-        if not isinstance(data, bytes):
-            data = data.encode(locale.getpreferredencoding())
-        kwargs['data'] = Binary(data)
-
         kwargs['ids'] = self._listify(idlist)
 
         if 'file_name' not in kwargs and hasattr(f, "name"):
@@ -1509,9 +3110,9 @@ class BugzillaBase(object):
             if not ctype:
                 ctype = 'application/octet-stream'
             kwargs['content_type'] = ctype
+        return kwargs, f
 
-        ret = self._proxy.Bug.add_attachment(kwargs)
-
+    def _attachfile_result(self, ret):
         if "attachments" in ret:
             # Up to BZ 4.2
             ret = [int(k) for k in ret["attachments"].keys()]
@@ -1524,38 +3125,158 @@ class BugzillaBase(object):
         return ret
 
 
-    def openattachment(self, attachid):
-        '''Get the contents of the attachment with the given attachment ID.
-        Returns a file-like object.'''
-
-        def get_filename(headers):
-            import re
-
-            match = re.search(
-                r'^.*filename="?(.*)"$',
-                headers.get('content-disposition', '')
-            )
+    def _attachment_filename(self, attachid, headers):
+        '''Returns the attachment file name from the download headers'''
+        match = re.search(
+            r'^.*filename="?(.*)"$',
+            headers.get('content-disposition', '')
+        )
 
-            # default to attchid if no match was found
-            return match.group(1) if match else attachid
-
-        att_uri = self._attachment_uri(attachid)
+        # default to attchid if no match was found
+        return match.group(1) if match else attachid
 
+    def _attachment_request(self, attachid, headers=None):
+        '''Start downloading the attachment, return the streamed response'''
         defaults = self._transport.request_defaults.copy()
         defaults["headers"] = defaults["headers"].copy()
         del(defaults["headers"]["Content-Type"])
+        defaults["headers"].update(headers or {})
+
+        return self._transport.session.get(
+            self._attachment_uri(attachid), stream=True, **defaults)
 
-        response = requests.get(att_uri, stream=True, **defaults)
+    def openattachment(self, attachid):
+        '''Get the contents of the attachment with the given attachment ID.
+        Returns a file-like object with .read() and .name. The data is
+        fetched from the server as it's read, close() the file if it's
+        not read to the end.'''
+        response = self._attachment_request(attachid)
+        return _AttachmentFile(
+            response, self._attachment_filename(attachid, response.headers))
+
+    def download_attachment(self, attachid, dest, resume=False,
+                            size=None, checksum=None):
+        '''
+        Save the attachment with the given ID to dest, which may be a
+        filename or a file-like object opened for writing in binary mode.
+        The data is written in blocks as it arrives, it's never held in
+        memory in full.
+
+        Optional args:
+            resume:   Keep the data already in dest (the existing file, or
+                      everything before the current position of the file
+                      object) and only fetch the rest, with an HTTP Range
+                      request. If the server ignores the range, the whole
+                      attachment is downloaded again.
+            size:     Expected size of the attachment in bytes.
+            checksum: Expected checksum of the attachment, in the form
+                      'ALGORITHM:HEXDIGEST', like 'sha256:0a1b...'. Any
+                      algorithm hashlib supports works. With resume and
+                      a file object, it must be readable too.
+
+        Raises BugzillaError if the download fails or the size or
+        checksum don't match. Returns the attachment file name reported
+        by the server.
+        '''
+        digest = None
+        if checksum:
+            algorithm, ignore, checksum = checksum.partition(":")
+            if not checksum:
+                raise ValueError("checksum must be 'ALGORITHM:HEXDIGEST'")
+            digest = hashlib.new(algorithm)
+
+        if isinstance(dest, str):
+            if resume and os.path.exists(dest):
+                f = open(dest, "r+b")
+                f.seek(0, 2)
+            else:
+                f = open(dest, "wb")
+        elif hasattr(dest, "write"):
+            f = dest
+        else:
+            raise TypeError("dest must be filename or file-like object")
 
-        ret = BytesIO()
-        for chunk in response.iter_content(chunk_size=1024):
-            if chunk:
-                ret.write(chunk)
-        ret.name = get_filename(response.headers)
+        try:
+            offset = resume and f.tell() or 0
+            name, total = self._download_attachment(attachid, f, offset,
+                                                    digest)
+        finally:
+            if f is not dest:
+                f.close()
+
+        if size is not None and total != size:
+            raise BugzillaError("Attachment %s is %d bytes, expected %d" %
+                                (attachid, total, size))
+        if digest and digest.hexdigest() != checksum.lower():
+            raise BugzillaError("Attachment %s has %s checksum %s, "
+                                "expected %s" % (attachid, digest.name,
+                                digest.hexdigest(), checksum))
+        return name
+
+    def _download_attachment(self, attachid, f, offset, digest):
+        '''
+        Write the attachment to f, after the first 'offset' bytes that are
+        already there. Returns the file name and the total size.
+        '''
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+        response = self._attachment_request(attachid, headers)
 
-        # Hooray, now we have a file-like object with .read() and .name
-        ret.seek(0)
-        return ret
+        try:
+            contentrange = response.headers.get("content-range", "")
+            complete = False
+            if offset and response.status_code == 416:
+                # Nothing left to fetch, if the server agrees on the size
+                if contentrange != "bytes */%d" % offset:
+                    raise BugzillaError(
+                        "Partial download of attachment %s doesn't "
+                        "match the attachment (%s)" % (attachid, contentrange))
+                complete = True
+            else:
+                try:
+                    response.raise_for_status()
+                except requests.RequestException:
+                    raise BugzillaError("Error downloading attachment %s: "
+                                        "%s" % (attachid, sys.exc_info()[1]))
+
+                if offset and response.status_code != 206:
+                    log.debug("Server ignored the Range request, "
+                              "downloading attachment %s again", attachid)
+                    f.seek(0)
+                    f.truncate()
+                    offset = 0
+                elif offset and not contentrange.startswith(
+                        "bytes %d-" % offset):
+                    raise BugzillaError("Unexpected Content-Range '%s' "
+                                        "for attachment %s" %
+                                        (contentrange, attachid))
+
+            if digest and offset:
+                # Hash the data that is already there
+                f.seek(0)
+                remaining = offset
+                while remaining:
+                    data = f.read(min(remaining, self.attachment_chunk_size))
+                    if not data:
+                        raise BugzillaError("Couldn't read back the "
+                                            "partial download")
+                    digest.update(data)
+                    remaining -= len(data)
+
+            total = offset
+            if not complete:
+                for chunk in response.iter_content(
+                        chunk_size=self.attachment_chunk_size):
+                    f.write(chunk)
+                    total += len(chunk)
+                    if digest:
+                        digest.update(chunk)
+
+            return (self._attachment_filename(attachid, response.headers),
+                    total)
+        finally:
+            response.close()
 
     def updateattachmentflags(self, bugid, attachid, flagname, **kwargs):
         '''
@@ -1733,8 +3454,12 @@ class BugzillaBase(object):
         :userlist: List of usernames to lookup
         :returns: List of User records
         '''
+        return self._getusers_result(userlist,
+                                     self._getusers(names=userlist))
+
+    def _getusers_result(self, userlist, ret):
         userobjs = [_User(self, **rawuser) for rawuser in
-                    self._getusers(names=userlist).get('users', [])]
+                    ret.get('users', [])]
 
         # Return users in same order they were passed in
         ret = []
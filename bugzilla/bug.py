@@ -11,39 +11,41 @@
 
 import locale
 from logging import getLogger
+import os
 import sys
+import threading
+import time
+import weakref
 
 log = getLogger(__name__)
 
+# Marks fields a bug doesn't have
+_MISSING = object()
 
-class _Bug(object):
-    '''A container object for a bug report. Requires a Bugzilla instance -
-    every Bug is on a Bugzilla, obviously.
-    Optional keyword args:
-        dict=DICT   - populate attributes with the result of a getBug() call
-        bug_id=ID   - if dict does not contain bug_id, this is required before
-                      you can read any attributes or make modifications to this
-                      bug.
+
+class _BugBase(object):
     '''
-    def __init__(self, bugzilla, bug_id=None, dict=None, autorefresh=True):
-        # pylint: disable=redefined-builtin
-        # API had pre-existing issue that we can't change ('dict' usage)
+    Mixin with what regular and compact bugs have in common, only used
+    by _Bug and _CompactBug. They decide how field values are stored,
+    and provide:
 
-        self.bugzilla = bugzilla
-        self._bug_fields = []
-        self.autorefresh = autorefresh
+      _get_field(name): the value of bug field name, or _MISSING
+      _set_fields(newdict): store the {field name: value} in newdict
+    '''
+    # pylint: disable=no-member
+    # No instance dict here, so _CompactBug can do without one
+    __slots__ = ()
 
-        if bug_id:
-            if not dict:
-                dict = {}
-            dict["id"] = bug_id
+    # The _ResultSet this bug came in, if any
+    _resultset = None
 
-        if dict:
-            log.debug("Bug(%s)", sorted(dict.keys()))
-            self._update_dict(dict)
+    # {field: value as loaded} for the fields assigned since the bug was
+    # loaded or last flushed, see flush()
+    _original = None
 
-        self.weburl = bugzilla.url.replace('xmlrpc.cgi',
-                                           'show_bug.cgi?id=%i' % self.bug_id)
+    # List fields that Bug.update changes with add/remove deltas
+    _delta_fields = frozenset(["cc", "blocks", "depends_on", "groups",
+                               "keywords", "see_also"])
 
     def __str__(self):
         '''Return a simple string representation of this bug
@@ -70,18 +72,21 @@ class _Bug(object):
     def __getattr__(self, name):
         refreshed = False
         while True:
-            if refreshed and name in self.__dict__:
+            if refreshed:
                 # If name was in __dict__ to begin with, __getattr__ would
                 # have never been called.
-                return self.__dict__[name]
+                value = self._get_field(name)
+                if value is not _MISSING:
+                    return value
 
             # pylint: disable=protected-access
-            aliases = self.bugzilla._get_bug_aliases()
+            newnames = self.bugzilla._get_bug_alias_newnames(name)
             # pylint: enable=protected-access
 
-            for newname, oldname in aliases:
-                if name == oldname and newname in self.__dict__:
-                    return self.__dict__[newname]
+            for newname in newnames:
+                value = self._get_field(newname)
+                if value is not _MISSING:
+                    return value
 
             # Doing dir(bugobj) does getattr __members__/__methods__,
             # don't refresh for those
@@ -91,19 +96,43 @@ class _Bug(object):
             if refreshed or not self.autorefresh:
                 break
 
+            if not self._autorefresh(name):
+                # Already tried for this bug
+                break
+            refreshed = True
+
+        raise AttributeError("Bug object has no attribute '%s'" % name)
+
+    def _autorefresh(self, name):
+        '''
+        Fetch missing field name from bugzilla. Returns False if nothing
+        was fetched.
+        '''
+        recorder = self.bugzilla.autorefresh_recorder
+        if recorder:
+            start = recorder.start()
+
+        resultset = self._resultset
+        if resultset and self.bugzilla.bug_autorefresh_batch:
+            count = resultset.refresh_field(self, name)
+            if not count:
+                return False
+        else:
             log.info("Bug %i missing attribute '%s' - doing implicit "
                 "refresh(). This will be slow, if you want to avoid "
                 "this, properly use query/getbug include_fields, and "
                 "set bugzilla.bug_autorefresh = False to force failure.",
                 self.bug_id, name)
 
-            # We pass the attribute name to getbug, since for something like
-            # 'attachments' which downloads lots of data we really want the
-            # user to opt in.
+            # We pass the attribute name to getbug, since for something
+            # like 'attachments' which downloads lots of data we really
+            # want the user to opt in.
             self.refresh(extra_fields=[name])
-            refreshed = True
+            count = 1
 
-        raise AttributeError("Bug object has no attribute '%s'" % name)
+        if recorder:
+            recorder.record(start, self, name, count)
+        return True
 
     def refresh(self, include_fields=None, exclude_fields=None,
         extra_fields=None):
@@ -115,7 +144,12 @@ class _Bug(object):
             include_fields=include_fields, exclude_fields=exclude_fields,
             extra_fields=self._bug_fields + (extra_fields or []))
         # pylint: enable=protected-access
+
+        # Keep the changes that weren't flushed yet
+        changes = dict([(field, self._get_field(field))
+                        for field in self._original or []])
         self._update_dict(r)
+        self._set_fields(changes)
     reload = refresh
 
     def _update_dict(self, newdict):
@@ -143,15 +177,108 @@ class _Bug(object):
                             newdict[oldname], oldname)
                 del(newdict[oldname])
 
-        for key in newdict.keys():
-            if key not in self._bug_fields:
-                self._bug_fields.append(key)
-        self.__dict__.update(newdict)
+        self._set_fields(newdict)
 
-        if 'id' not in self.__dict__ and 'bug_id' not in self.__dict__:
+        if (self._get_field('id') is _MISSING and
+            self._get_field('bug_id') is _MISSING):
             raise TypeError("Bug object needs a bug_id")
 
 
+    #################
+    # Field storage #
+    #################
+
+    def _has_field(self, name):
+        '''Return True if the bug has field name, or one of its aliases'''
+        if self._get_field(name) is not _MISSING:
+            return True
+        # pylint: disable=protected-access
+        for newname in self.bugzilla._get_bug_alias_newnames(name):
+            if self._get_field(newname) is not _MISSING:
+                return True
+        return False
+
+    def _loaded_field(self, name):
+        '''
+        Return the field that name, or one of its aliases, is stored
+        under, or None if the bug wasn't loaded with it
+        '''
+        if self._get_field(name) is not _MISSING:
+            return name
+        # pylint: disable=protected-access
+        for newname in self.bugzilla._get_bug_alias_newnames(name):
+            if self._get_field(newname) is not _MISSING:
+                return newname
+        return None
+
+
+    ####################
+    # Assigning fields #
+    ####################
+
+    def get_changes(self):
+        '''
+        Return the Bug.update dict for the fields assigned since the bug
+        was loaded or last flushed. List fields like cc and keywords get
+        add/remove deltas against the loaded lists, other fields their
+        new value. Fields set back to their loaded value are left
+        out. Fields the bug wasn't loaded with are always sent, list
+        fields as a 'set'. Note that only assignments are tracked,
+        changing a list in place isn't.
+        '''
+        ret = {}
+        for field, old in (self._original or {}).items():
+            new = self._get_field(field)
+            if new == old:
+                continue
+            if field not in self._delta_fields:
+                ret[field] = new
+                continue
+
+            # pylint: disable=protected-access
+            if old is _MISSING:
+                ret[field] = {"set": self.bugzilla._listify(new) or []}
+                continue
+            old = self.bugzilla._listify(old) or []
+            new = self.bugzilla._listify(new) or []
+            delta = {}
+            add = [v for v in new if v not in old]
+            remove = [v for v in old if v not in new]
+            if add:
+                delta["add"] = add
+            if remove:
+                delta["remove"] = remove
+            if delta:
+                ret[field] = delta
+        return ret
+
+    def _clear_changes(self):
+        if self._original is not None:
+            object.__setattr__(self, "_original", None)
+
+    def flush(self):
+        '''
+        Send the fields assigned since the bug was loaded or last flushed
+        to bugzilla, in a single Bug.update with just the changes:
+
+          bug.status = "POST"
+          bug.cc = bug.cc + ["someone@example.com"]
+          bug.flush()
+
+        Returns the update_bugs() result, or None if nothing changed.
+        Use bz.flush_all() for many bugs at once.
+        '''
+        vals = self.get_changes()
+        if not vals:
+            self._clear_changes()
+            return None
+
+        log.debug("flush: update=%s", vals)
+        ret = self.bugzilla.update_bugs(self.bug_id, vals)
+        self._clear_changes()
+        return ret
+
+
     ##################
     # pickle helpers #
     ##################
@@ -159,14 +286,9 @@ class _Bug(object):
     def __getstate__(self):
         ret = {}
         for key in self._bug_fields:
-            ret[key] = self.__dict__[key]
+            ret[key] = self._get_field(key)
         return ret
 
-    def __setstate__(self, vals):
-        self._bug_fields = []
-        self.bugzilla = None
-        self._update_dict(vals)
-
 
     #####################
     # Modify bug status #
@@ -430,7 +552,7 @@ class _Bug(object):
         proxy = self.bugzilla._proxy
         # pylint: enable=protected-access
 
-        if "attachments" in self.__dict__:
+        if self._get_field("attachments") is not _MISSING:
             attachments = self.attachments
         else:
             rawret = proxy.Bug.attachments(
@@ -465,6 +587,400 @@ class _Bug(object):
         return self.bugzilla.update_flags(self.bug_id, flaglist)
 
 
+class _Bug(_BugBase):
+    '''A container object for a bug report. Requires a Bugzilla instance -
+    every Bug is on a Bugzilla, obviously.
+    Optional keyword args:
+        dict=DICT   - populate attributes with the result of a getBug() call
+        bug_id=ID   - if dict does not contain bug_id, this is required before
+                      you can read any attributes or make modifications to this
+                      bug.
+    '''
+    # Instance attributes that aren't bug fields
+    _plain_attrs = frozenset(["bugzilla", "autorefresh", "weburl"])
+
+    def __init__(self, bugzilla, bug_id=None, dict=None, autorefresh=True):
+        # pylint: disable=redefined-builtin
+        # API had pre-existing issue that we can't change ('dict' usage)
+
+        # Bypass __setattr__, bugs are created in bulk
+        self.__dict__.update({"bugzilla": bugzilla, "_bug_fields": [],
+                              "autorefresh": autorefresh})
+
+        if bug_id:
+            if not dict:
+                dict = {}
+            dict["id"] = bug_id
+
+        if dict:
+            log.debug("Bug(%s)", sorted(dict.keys()))
+            self._update_dict(dict)
+
+        self.__dict__["weburl"] = bugzilla.url.replace(
+            'xmlrpc.cgi', 'show_bug.cgi?id=%i' % self.bug_id)
+
+    def __setattr__(self, name, value):
+        # Unpickled bugs have no bugzilla to flush to, nothing to track
+        if (name.startswith("_") or name in self._plain_attrs or
+            hasattr(type(self), name) or
+            self.__dict__.get("bugzilla") is None):
+            object.__setattr__(self, name, value)
+            return
+
+        # pylint: disable=protected-access
+        field = self._loaded_field(name)
+        loaded = field is not None
+        if not loaded:
+            newnames = self.bugzilla._get_bug_alias_newnames(name)
+            field = newnames and newnames[0] or name
+
+        # Only fields bugzilla can update are tracked, anything else is
+        # left as a plain attribute
+        updatable = self.bugzilla._get_update_fields()
+        if field not in updatable:
+            object.__setattr__(self, name, value)
+            return
+        if not loaded and not updatable[field]:
+            # Not loaded, so we don't know what we're changing it from
+            raise ValueError("Bug %s wasn't loaded with %s, which can only "
+                "be changed with add/remove. Load it first, or use "
+                "build_update()" % (self.bug_id, field))
+
+        if self._original is None:
+            object.__setattr__(self, "_original", {})
+        if field not in self._original:
+            old = self._get_field(field)
+            if type(old) is list:
+                old = old[:]
+            self._original[field] = old
+        self._set_fields({field: value})
+
+    def _get_field(self, name):
+        '''Return the value of bug field name, or _MISSING'''
+        return self.__dict__.get(name, _MISSING)
+
+    def _set_fields(self, newdict):
+        '''Store the {field name: value} in newdict'''
+        known = set(self._bug_fields)
+        for key in newdict:
+            if key not in known:
+                known.add(key)
+                self._bug_fields.append(key)
+        self.__dict__.update(newdict)
+
+    def __setstate__(self, vals):
+        self._bug_fields = []
+        self.bugzilla = None
+        self._update_dict(vals)
+
+
+class _BugSchema(object):
+    '''
+    Field name to value index mapping shared by the _CompactBugs of a
+    result set, which usually all have the same fields. Also shares one
+    copy of repeated values like statuses, components and emails.
+    '''
+    def __init__(self):
+        self.fields = []
+        self.index = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add_field(self, name):
+        '''Return the index of field name, adding it if needed'''
+        with self._lock:
+            idx = self.index.get(name)
+            if idx is None:
+                idx = len(self.fields)
+                self.fields.append(name)
+                self.index[name] = idx
+            return idx
+
+    def intern(self, value):
+        '''Return a shared copy of value if it's a string. Strings in a
+        list are replaced in place.'''
+        if isinstance(value, _string_types):
+            return self._values.setdefault(value, value)
+        if isinstance(value, list):
+            for idx, v in enumerate(value):
+                if isinstance(v, _string_types):
+                    value[idx] = self._values.setdefault(v, v)
+        return value
+
+
+_string_types = (str, type(u""))
+
+# Bugs unpickled without a result set share this schema
+_default_schema = _BugSchema()
+
+
+class _CompactBug(_BugBase):
+    '''
+    A Bug that uses much less memory, for large result sets: field values
+    are kept in a list indexed by a _BugSchema shared with the other bugs
+    of the result set, repeated strings in the intern_fields are shared,
+    and weburl is computed on demand.
+
+    Attribute access and pickling work like for regular Bugs. Fields are
+    looked up by __getattr__, so reading them is a bit slower. Compact
+    bugs are read only, assigning a field raises AttributeError.
+    '''
+    __slots__ = ("bugzilla", "autorefresh", "_schema", "_values",
+                 "_resultset", "__weakref__")
+
+    # Fields whose values repeat a lot across bugs
+    intern_fields = frozenset([
+        "status", "resolution", "product", "component", "components",
+        "version", "versions", "severity", "priority", "platform", "op_sys",
+        "target_milestone", "classification", "assigned_to", "creator",
+        "qa_contact", "cc", "keywords",
+    ])
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, bugzilla, bug_id=None, dict=None, autorefresh=True,
+                 schema=None):
+        # pylint: disable=redefined-builtin
+        _setslot = object.__setattr__
+        _setslot(self, "bugzilla", bugzilla)
+        _setslot(self, "autorefresh", autorefresh)
+        _setslot(self, "_schema", schema or _default_schema)
+        _setslot(self, "_values", [])
+        _setslot(self, "_resultset", None)
+
+        if bug_id:
+            if not dict:
+                dict = {}
+            dict["id"] = bug_id
+
+        if dict:
+            self._update_dict(dict)
+
+    def __getattr__(self, name):
+        if name in _CompactBug.__slots__:
+            # Not set yet, avoid recursing
+            raise AttributeError("Bug object has no attribute '%s'" % name)
+
+        value = self._get_field(name)
+        if value is not _MISSING:
+            return value
+        return _BugBase.__getattr__(self, name)
+
+    def __setattr__(self, name, value):
+        if name not in _CompactBug.__slots__:
+            raise AttributeError("Compact bugs are read only, can't set "
+                                 "'%s'" % name)
+        object.__setattr__(self, name, value)
+
+    def _get_weburl(self):
+        return self.bugzilla.url.replace('xmlrpc.cgi',
+                                         'show_bug.cgi?id=%i' % self.bug_id)
+    weburl = property(_get_weburl)
+
+    def _get_bug_fields(self):
+        return [name for name in self._schema.fields
+                if self._get_field(name) is not _MISSING]
+    _bug_fields = property(_get_bug_fields)
+
+    def _get_field(self, name):
+        '''Return the value of bug field name, or _MISSING'''
+        idx = self._schema.index.get(name)
+        if idx is None or idx >= len(self._values):
+            return _MISSING
+        return self._values[idx]
+
+    def _set_fields(self, newdict):
+        '''Store the {field name: value} in newdict'''
+        schema = self._schema
+        index = schema.index
+        intern_fields = self.intern_fields
+        values = self._values
+        for key, value in newdict.items():
+            idx = index.get(key)
+            if idx is None:
+                idx = schema.add_field(key)
+            if idx >= len(values):
+                values.extend([_MISSING] * (len(schema.fields) - len(values)))
+            if key in intern_fields:
+                value = schema.intern(value)
+            values[idx] = value
+
+    def __setstate__(self, vals):
+        self.__init__(None, dict=vals)
+
+
+class _ResultSet(object):
+    '''
+    Ties together the bugs returned by one query() or getbugs() call.
+    When autorefresh kicks in for a field one of them is missing, the
+    field is fetched for all of them with one (chunked) Bug.get, rather
+    than with one Bug.get per bug. Bugs are only weakly referenced.
+    '''
+    def __init__(self, bugzilla, origin=None, include_fields=None):
+        self.bugzilla = bugzilla
+        # Where the bugs came from, and the fields that were asked for,
+        # see _AutorefreshRecorder
+        self.origin = origin
+        self.include_fields = include_fields
+        self._bugs = weakref.WeakValueDictionary()
+        # {field name: set of bug IDs it was fetched for}
+        self._fetched = {}
+        self._lock = threading.Lock()
+
+    def add(self, bug):
+        bug._resultset = self
+        self._bugs[id(bug)] = bug
+        return bug
+
+    def refresh_field(self, bug, name):
+        '''
+        Fetch field name for bug, and every other bug of the set that is
+        missing it. Returns the number of bugs fetched, or 0 if that was
+        already tried for bug.
+        '''
+        # pylint: disable=protected-access
+        newnames = self.bugzilla._get_bug_alias_newnames(name)
+        field = newnames and newnames[0] or name
+        with self._lock:
+            fetched = self._fetched.setdefault(field, set())
+            if bug.bug_id in fetched:
+                return 0
+
+            bugs = []
+            for b in list(self._bugs.values()):
+                if (b is bug or
+                    (b.autorefresh and b.bug_id not in fetched and
+                     not b._has_field(name))):
+                    bugs.append(b)
+
+            # Every bug of iterquery() is its own result set, only warn
+            # the first time a field is missing
+            warned = self.bugzilla._autorefresh_warned
+            logfunc = field in warned and log.info or log.warning
+            warned.add(field)
+            logfunc("Bug field '%s' is missing, fetching it for %d "
+                "bugs of the result. Use include_fields to avoid this, "
+                "and set bugzilla.bug_autorefresh = False to force failure.",
+                name, len(bugs))
+
+            include_fields = self.bugzilla._convert_include_field_list(
+                ["id", name])
+            data = self.bugzilla._getbugs([b.bug_id for b in bugs],
+                simple=True, include_fields=include_fields,
+                extra_fields=[name])
+            for b, d in zip(bugs, data):
+                fetched.add(b.bug_id)
+                if d:
+                    b._update_dict(d)
+        return len(bugs)
+
+
+class _AutorefreshRecorder(object):
+    '''
+    Records the implicit refreshes done for missing Bug attributes, see
+    BugzillaBase.record_autorefresh()
+
+    @refreshes: {(attribute, call site): stats dict}, where the stats
+        are 'count' refreshes, fetching 'bugs' bugs, that took 'seconds'
+        and 'bytes' of response. Concurrent requests made by other threads
+        are counted in 'bytes' as well.
+    @origins: {origin: (include_fields, set of attributes)}, where origin
+        describes the query() or getbugs() call the bugs came from
+    '''
+    def __init__(self, bugzilla):
+        self.bugzilla = bugzilla
+        self.refreshes = {}
+        self.origins = {}
+        self._lock = threading.Lock()
+
+    def _bytes_received(self):
+        # pylint: disable=protected-access
+        transport = self.bugzilla._transport
+        return transport and transport.bytes_received or 0
+
+    def start(self):
+        return time.time(), self._bytes_received()
+
+    def record(self, start, bug, name, count):
+        starttime, startbytes = start
+        seconds = time.time() - starttime
+        size = self._bytes_received() - startbytes
+        callsite = _get_callsite()
+
+        resultset = bug._resultset
+        origin = resultset and resultset.origin or "other"
+        include_fields = resultset and resultset.include_fields or None
+
+        with self._lock:
+            stats = self.refreshes.setdefault((name, callsite),
+                {"count": 0, "bugs": 0, "seconds": 0.0, "bytes": 0})
+            stats["count"] += 1
+            stats["bugs"] += count
+            stats["seconds"] += seconds
+            stats["bytes"] += size
+
+            ignore, names = self.origins.setdefault(origin,
+                (include_fields, set()))
+            names.add(name)
+
+    def recommended_include_fields(self):
+        '''
+        Return {origin: include_fields}, with the include_fields that
+        would have avoided all the recorded refreshes for bugs from origin.
+        If origin didn't use include_fields, the list starts with
+        '_default' (supported since bugzilla 5.0) to keep the default
+        fields.
+        '''
+        ret = {}
+        with self._lock:
+            for origin, (include_fields, names) in self.origins.items():
+                fields = list(include_fields or ["_default"])
+                for name in sorted(names):
+                    # pylint: disable=protected-access
+                    name = self.bugzilla._convert_include_field_list(
+                        [name])[0]
+                    if name not in fields:
+                        fields.append(name)
+                ret[origin] = fields
+        return ret
+
+    def report(self):
+        '''
+        Return a summary of the recorded refreshes as a string, most
+        expensive first, followed by the recommended include_fields.
+        '''
+        with self._lock:
+            refreshes = sorted(self.refreshes.items(),
+                               key=lambda i: -i[1]["seconds"])
+
+        lines = []
+        for (name, callsite), stats in refreshes:
+            lines.append("%s: %d refreshes of %d bugs, %.2fs, %d bytes, "
+                         "at %s" % (name, stats["count"], stats["bugs"],
+                                    stats["seconds"], stats["bytes"],
+                                    callsite))
+
+        recommended = self.recommended_include_fields()
+        for origin in sorted(recommended):
+            lines.append("%s: include_fields=%s" %
+                         (origin, recommended[origin]))
+        return "\n".join(lines)
+
+
+def _get_callsite():
+    # The innermost frame outside of this package
+    pkgdir = os.path.dirname(os.path.abspath(__file__))
+    # pylint: disable=protected-access
+    frame = sys._getframe(1)
+    while (frame and
+           os.path.dirname(os.path.abspath(frame.f_code.co_filename)) ==
+           pkgdir):
+        frame = frame.f_back
+    if not frame:
+        return "unknown"
+    return "%s:%d (%s)" % (frame.f_code.co_filename, frame.f_lineno,
+                           frame.f_code.co_name)
+
+
 class _User(object):
     '''Container object for a bugzilla User.
 
@@ -0,0 +1,180 @@
+#
+# Copyright (C) 2015 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+import json
+from logging import getLogger
+import sys
+
+if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
+    # pylint: disable=F0401,E0611
+    from xmlrpc.client import DateTime, Fault, ProtocolError
+else:
+    from xmlrpclib import DateTime, Fault, ProtocolError
+
+import requests
+
+from .base import BugzillaError, _json_default, _json_object_hook
+from .bugzilla4 import Bugzilla44
+
+log = getLogger(__name__)
+
+
+class Bugzilla5(Bugzilla44):
+    '''
+    Bugzilla 5 and later also provide a REST API. Fetching and searching
+    bugs, products and users is done with plain HTTP GET requests, whose
+    responses can be cached by HTTP proxies, and that honor
+    include_fields. Everything else still goes through XMLRPC.
+
+    The REST API doesn't accept login cookies, only tokens, which
+    login() stores for us.
+    '''
+    bz_ver_major = 5
+    bz_ver_minor = 0
+
+    def _rest_url(self, path):
+        return self.url.replace("xmlrpc.cgi", "rest.cgi") + path
+
+    def _rest_request(self, method, path, params=None, data=None):
+        '''
+        Make a REST call and return the decoded JSON result, raising
+        errors reported by bugzilla as Fault, like XMLRPC does.
+        '''
+        params = dict(params or {})
+        if self._proxy.token.value is not None:
+            params["token"] = self._proxy.token.value
+
+        defaults = self._transport.request_defaults.copy()
+        defaults["headers"] = defaults["headers"].copy()
+        defaults["headers"]["Accept"] = "application/json"
+        if data is None:
+            del(defaults["headers"]["Content-Type"])
+        else:
+            defaults["headers"]["Content-Type"] = "application/json"
+            data = json.dumps(data, default=_json_default)
+
+        url = self._rest_url(path)
+        log.debug("Calling REST %s %s with: %s", method, url, params)
+        response = self._transport.session.request(
+            method, url, params=params, data=data, **defaults)
+        self._transport._count_bytes(len(response.content))
+
+        try:
+            ret = json.loads(response.text, object_hook=_json_object_hook)
+        except ValueError:
+            ret = None
+
+        if isinstance(ret, dict) and ret.get("error"):
+            raise Fault(ret.get("code"), ret.get("message"))
+        try:
+            response.raise_for_status()
+        except requests.RequestException:
+            e = sys.exc_info()[1]
+            raise ProtocolError(
+                url, response.status_code, str(e), response.headers)
+        return ret
+
+    def _rest_params(self, params):
+        # requests sends lists as repeated parameters, which bugzilla
+        # understands. Booleans need to be sent as 0/1, and timestamps
+        # in ISO 8601 format
+        ret = {}
+        for key, val in params.items():
+            if type(val) is bool:
+                val = int(val)
+            elif isinstance(val, DateTime):
+                val = _json_default(val)
+            ret[key] = val
+        return ret
+
+
+    ###################
+    # getbug* methods #
+    ###################
+
+    def _bug_get(self, getbugdata):
+        idlist = getbugdata["ids"]
+        params = self._rest_params(getbugdata)
+        del(params["ids"])
+
+        if not getbugdata.get("permissive") and len(idlist) == 1:
+            # Bug.get proper, so missing bugs raise an error
+            return self._rest_request("GET", "/bug/%s" % idlist[0], params)
+
+        if [i for i in idlist if type(i) is not int]:
+            # Bug search by ID can't handle aliases
+            return Bugzilla44._bug_get(self, getbugdata)
+
+        # Missing bugs are silently dropped, like with 'permissive'
+        params["id"] = ",".join([str(i) for i in idlist])
+        return self._rest_request("GET", "/bug", params)
+
+
+    #################
+    # query methods #
+    #################
+
+    def _query(self, query):
+        return self._rest_request("GET", "/bug", self._rest_params(query))
+
+    def _iterquery(self, query):
+        # The JSON response can't be parsed incrementally
+        return iter(self._query(query)["bugs"])
+
+
+    #######################################
+    # Methods for modifying existing bugs #
+    #######################################
+
+    def update_bugs(self, ids, updates):
+        tmp = updates.copy()
+        tmp["ids"] = self._listify(ids)
+
+        return self._rest_request("PUT", "/bug/%s" % tmp["ids"][0], data=tmp)
+
+
+    #############################################
+    # Fetching info about the bugzilla instance #
+    #############################################
+
+    def _getproductinfo(self, ids=None, names=None,
+                        include_fields=None, exclude_fields=None):
+        if ids is None and names is None:
+            raise RuntimeError("Products must be specified")
+
+        params = {}
+        if ids:
+            params["ids"] = self._listify(ids)
+        if names:
+            params["names"] = self._listify(names)
+        if include_fields:
+            params["include_fields"] = include_fields
+        if exclude_fields:
+            params["exclude_fields"] = exclude_fields
+
+        return self._rest_request("GET", "/product", params)["products"]
+
+
+    ##############################
+    # Methods for handling Users #
+    ##############################
+
+    def _getusers(self, ids=None, names=None, match=None):
+        params = {}
+        if ids:
+            params['ids'] = self._listify(ids)
+        if names:
+            params['names'] = self._listify(names)
+        if match:
+            params['match'] = self._listify(match)
+        if not params:
+            raise BugzillaError('_get() needs one of ids, '
+                                ' names, or match kwarg.')
+
+        return self._rest_request("GET", "/user", params)
@@ -0,0 +1,165 @@
+#
+# Copyright (C) 2015 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+'''
+Columnar bug data, see BugzillaBase.query_columns()
+'''
+
+import array
+import datetime
+from logging import getLogger
+import sys
+
+if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
+    # pylint: disable=F0401
+    from xmlrpc.client import DateTime
+else:
+    from xmlrpclib import DateTime
+
+log = getLogger(__name__)
+
+_string_types = (str, type(u""))
+
+numpy = None
+
+
+def _get_numpy():
+    # numpy is slow to import, only do it when needed
+    global numpy
+
+    if numpy is None:
+        try:
+            # pylint: disable=F0401
+            import numpy as _numpy
+            numpy = _numpy
+        except ImportError:
+            e = sys.exc_info()[1]
+            log.debug("Could not load numpy: %s", e)
+            numpy = False
+    return numpy
+
+
+def _column_type(values):
+    '''
+    Return "int", "datetime", "bool", "str" or "object", depending on
+    the type all the non-None values have
+    '''
+    coltype = None
+    for v in values:
+        if v is None:
+            continue
+        if type(v) is int:
+            vtype = "int"
+        elif isinstance(v, DateTime):
+            vtype = "datetime"
+        elif type(v) is bool:
+            vtype = "bool"
+        elif isinstance(v, _string_types):
+            vtype = "str"
+        else:
+            return "object"
+
+        if coltype is None:
+            coltype = vtype
+        elif coltype != vtype:
+            return "object"
+    return coltype or "object"
+
+
+def _to_datetime(v):
+    v = v.value
+    return datetime.datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]),
+                             int(v[9:11]), int(v[12:14]), int(v[15:17]))
+
+
+def _to_iso8601(v):
+    if v is None:
+        return "NaT"
+    v = v.value
+    return "%s-%s-%sT%s" % (v[0:4], v[4:6], v[6:8], v[9:])
+
+
+class _ColumnBuilder(object):
+    '''
+    Collects the requested fields of bug dicts into one list per field,
+    and turns them into typed columns once all bugs are in.
+    '''
+    def __init__(self, fields):
+        # [(column name, field name in the bug dicts), ...]
+        self.fields = fields
+        self.columns = [[] for ignore in fields]
+        self._strings = {}
+
+    def add(self, bug):
+        for (ignore, name), column in zip(self.fields, self.columns):
+            column.append(bug.get(name))
+
+    def _intern(self, values):
+        strings = self._strings
+        return [v is not None and strings.setdefault(v, v) or v
+                for v in values]
+
+    def _build_list_column(self, values, coltype):
+        if coltype == "int":
+            return array.array("l", [v or 0 for v in values])
+        if coltype == "datetime":
+            return [v is not None and _to_datetime(v) or None
+                    for v in values]
+        if coltype == "str":
+            return self._intern(values)
+        return values
+
+    def _build_numpy_column(self, values, coltype):
+        if coltype == "int":
+            return numpy.array([v or 0 for v in values], dtype="i8")
+        if coltype == "datetime":
+            return numpy.array([_to_iso8601(v) for v in values],
+                               dtype="M8[s]")
+        if coltype == "bool":
+            return numpy.array([bool(v) for v in values], dtype="?")
+
+        if coltype == "str":
+            values = self._intern(values)
+        ret = numpy.empty(len(values), dtype="O")
+        ret[:] = values
+        return ret
+
+    def result(self, use_numpy=None):
+        '''
+        Return a numpy structured array if use_numpy is True, or it's
+        None and numpy is available. Otherwise return a dict of columns.
+        '''
+        if use_numpy is None:
+            use_numpy = bool(_get_numpy())
+        elif use_numpy and not _get_numpy():
+            raise ImportError("numpy is not installed")
+
+        names = [colname for colname, ignore in self.fields]
+        columns = self.columns
+        self.columns = None
+
+        if not use_numpy:
+            ret = {}
+            for colname, values in zip(names, columns):
+                ret[colname] = self._build_list_column(
+                    values, _column_type(values))
+            return ret
+
+        arrays = []
+        for values in columns:
+            arrays.append(self._build_numpy_column(
+                values, _column_type(values)))
+        del(columns)
+
+        length = arrays and len(arrays[0]) or 0
+        ret = numpy.empty(length,
+            dtype=[(str(n), a.dtype) for n, a in zip(names, arrays)])
+        for n, a in zip(names, arrays):
+            ret[str(n)] = a
+        return ret
@@ -0,0 +1,593 @@
+#
+# Copyright (C) 2015 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+'''
+Local SQLite copy of the bugs matching a query, see BugzillaBase.mirror()
+'''
+
+import json
+from logging import getLogger
+import os
+import re
+import sqlite3
+import sys
+
+if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
+    # pylint: disable=F0401
+    from xmlrpc.client import DateTime
+else:
+    from xmlrpclib import DateTime
+
+from .base import _json_default, _json_object_hook
+from .bug import _Bug, _string_types
+
+log = getLogger(__name__)
+
+# Bump when the tables change, older mirrors are refetched
+_schema_version = "2"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS bugs (
+    id INTEGER PRIMARY KEY,
+    last_change_time TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS flags (
+    bug_id INTEGER,
+    name TEXT,
+    status TEXT,
+    setter TEXT,
+    requestee TEXT
+);
+CREATE INDEX IF NOT EXISTS flags_bug_id ON flags (bug_id);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    bug_id INTEGER,
+    count INTEGER,
+    creator TEXT,
+    time TEXT,
+    is_private INTEGER,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_bug_id ON comments (bug_id);
+CREATE TABLE IF NOT EXISTS bug_values (
+    bug_id INTEGER,
+    name TEXT,
+    value TEXT COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS bug_values_name ON bug_values (name, value);
+CREATE INDEX IF NOT EXISTS bug_values_bug_id ON bug_values (bug_id);
+"""
+
+# Bug fields indexed in the bug_values table for offline queries, by
+# their Bug.get name, with the names queries use for them. flag values
+# are the flag name and status, like needinfo?
+_indexed_fields = {
+    "alias": ["alias"],
+    "assigned_to": ["assigned_to"],
+    "cc": ["cc"],
+    "classification": ["classification"],
+    "component": ["component"],
+    "creator": ["reporter", "creator"],
+    "flag": ["flag", "flagtypes.name"],
+    "keywords": ["keywords"],
+    "priority": ["priority"],
+    "product": ["product"],
+    "qa_contact": ["qa_contact"],
+    "resolution": ["resolution"],
+    "severity": ["bug_severity", "severity"],
+    "status": ["bug_status", "status"],
+    "summary": ["short_desc", "summary"],
+    "target_milestone": ["target_milestone"],
+    "url": ["bug_file_loc", "url"],
+    "version": ["version"],
+    "whiteboard": ["status_whiteboard", "whiteboard"],
+}
+_query_names = dict([(qname, name)
+                     for name, qnames in _indexed_fields.items()
+                     for qname in qnames])
+
+
+def _index_values(bug):
+    for name in _indexed_fields:
+        val = bug.get(name)
+        if type(val) is not list:
+            val = [val]
+        for v in val:
+            if v is None or v == "":
+                continue
+            if not isinstance(v, _string_types):
+                v = str(v)
+            yield name, v
+
+    for flag in bug.get("flags") or []:
+        yield "flag", "%s%s" % (flag.get("name"), flag.get("status"))
+
+
+def _regexp(pattern, value):
+    # Backs the SQL REGEXP operator, case insensitive like bugzilla's
+    return value is not None and bool(re.search(pattern, value, re.I))
+
+
+class _OfflineQuery(object):
+    '''
+    Translates a build_query() or url_to_query() style dict into SQL
+    over the mirror tables. Handles plain Bug.search fields with their
+    optional FIELD_type match types, the __open__, __closed__ and __all__
+    bug_status values, RHBZ style emailN and boolean charts, and fN/oN/vN
+    custom searches without parentheses. Anything else raises
+    RuntimeError, rather than silently matching too much or too little.
+    '''
+    _ignored_keys = ["include_fields", "exclude_fields", "extra_fields",
+                     "column_list", "query_format", "order",
+                     "Bugzilla_token", "list_id", "ctype"]
+
+    # bug_status values standing for a set of statuses
+    _meta_statuses = ["__open__", "__closed__", "__all__"]
+
+    # Keys read along with some other key
+    _consumed_re = re.compile(r"^(\w+_type|emailtype\d+|email\w+\d+|"
+                              r"(type|value)\d+-\d+-\d+|negate\d+|"
+                              r"[ovn]\d+|j_top)$")
+
+    def __init__(self, query):
+        self.query = query
+        self.limit = 0
+        self.offset = 0
+        self.where = []
+
+        charts = {}
+        customsearch = []
+        for key, val in query.items():
+            chartmatch = re.match(r"^field(\d+)-(\d+)-(\d+)$", key)
+            emailmatch = re.match(r"^email(\d+)$", key)
+            custommatch = re.match(r"^f(\d+)$", key)
+
+            if key in self._ignored_keys:
+                continue
+            elif key == "limit":
+                self.limit = int(val)
+            elif key == "offset":
+                self.offset = int(val)
+            elif key in ["id", "bug_id"]:
+                self._add(self._match("id", "anyexact", val))
+            elif key in _query_names:
+                self._add(self._match(_query_names[key],
+                                      query.get(key + "_type"), val))
+            elif emailmatch:
+                self._add(self._email(emailmatch.group(1), val))
+            elif chartmatch:
+                chart, andid, orid = [int(i) for i in chartmatch.groups()]
+                charts.setdefault(chart, {}).setdefault(andid, []).append(
+                    (orid, key[len("field"):], val))
+            elif custommatch:
+                customsearch.append((int(custommatch.group(1)), val))
+            elif self._consumed_re.match(key):
+                continue
+            else:
+                raise RuntimeError("'%s' search not supported offline" % key)
+
+        for chart in sorted(charts):
+            self._add(self._chart(chart, charts[chart]))
+        if customsearch:
+            self._add(self._customsearch(sorted(customsearch)))
+
+    def _add(self, cond):
+        if cond:
+            self.where.append(cond)
+
+    def _field(self, field):
+        if field in ["id", "bug_id"]:
+            return "id"
+        if field not in _query_names:
+            raise RuntimeError("'%s' search not supported offline" % field)
+        return _query_names[field]
+
+    def _combine(self, op, conds):
+        conds = [c for c in conds if c]
+        if not conds:
+            return None
+        params = []
+        for ignore, p in conds:
+            params += p
+        return ("(%s)" % (" %s " % op).join([c[0] for c in conds]), params)
+
+    def _negate(self, cond):
+        return cond and ("NOT %s" % cond[0], cond[1]) or None
+
+    def _match(self, name, optype, value):
+        '''
+        Return an (sql, params) condition on bugs.id matching bugs where
+        a value of field name matches value, the bugzilla optype way
+        '''
+        exacttypes = ["anyexact", "equals", "exact", "notequals"]
+        if name == "status":
+            words = self._listify(value)
+            if len(words) == 1:
+                words = ("%s" % words[0]).split(",")
+            words = [("%s" % w).strip() for w in words]
+            if [w for w in words if w in self._meta_statuses]:
+                return self._meta_status(optype, words)
+
+        if optype is None:
+            # Plain Bug.search parameters match any of the values exactly
+            optype = "anyexact"
+            if name != "id":
+                value = self._listify(value)
+        if type(value) is list:
+            if optype not in exacttypes:
+                value = " ".join(["%s" % v for v in value])
+        elif optype == "anyexact":
+            value = [v.strip() for v in ("%s" % value).split(",")]
+        else:
+            value = "%s" % value
+
+        if name == "id":
+            if optype not in exacttypes[:-1]:
+                raise RuntimeError("'%s' search on bug IDs not supported "
+                                   "offline" % optype)
+            value = [int(v) for v in self._listify(value) if v != ""]
+            return ("id IN (%s)" % ", ".join(["?"] * len(value)), value)
+
+        def values(cond, params):
+            return ("id IN (SELECT bug_id FROM bug_values "
+                    "WHERE name = ? AND %s)" % cond, [name] + params)
+
+        def substring(word):
+            word = re.sub(r"([\\%_])", r"\\\1", word)
+            return values("value LIKE ? ESCAPE '\\'", ["%" + word + "%"])
+
+        def word(w):
+            return values("value REGEXP ?",
+                          [r"(^|[\s,])%s([\s,]|$)" % re.escape(w)])
+
+        if optype in exacttypes:
+            value = self._listify(value)
+            cond = values("value IN (%s)" % ", ".join(["?"] * len(value)),
+                          value)
+            if optype == "notequals":
+                return self._negate(cond)
+            return cond
+        if optype == "substring":
+            return substring(value)
+        if optype == "notsubstring":
+            return self._negate(substring(value))
+        if optype == "casesubstring":
+            return values("instr(value, ?) > 0", [value])
+        if optype == "regexp":
+            return values("value REGEXP ?", [value])
+        if optype == "notregexp":
+            return self._negate(values("value REGEXP ?", [value]))
+        if optype == "isnotempty":
+            return values("1", [])
+        if optype == "isempty":
+            return self._negate(values("1", []))
+
+        for suffix, func in [("wordssubstr", substring), ("words", word)]:
+            if not optype.endswith(suffix):
+                continue
+            how = optype[:-len(suffix)]
+            conds = [func(w) for w in re.split(r"[\s,]+", value) if w]
+            if how == "all":
+                return self._combine("AND", conds)
+            if how == "any":
+                return self._combine("OR", conds)
+            if how == "no":
+                return self._negate(self._combine("OR", conds))
+
+        raise RuntimeError("'%s' search type not supported offline" % optype)
+
+    def _meta_status(self, optype, words):
+        '''
+        Return the condition for bug_status words that include __open__,
+        __closed__ or __all__. Closed bugs are the ones with a resolution
+        '''
+        if optype not in [None, "anyexact", "equals", "exact"]:
+            raise RuntimeError("'%s' search on %s not supported offline" %
+                               (optype, ", ".join(words)))
+        if "__all__" in words:
+            return ("1", [])
+
+        resolved = self._match("resolution", "isnotempty", "")
+        conds = []
+        if "__open__" in words:
+            conds.append(self._negate(resolved))
+        if "__closed__" in words:
+            conds.append(resolved)
+        rest = [w for w in words if w not in self._meta_statuses]
+        if rest:
+            conds.append(self._match("status", "anyexact", rest))
+        return self._combine("OR", conds)
+
+    def _listify(self, value):
+        return type(value) is list and value or [value]
+
+    def _email(self, num, value):
+        optype = self.query.get("emailtype%s" % num, "substring")
+        conds = []
+        for field in ["assigned_to", "reporter", "qa_contact", "cc"]:
+            if self.query.get("email%s%s" % (field, num)):
+                conds.append(self._match(self._field(field), optype, value))
+        return self._combine("OR", conds)
+
+    def _chart(self, chart, andgroups):
+        andconds = []
+        for andid in sorted(andgroups):
+            orconds = []
+            for ignore, suffix, field in sorted(andgroups[andid]):
+                if field == "noop":
+                    continue
+                orconds.append(self._match(
+                    self._field(field),
+                    self.query.get("type" + suffix, "substring"),
+                    self.query.get("value" + suffix, "")))
+            andconds.append(self._combine("OR", orconds))
+
+        cond = self._combine("AND", andconds)
+        if self.query.get("negate%d" % chart):
+            cond = self._negate(cond)
+        return cond
+
+    def _customsearch(self, fields):
+        conds = []
+        for num, field in fields:
+            if field == "noop":
+                continue
+            if field in ["OP", "CP"]:
+                raise RuntimeError("Parentheses in custom searches are "
+                                   "not supported offline")
+            cond = self._match(self._field(field),
+                               self.query.get("o%d" % num, "substring"),
+                               self.query.get("v%d" % num, ""))
+            if self.query.get("n%d" % num):
+                cond = self._negate(cond)
+            conds.append(cond)
+
+        if self.query.get("j_top") == "OR":
+            return self._combine("OR", conds)
+        return self._combine("AND", conds)
+
+    def sql(self):
+        '''Return the (sql, params) selecting the matching bug data'''
+        cond = self._combine("AND", self.where) or ("1", [])
+        sql = "SELECT data FROM bugs WHERE %s ORDER BY id" % cond[0]
+        if self.limit or self.offset:
+            sql += " LIMIT %d OFFSET %d" % (self.limit or -1, self.offset)
+        return sql, cond[1]
+
+
+class BugzillaMirror(object):
+    '''
+    Keeps a SQLite database at dbpath up to date with the bugs matching
+    query. The first sync() fetches all of them, later ones only fetch
+    the bugs whose last_change_time moved since, and drop the bugs that
+    changed so that they no longer match.
+
+    The database has these tables, for querying it directly via
+    mirror.db:
+
+        bugs (id, last_change_time, data): data is the JSON encoded bug
+            dict, as Bug.get returned it (minus comments), after
+            post_translation()
+        flags (bug_id, name, status, setter, requestee)
+        comments (id, bug_id, count, creator, time, is_private, text):
+            only filled in with comments=True
+
+    Timestamps are in xmlrpclib DateTime format, like 20150102T03:04:05.
+    '''
+    def __init__(self, bz, query, dbpath, comments=False):
+        if query is None and not os.path.exists(dbpath):
+            raise ValueError("No mirror database at %s" % dbpath)
+
+        self.bz = bz
+        self.dbpath = dbpath
+        self.comments = comments
+
+        self.db = sqlite3.connect(dbpath)
+        self.db.create_function("regexp", 2, _regexp)
+        self.db.executescript(_schema)
+        if self._get_meta("schema") != _schema_version:
+            self.clear()
+
+        # A database only mirrors one query, start over if it changed
+        querystr = self._get_meta("query")
+        if query is None:
+            self.mirror_query = querystr and json.loads(
+                querystr, object_hook=_json_object_hook) or None
+            return
+
+        self.mirror_query = query.copy()
+        newquerystr = json.dumps(self.mirror_query, sort_keys=True,
+                                 default=_json_default)
+        if querystr not in [None, newquerystr]:
+            log.info("Mirror query changed, starting over")
+            self.clear()
+        self._set_meta("query", newquerystr)
+        self._set_meta("url", bz.url)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM bugs").fetchone()[0]
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        return row and row[0] or None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, value))
+
+    def clear(self):
+        '''Empty the mirror, the next sync() fetches everything again'''
+        for table in ["meta", "bugs", "flags", "comments", "bug_values"]:
+            self.db.execute("DELETE FROM %s" % table)
+        self._set_meta("schema", _schema_version)
+        self.db.commit()
+
+
+    ###########
+    # Syncing #
+    ###########
+
+    def _search(self, query, since):
+        query = query.copy()
+        query["include_fields"] = ["id", "last_change_time"]
+        if since:
+            query["last_change_time"] = DateTime(since)
+        # pylint: disable=protected-access
+        return self.bz._query(query)["bugs"]
+
+    def _get_comments(self, idlist):
+        # pylint: disable=protected-access
+        ret = self.bz._proxy.Bug.comments({"ids": idlist})
+        return dict([(int(bugid), val["comments"])
+                     for bugid, val in ret["bugs"].items()])
+
+    def _store(self, bugs, comments):
+        for bug in bugs:
+            bugid = bug["id"]
+            self.db.execute("DELETE FROM flags WHERE bug_id = ?", (bugid,))
+            for flag in bug.get("flags") or []:
+                self.db.execute("INSERT INTO flags VALUES (?, ?, ?, ?, ?)",
+                    (bugid, flag.get("name"), flag.get("status"),
+                     flag.get("setter"), flag.get("requestee")))
+
+            self.db.execute("DELETE FROM bug_values WHERE bug_id = ?",
+                            (bugid,))
+            self.db.executemany("INSERT INTO bug_values VALUES (?, ?, ?)",
+                [(bugid, name, value) for name, value in _index_values(bug)])
+
+            if bugid in comments:
+                self.db.execute("DELETE FROM comments WHERE bug_id = ?",
+                                (bugid,))
+                for c in comments[bugid]:
+                    self.db.execute(
+                        "INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (c["id"], bugid, c.get("count"), c.get("creator"),
+                         str(c.get("time") or ""),
+                         int(bool(c.get("is_private"))), c.get("text")))
+
+            self.bz.post_translation({}, bug)
+            self.db.execute("INSERT OR REPLACE INTO bugs VALUES (?, ?, ?)",
+                (bugid, str(bug.get("last_change_time") or ""),
+                 json.dumps(bug, default=_json_default)))
+
+    def _remove(self, idlist):
+        for bugid in idlist:
+            for table, column in [("bugs", "id"), ("flags", "bug_id"),
+                                  ("comments", "bug_id"),
+                                  ("bug_values", "bug_id")]:
+                self.db.execute("DELETE FROM %s WHERE %s = ?" %
+                                (table, column), (bugid,))
+
+    def sync(self):
+        '''
+        Bring the mirror up to date. Returns the lists of updated and
+        removed bug IDs.
+        '''
+        if self.mirror_query is None:
+            raise RuntimeError("Mirror at %s has no query to sync" %
+                               self.dbpath)
+
+        since = self._get_meta("last_change_time")
+        found = self._search(self.mirror_query, since)
+        log.debug("Mirror search since %s found %d bugs", since, len(found))
+
+        stored = dict(self.db.execute("SELECT id, last_change_time "
+                                      "FROM bugs").fetchall())
+        changed = []
+        highwater = since
+        for b in found:
+            lastchange = str(b["last_change_time"])
+            if stored.get(b["id"]) != lastchange:
+                changed.append(b["id"])
+            if not highwater or lastchange > highwater:
+                highwater = lastchange
+
+        # Drop bugs that no longer match the query. Only mirrored bugs
+        # that changed since the last sync can have dropped out
+        foundids = set([b["id"] for b in found])
+        if since:
+            candidates = set()
+            notfound = sorted([i for i in stored if i not in foundids])
+            step = max(self.bz.getbugs_chunk_size or 0, 1)
+            for i in range(0, len(notfound), step):
+                candidates.update([b["id"] for b in
+                                   self._search({"id": notfound[i:i + step]},
+                                                since)])
+        else:
+            candidates = set(stored)
+        removed = sorted([i for i in candidates
+                          if i in stored and i not in foundids])
+        self._remove(removed)
+
+        # Fetch in steps, committing as we go. Comments go in their
+        # own table, not in the bug data
+        step = max(self.bz.getbugs_chunk_size or 0, 1) * 10
+        for i in range(0, len(changed), step):
+            idlist = changed[i:i + step]
+            # pylint: disable=protected-access
+            bugs = [b for b in self.bz._getbugs(idlist,
+                                                exclude_fields=["comments"])
+                    if b]
+            comments = {}
+            if self.comments:
+                comments = self._get_comments(idlist)
+            self._store(bugs, comments)
+            self.db.commit()
+
+        # Only move the mark once everything is stored, so an interrupted
+        # sync is redone from the old one
+        if highwater:
+            self._set_meta("last_change_time", highwater)
+        self.db.commit()
+        log.debug("Mirror updated %d bugs, removed %d", len(changed),
+                  len(removed))
+        return changed, removed
+
+
+    ###########
+    # Reading #
+    ###########
+
+    def _make_bug(self, data):
+        return _Bug(self.bz, dict=json.loads(data,
+                                             object_hook=_json_object_hook),
+                    autorefresh=False)
+
+    def bugs(self):
+        '''Yield a Bug object for every mirrored bug, by ID'''
+        for row in self.db.execute("SELECT data FROM bugs ORDER BY id"):
+            yield self._make_bug(row[0])
+
+    def getbug(self, bugid):
+        '''Return the mirrored Bug with ID bugid, or None'''
+        row = self.db.execute("SELECT data FROM bugs WHERE id = ?",
+                              (bugid,)).fetchone()
+        return row and self._make_bug(row[0]) or None
+
+    def query(self, query):
+        '''
+        Return the mirrored bugs matching query, a dict as returned by
+        build_query() or url_to_query(), as a list of Bug objects. Only
+        mirrored bugs can match, and search parameters that can't be
+        evaluated locally raise RuntimeError.
+        '''
+        sql, params = _OfflineQuery(query).sql()
+        log.debug("Offline query: %s %s", sql, params)
+        return [self._make_bug(row[0])
+                for row in self.db.execute(sql, params)]
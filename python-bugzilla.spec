@@ -74,6 +74,8 @@ popd
 %endif # with_python3
 
 %{__python2} setup.py install -O1 --skip-build --root %{buildroot}
+# asyncio client is python3 only
+rm -f %{buildroot}%{python2_sitelib}/bugzilla/asyncbugzilla.py*
 
 
 %check
@@ -4,14 +4,26 @@ from __future__ import print_function
 import atexit
 import difflib
 import imp
+import json
 import os
+import re
 import shlex
 import sys
+import threading
 
 if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
     from io import StringIO
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+    from xmlrpc.client import Fault
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 else:
     from StringIO import StringIO
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+    from SimpleXMLRPCServer import (SimpleXMLRPCServer,
+                                    SimpleXMLRPCRequestHandler)
+    from xmlrpclib import Fault
 
 
 _cleanup = []
@@ -105,3 +117,156 @@ def clicomm(argv, bzinstance, returnmain=False, printcliout=False,
         sys.stderr = oldstderr
         sys.stdin = oldstdin
         sys.argv = oldargv
+
+
+def _serve_in_thread(server):
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class _LocalRequestHandler(SimpleXMLRPCRequestHandler):
+    # Accept requests on any path, like /xmlrpc.cgi
+    rpc_paths = ()
+
+    def do_POST(self):
+        self.server.request_cookies.append(self.headers.get("cookie"))
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def end_headers(self):
+        for cookie in self.server.set_cookies:
+            self.send_header("Set-Cookie", cookie)
+        SimpleXMLRPCRequestHandler.end_headers(self)
+
+    def do_GET(self):
+        # attachment.cgi?id=X downloads
+        query = parse_qs(urlparse(self.path).query)
+        attachment = self.server.attachments.get(query.get("id", [""])[0])
+        if attachment is None:
+            self.send_error(404)
+            return
+
+        filename, data = attachment
+        status = 200
+        match = re.match(r"^bytes=(\d+)-$", self.headers.get("range", ""))
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+            contentrange = "bytes %d-%d/%d" % (start, len(data) - 1,
+                                               len(data))
+            data = data[start:]
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition",
+                         'attachment; filename="%s"' % filename)
+        if status == 206:
+            self.send_header("Content-Range", contentrange)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_xmlrpc_server(methods):
+    """
+    Start an XMLRPC server on localhost in a background thread, serving
+    the passed {"Bug.get": callable, ...} dict. system.multicall is
+    supported. The bugzilla URL is available as server.url, call
+    server.shutdown() when finished.
+
+    Attachments can be downloaded from attachment.cgi after adding them
+    to the server.attachments {"ID": (filename, bytes)} dict. Range
+    requests are honoured unless server.ranges is set to False.
+
+    Every response sets the cookies in the server.set_cookies list of
+    Set-Cookie header values. The Cookie header of each request, or
+    None, is appended to server.request_cookies.
+    """
+    server = SimpleXMLRPCServer(("127.0.0.1", 0),
+                                requestHandler=_LocalRequestHandler,
+                                logRequests=False, allow_none=True)
+    server.attachments = {}
+    server.ranges = True
+    server.set_cookies = []
+    server.request_cookies = []
+    server.register_multicall_functions()
+    for name, func in methods.items():
+        server.register_function(func, name)
+
+    server.url = "http://127.0.0.1:%d/xmlrpc.cgi" % server.server_address[1]
+    return _serve_in_thread(server)
+
+
+def start_jsonrpc_server(methods):
+    """
+    Like start_xmlrpc_server, but speaking bugzilla's JSONRPC dialect.
+    The callables take and return JSON compatible values.
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            ignore = args
+
+        def do_POST(self):
+            self.server.paths.append(self.path)
+            length = int(self.headers.get("content-length"))
+            req = json.loads(self.rfile.read(length).decode("utf-8"))
+            ret = {"id": req["id"], "error": None, "result": None}
+            try:
+                ret["result"] = methods[req["method"]](*req["params"])
+            except Fault:
+                e = sys.exc_info()[1]
+                ret["error"] = {"code": e.faultCode,
+                                "message": e.faultString}
+
+            body = json.dumps(ret).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(("127.0.0.1", 0), _Handler)
+    server.paths = []
+    server.url = "http://127.0.0.1:%d/xmlrpc.cgi" % server.server_address[1]
+    return _serve_in_thread(server)
+
+
+def start_rest_server(callback):
+    """
+    Start a fake bugzilla REST server. callback is called as
+    callback(method, path, query, body) with the parsed query string
+    and JSON body, and must return a (status, result) tuple.
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            ignore = args
+
+        def _handle(self):
+            url = urlparse(self.path)
+            body = None
+            length = int(self.headers.get("content-length") or 0)
+            if length:
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+
+            status, ret = callback(self.command, url.path,
+                                   parse_qs(url.query), body)
+            out = json.dumps(ret).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        do_GET = _handle
+        do_PUT = _handle
+
+    server = HTTPServer(("127.0.0.1", 0), _Handler)
+    server.url = "http://127.0.0.1:%d/xmlrpc.cgi" % server.server_address[1]
+    return _serve_in_thread(server)
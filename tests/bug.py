@@ -16,7 +16,7 @@ import unittest
 from tests import StringIO
 
 from bugzilla import RHBugzilla
-from bugzilla.bug import _Bug
+from bugzilla.bug import _Bug, _BugBase, _BugSchema, _CompactBug
 
 
 rhbz = RHBugzilla(cookiefile=None, tokenfile=None)
@@ -82,3 +82,58 @@ class BugTest(unittest.TestCase):
             raise AssertionError("Expected lack of ID failure.")
         except TypeError:
             pass
+
+    def testCompact(self):
+        data = {
+            "bug_id": 123456,
+            "status": "NEW",
+            "assigned_to": "foo@bar.com",
+            "short_desc": "some short desc",
+            "cf_fixed_in": "nope",
+            "fixed_in": "1.2.3.4",
+        }
+        schema = _BugSchema()
+        bug = _CompactBug(self.bz, dict=data.copy(), schema=schema,
+                          autorefresh=False)
+        bug2 = _CompactBug(self.bz, schema=schema, dict={
+            "id": 2, "assigned_to": "".join(["foo", "@bar.com"])})
+
+        def _assert_bug():
+            self.assertEqual(bug.summary, "some short desc")
+            self.assertEqual(bug.short_desc, "some short desc")
+            self.assertEqual(bug.cf_fixed_in, "1.2.3.4")
+            self.assertEqual(bug.bug_status, "NEW")
+            self.assertFalse(hasattr(bug, "resolution"))
+
+        _assert_bug()
+        self.assertTrue(isinstance(bug, _BugBase))
+        self.assertFalse(hasattr(bug, "__dict__"))
+
+        # Read only
+        self.assertRaises(AttributeError, setattr, bug, "status", "POST")
+        self.assertRaises(AttributeError, setattr, bug, "newfield", 1)
+        self.assertEqual(bug.status, "NEW")
+        self.assertEqual(bug.__getstate__()["status"], "NEW")
+        self.assertEqual(bug.get_changes(), {})
+        self.assertEqual(bug.flush(), None)
+        self.assertEqual(str(bug),
+            "#123456 NEW        - foo@bar.com - some short desc")
+        self.assertEqual(bug.weburl,
+            _Bug(self.bz, dict=data.copy()).weburl)
+
+        # Repeated values are shared, fields are stored in the schema
+        self.assertTrue(bug.assigned_to is bug2.assigned_to)
+        self.assertEqual(sorted(bug._bug_fields),
+            ["assigned_to", "fixed_in", "id", "status", "summary"])
+        self.assertEqual(len(schema.fields), 5)
+        self.assertFalse(hasattr(bug2, "summary"))
+
+        # Pickled state is the same as for regular bugs
+        state = bug.__getstate__()
+        self.assertEqual(state,
+            _Bug(self.bz, dict=data.copy()).__getstate__())
+        bug = pickle.loads(pickle.dumps(bug))
+        self.assertTrue(isinstance(bug, _CompactBug))
+        self.assertEqual(bug.bugzilla, None)
+        bug.bugzilla = self.bz
+        _assert_bug()
@@ -18,6 +18,8 @@ import shutil
 import sys
 import unittest
 
+import requests
+
 import bugzilla
 
 import tests
@@ -170,3 +172,46 @@ class MiscAPI(unittest.TestCase):
         bz3 = bugzilla.Bugzilla3(None, cookiefile=None, tokenfile=None)
         self.assertRaises(RuntimeError, bz3.getbugfields)
         self.assertRaises(RuntimeError, bz3.getqueryinfo)
+
+    def testTransportSession(self):
+        bz = bugzilla.Bugzilla4(url="https://example.com",
+            cookiefile=None, tokenfile=None, pool_size=4)
+        transport = bz._transport
+        self.assertTrue(isinstance(transport.session, requests.Session))
+        adapter = transport.session.get_adapter("https://example.com")
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+        # Reconnecting replaces the transport, close() drops it
+        bz.connect()
+        self.assertTrue(bz._transport is not transport)
+        with bz:
+            pass
+        self.assertEqual(bz._transport, None)
+
+    def testProductIndex(self):
+        bz = bugzilla.Bugzilla4(url=None, cookiefile=None, tokenfile=None)
+        bz._products = [{"id": 1, "name": "foo"}, {"id": 2, "name": "bar"}]
+        self.assertEqual(bz._product_name_to_id("bar"), 2)
+        self.assertEqual(bz._product_id_to_name(1), "foo")
+        self.assertRaises(ValueError, bz._product_name_to_id, "baz")
+
+        # refresh_products() replaces matching entries, and the
+        # index follows along
+        bz._getproductinfo = lambda **kwargs: [
+            {"id": 2, "name": "newbar"}, {"id": 3, "name": "baz"}]
+        bz.refresh_products(ids=[2, 3])
+        self.assertEqual(bz._products, [{"id": 1, "name": "foo"},
+            {"id": 2, "name": "newbar"}, {"id": 3, "name": "baz"}])
+        self.assertEqual(bz._product_name_to_id("baz"), 3)
+        self.assertEqual(bz._product_id_to_name(2), "newbar")
+        self.assertRaises(ValueError, bz._product_name_to_id, "bar")
+
+    def testAliasIndex(self):
+        rhbz = bugzilla.RHBugzilla(url=None, cookiefile=None, tokenfile=None)
+        self.assertEqual(rhbz._get_bug_alias_newnames("short_desc"),
+                         ("summary",))
+        self.assertEqual(rhbz._get_bug_alias_newnames("summary"), ())
+
+        rhbz._add_field_alias("newfoo", "oldfoo")
+        self.assertEqual(rhbz._get_bug_alias_newnames("oldfoo"), ("newfoo",))
+        self.assertTrue(("newfoo", "oldfoo") in rhbz._get_api_aliases())
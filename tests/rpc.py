@@ -0,0 +1,1501 @@
+#
+# Copyright Red Hat, Inc. 2015
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+#
+
+'''
+Unit tests that talk XMLRPC to a fake bugzilla server on localhost
+'''
+
+import base64
+import datetime
+import hashlib
+from io import BytesIO
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+if hasattr(sys.version_info, "major") and sys.version_info.major >= 3:
+    from xmlrpc.client import DateTime, ExpatParser, Fault, dumps
+else:
+    from xmlrpclib import DateTime, ExpatParser, Fault, dumps
+
+import bugzilla
+from bugzilla.base import (BugzillaError, _BugzillaCache,
+                           _StreamingUnmarshaller)
+from bugzilla.bug import _Bug
+from bugzilla.bugzilla4 import Bugzilla42, Bugzilla44
+from bugzilla.bugzilla5 import Bugzilla5
+
+AsyncBugzilla = None
+if sys.version_info >= (3, 5):
+    import asyncio
+    from bugzilla.asyncbugzilla import AsyncBugzilla
+
+import tests
+
+
+class RPCTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.calls = []
+        self.shifts = []
+        self.removals = []
+        self.removed = set()
+
+        def _bug_get(params):
+            self.calls.append(("Bug.get", params))
+            bugs = []
+            for i in params["ids"]:
+                if i == 7:
+                    continue
+                if i == "somealias":
+                    bugs.append({"id": 100, "alias": ["somealias"]})
+                    continue
+                bugs.append({"id": i, "summary": "bug %s" % i})
+            return {"bugs": bugs}
+
+        def _bug_search(params):
+            self.calls.append(("Bug.search", params))
+            if "product" not in params:
+                raise Fault(32000, "Search needs a product")
+            bugs = [{"id": i, "cc": ["a@example.com"],
+                     "flags": [{"name": "needinfo"}]}
+                    for i in range(1, 101) if i not in self.removed]
+            for n in range(1, 10):
+                if (params.get("f%d" % n) == "bug_id" and
+                    params.get("o%d" % n) == "greaterthan"):
+                    bugs = [b for b in bugs
+                            if b["id"] > int(params["v%d" % n])]
+            if "limit" in params:
+                # Pretend bugs were added that shift later pages
+                start = params["offset"]
+                if self.shifts:
+                    start -= self.shifts.pop(0)
+                bugs = bugs[max(start, 0):start + params["limit"]]
+            if self.removals:
+                # Pretend bugs were closed after this request
+                self.removed.update(self.removals.pop(0))
+            return {"bugs": bugs, "faults": [{"id": 0}]}
+
+        def _flag_update(params):
+            self.calls.append(("Flag.update", params))
+            if not params["updates"]:
+                raise Fault(300, "No flag updates")
+            return {}
+
+        def _record(name):
+            def _cb(params):
+                self.calls.append((name, params))
+                return {}
+            return _cb
+
+        def _bug_add_attachment(params):
+            self.calls.append(("Bug.add_attachment", params))
+            return {"ids": [1234]}
+
+        self.server = tests.start_xmlrpc_server({
+            "Bug.get": _bug_get,
+            "Bug.search": _bug_search,
+            "Bug.update": _record("Bug.update"),
+            "Bug.update_tags": _record("Bug.update_tags"),
+            "Bug.add_attachment": _bug_add_attachment,
+            "Flag.update": _flag_update,
+        })
+
+        multicall = self.server.funcs["system.multicall"]
+        def _multicall(calls):
+            self.calls.append(("system.multicall", len(calls)))
+            return multicall(calls)
+        self.server.funcs["system.multicall"] = _multicall
+
+        self.bz = Bugzilla44(url=self.server.url,
+                             cookiefile=None, tokenfile=None)
+
+    def tearDown(self):
+        self.bz.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testCookies(self):
+        # The session uses the user's jar, and no copy of its own
+        self.server.set_cookies = ["Bugzilla_logincookie=abc; Path=/"]
+        self.bz.getbug(1)
+        self.assertTrue(self.bz._transport.session.cookies is
+                        self.bz._cookiejar)
+        self.assertEqual([c.value for c in self.bz._cookiejar], ["abc"])
+        self.bz.getbug(2)
+
+        self.server.set_cookies = []
+        self.bz._cookiejar.clear()
+        self.bz.getbug(3)
+        self.assertEqual(self.server.request_cookies,
+                         [None, "Bugzilla_logincookie=abc", None])
+
+    def testBatch(self):
+        self.bz._proxy.token.value = "sometoken"
+        with self.bz.batch() as b:
+            bugret = b.Bug.get({"ids": [1, 2]})
+            flagret = b.Flag.update({"ids": [1], "updates": []})
+            self.assertFalse(bugret.done())
+
+        self.assertEqual([b["id"] for b in bugret.result()["bugs"]], [1, 2])
+        self.assertRaises(Fault, flagret.result)
+
+        # Both calls went in the same multicall, and each got the token
+        self.assertEqual(self.calls[0], ("system.multicall", 2))
+        self.assertEqual([c[0] for c in self.calls[1:]],
+                         ["Bug.get", "Flag.update"])
+        for ignore, params in self.calls[1:]:
+            self.assertEqual(params["Bugzilla_token"], "sometoken")
+
+        # Nothing is sent if the block raises an exception
+        try:
+            with self.bz.batch() as b:
+                b.Bug.get({"ids": [3]})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(self.calls), 3)
+
+    def testIterquery(self):
+        self.bz._proxy.token.value = "sometoken"
+        self.bz._transport.chunk_size = 64
+        bugs = self.bz.iterquery({"product": "foo"})
+        self.assertEqual(self.calls, [])
+
+        bug = next(bugs)
+        self.assertEqual(bug.bug_id, 1)
+        self.assertEqual(bug.cc, ["a@example.com"])
+        self.assertEqual(bug.flags, [{"name": "needinfo"}])
+        self.assertEqual([b.bug_id for b in bugs], list(range(2, 101)))
+        self.assertEqual(self.calls, [("Bug.search",
+            {"product": "foo", "Bugzilla_token": "sometoken"})])
+
+        self.assertRaises(Fault, list, self.bz.iterquery({}))
+
+        # Abandoning the generator releases the connection
+        bugs = self.bz.iterquery({"product": "foo"})
+        next(bugs)
+        bugs.close()
+        self.assertEqual(len(self.bz.query({"product": "foo"})), 100)
+
+    def testQueryCompact(self):
+        bugs = self.bz.query({"product": "foo"}, compact=True)
+        self.assertEqual([b.bug_id for b in bugs], list(range(1, 101)))
+        self.assertTrue(bugs[0].cc[0] is bugs[1].cc[0])
+        self.assertTrue(bugs[0]._schema is bugs[1]._schema)
+
+        # Autorefresh fills in fields of compact bugs too
+        self.assertEqual(bugs[4].summary, "bug 5")
+        self.assertEqual(self.calls[-1][0], "Bug.get")
+        self.assertEqual(bugs[4].cc, ["a@example.com"])
+        self.assertEqual(bugs[5].summary, "bug 6")
+
+        bugs = self.bz.query({"product": "foo"}, page_size=60, compact=True)
+        self.assertEqual([b.bug_id for b in bugs], list(range(1, 101)))
+        self.assertTrue(bugs[0]._schema is bugs[99]._schema)
+        bugs = self.bz.getbugs([1, 7], compact=True)
+        self.assertEqual(bugs[0].summary, "bug 1")
+        self.assertEqual(bugs[1], None)
+
+    def testQueryColumns(self):
+        def _bug_search(params):
+            self.calls.append(("Bug.search", params))
+            bugs = []
+            for i in range(1, 6):
+                bug = {"id": i, "status": i % 2 and "NEW" or "ASSIGNED",
+                       "creation_time": DateTime("2015010%dT03:04:05" % i),
+                       "cc": ["a@example.com"]}
+                if i == 3:
+                    bug["dupe_of"] = 1
+                bugs.append(bug)
+            return {"bugs": bugs}
+        self.server.funcs["Bug.search"] = _bug_search
+
+        fields = ["bug_id", "status", "dupe_of", "creation_time", "cc"]
+        cols = self.bz.query_columns({"product": "foo"}, fields,
+                                     use_numpy=False)
+        self.assertEqual(self.calls[-1][1]["include_fields"],
+            ["id", "status", "dupe_of", "creation_time", "cc"])
+        self.assertEqual(sorted(cols.keys()), sorted(fields))
+        self.assertEqual(list(cols["bug_id"]), [1, 2, 3, 4, 5])
+        self.assertEqual(cols["bug_id"].typecode, "l")
+        self.assertEqual(list(cols["dupe_of"]), [0, 0, 1, 0, 0])
+        self.assertEqual(cols["status"],
+            ["NEW", "ASSIGNED", "NEW", "ASSIGNED", "NEW"])
+        self.assertTrue(cols["status"][0] is cols["status"][2])
+        self.assertEqual(cols["creation_time"][1],
+                         datetime.datetime(2015, 1, 2, 3, 4, 5))
+        self.assertEqual(cols["cc"][0], ["a@example.com"])
+
+        try:
+            import numpy
+        except ImportError:
+            return
+        arr = self.bz.query_columns({"product": "foo"}, fields)
+        self.assertTrue(isinstance(arr, numpy.ndarray))
+        self.assertEqual(arr["bug_id"].dtype, numpy.dtype("i8"))
+        self.assertEqual(list(arr["dupe_of"]), [0, 0, 1, 0, 0])
+        self.assertEqual(list(arr[arr["status"] == "NEW"]["bug_id"]),
+                         [1, 3, 5])
+        self.assertEqual(arr["creation_time"][0],
+                         numpy.datetime64("2015-01-01T03:04:05"))
+
+    def testAutorefreshBatch(self):
+        self.bz.getbugs_chunk_size = 40
+        bugs = self.bz.query({"product": "foo"})
+        other = self.bz.query({"product": "foo"})[:2]
+        del(self.calls[:])
+
+        # The first miss fetches the field for the whole result
+        self.assertEqual(bugs[9].short_desc, "bug 10")
+        ids = []
+        for name, params in self.calls:
+            self.assertEqual((name, params["include_fields"]),
+                             ("Bug.get", ["id", "summary"]))
+            ids += params["ids"]
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(sorted(ids), list(range(1, 101)))
+        self.assertEqual([b.summary for b in bugs[:3]],
+                         ["bug 1", "bug 2", "bug 3"])
+
+        # Bug 7 isn't returned by Bug.get, it isn't tried again
+        del(self.calls[:])
+        self.assertFalse(hasattr(bugs[6], "summary"))
+        self.assertEqual(self.calls, [])
+
+        # Bugs from other results aren't affected
+        self.assertEqual(other[1].summary, "bug 2")
+        self.assertEqual(self.calls[0][1]["ids"], [1, 2])
+
+        # Each bug refreshes separately without batching
+        self.bz.bug_autorefresh_batch = False
+        del(self.calls[:])
+        bugs = self.bz.query({"product": "foo"})
+        self.assertEqual(bugs[1].summary, "bug 2")
+        self.assertEqual(self.calls[-1][1]["ids"], [2])
+
+        # Without autorefresh, there's no result set
+        self.bz.bug_autorefresh = False
+        bugs = self.bz.query({"product": "foo"})
+        self.assertEqual(bugs[0]._resultset, None)
+
+    def testAutorefreshWarnsOnce(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        buglog = logging.getLogger("bugzilla.bug")
+        oldlevel = buglog.level
+        buglog.setLevel(logging.INFO)
+        buglog.addHandler(handler)
+        try:
+            # Every bug of iterquery() is its own result set
+            for bug in self.bz.iterquery({"product": "foo"}):
+                ignore = getattr(bug, "summary", None)
+        finally:
+            buglog.removeHandler(handler)
+            buglog.setLevel(oldlevel)
+
+        levels = [r.levelno for r in records
+                  if "is missing" in r.getMessage()]
+        self.assertEqual(levels, [logging.WARNING] + [logging.INFO] * 99)
+
+    def testAutorefreshRecorder(self):
+        recorder = self.bz.record_autorefresh()
+        self.assertTrue(self.bz.autorefresh_recorder is recorder)
+
+        bugs = self.bz.query({"product": "foo", "limit": 5, "offset": 0})
+        summaries = [b.short_desc for b in bugs]
+        self.assertEqual(summaries[0], "bug 1")
+        bugs = self.bz.getbugs([1, 2], include_fields=["id", "cc"])
+        self.assertFalse(hasattr(bugs[0], "whiteboard"))
+
+        self.assertEqual(len(recorder.refreshes), 2)
+        (name, callsite), stats = [i for i in recorder.refreshes.items()
+                                   if i[0][0] == "short_desc"][0]
+        self.assertTrue("rpc.py:" in callsite)
+        self.assertEqual((stats["count"], stats["bugs"]), (1, 5))
+        self.assertTrue(stats["bytes"] > 0)
+        self.assertTrue(stats["seconds"] > 0)
+
+        self.assertEqual(recorder.recommended_include_fields(), {
+            "query(product)": ["_default", "summary"],
+            "getbugs()": ["id", "cc", "whiteboard"],
+        })
+        report = recorder.report().splitlines()
+        self.assertEqual(len(report), 4)
+        self.assertTrue(report[-1].startswith(
+            "query(product): include_fields=["))
+
+    def testQueryPaged(self):
+        bugs = self.bz.query({"product": "foo"}, page_size=30)
+        self.assertEqual([b.bug_id for b in bugs], list(range(1, 101)))
+        self.assertEqual([(c[1]["limit"], c[1]["offset"], c[1]["order"],
+                           c[1].get("f1"), c[1].get("o1"), c[1].get("v1"))
+                          for c in self.calls],
+                         [(30, 0, "bug_id", None, None, None),
+                          (30, 0, "bug_id", "bug_id", "greaterthan", 30),
+                          (30, 0, "bug_id", "bug_id", "greaterthan", 60),
+                          (30, 0, "bug_id", "bug_id", "greaterthan", 90)])
+
+        # Bugs dropping out of the results between pages don't make
+        # others be skipped
+        self.calls = []
+        self.removals = [[3, 5, 12]]
+        bugs = self.bz.iterquery_paged({"product": "foo"}, page_size=10,
+                                       prefetch=False)
+        self.assertEqual([b.bug_id for b in bugs],
+                         [i for i in range(1, 101) if i != 12])
+        self.removed = set()
+
+        # Limit and offset apply to the whole result
+        self.calls = []
+        bugs = self.bz.iterquery_paged(
+            {"product": "foo", "offset": 10, "limit": 25},
+            page_size=10, prefetch=False)
+        self.assertEqual([b.bug_id for b in bugs], list(range(11, 36)))
+        self.assertEqual([(c[1]["offset"], c[1].get("v1"))
+                          for c in self.calls],
+                         [(10, None), (0, 20), (0, 30)])
+
+        # The query's own boolean charts are kept
+        self.calls = []
+        bugs = list(self.bz.iterquery_paged(
+            {"product": "foo", "f1": "bug_id", "o1": "greaterthan",
+             "v1": 50}, page_size=30))
+        self.assertEqual([b.bug_id for b in bugs], list(range(51, 101)))
+        self.assertEqual([c[1].get("v2") for c in self.calls], [None, 80])
+
+    def testQueryPagedOffsets(self):
+        # A user specified order is kept, and paged with offsets.
+        # Overlapping pages don't produce duplicates.
+        self.shifts = [0, 1, 3]
+        bugs = self.bz.iterquery_paged(
+            {"product": "foo", "order": "priority", "offset": 10,
+             "limit": 25}, page_size=10, prefetch=False)
+        self.assertEqual([b.bug_id for b in bugs], list(range(11, 36)))
+        self.assertEqual([(c[1]["offset"], c[1]["order"])
+                          for c in self.calls],
+                         [(10, "priority"), (20, "priority"),
+                          (30, "priority")])
+
+        # So are charts joined with OR
+        self.calls = []
+        bugs = list(self.bz.iterquery_paged(
+            {"product": "foo", "j_top": "OR"}, page_size=50))
+        self.assertEqual(len(bugs), 100)
+        self.assertEqual([(c[1]["offset"], c[1].get("f1"))
+                          for c in self.calls],
+                         [(0, None), (50, None), (100, None)])
+
+    def testQueryPagedIgnoredCharts(self):
+        def _bug_search(params):
+            self.calls.append(("Bug.search", params))
+            start = params["offset"]
+            return {"bugs": [{"id": i} for i in
+                             range(1, 101)[start:start + params["limit"]]]}
+        self.server.funcs["Bug.search"] = _bug_search
+
+        # A server ignoring the bug_id chart keeps returning the first
+        # page, which must not be asked for forever
+        bugs = self.bz.iterquery_paged({"product": "foo"}, page_size=30,
+                                       prefetch=False)
+        self.assertRaises(BugzillaError, list, bugs)
+        self.assertEqual(len(self.calls), 2)
+
+        # Servers before 4.4 are paged with offsets
+        self.calls = []
+        bz42 = Bugzilla42(url=self.server.url,
+                          cookiefile=None, tokenfile=None)
+        try:
+            bugs = list(bz42.iterquery_paged({"product": "foo"},
+                                             page_size=30))
+        finally:
+            bz42.close()
+        self.assertEqual([b.bug_id for b in bugs], list(range(1, 101)))
+        self.assertEqual([(c[1]["offset"], c[1].get("f1"))
+                          for c in self.calls],
+                         [(0, None), (30, None), (60, None), (90, None)])
+
+    def testQueryCLI(self):
+        out = tests.clicomm("bugzilla query --product foo --page-size 40 "
+                            "--outputformat %{bug_id}", self.bz)
+        self.assertEqual(out.splitlines()[-100:],
+                         [str(i) for i in range(1, 101)])
+        self.assertEqual([c[1].get("v1") for c in self.calls],
+                         [None, 40, 80])
+
+    def testStreamingUnmarshaller(self):
+        data = dumps(({"bugs": [{"id": 1}, {"id": 2}], "total": 2},),
+                     methodresponse=True).encode("utf-8")
+        unmarshaller = _StreamingUnmarshaller("bugs")
+        parser = ExpatParser(unmarshaller)
+
+        # Bugs are available as soon as their struct is complete
+        idx = data.index(b"</struct>") + len(b"</struct></value>")
+        parser.feed(data[:idx])
+        self.assertEqual(unmarshaller.items, [{"id": 1}])
+        parser.feed(data[idx:])
+        parser.close()
+        self.assertEqual(unmarshaller.items, [{"id": 1}, {"id": 2}])
+        self.assertEqual(unmarshaller.close(), ({"bugs": [], "total": 2},))
+
+    def testGetbugsChunked(self):
+        self.bz.getbugs_chunk_size = 3
+        idlist = [10, 9, 8, 7, "somealias", 5, 4, 3, 2, 1]
+        bugs = self.bz.getbugssimple(idlist)
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(sorted([len(c[1]["ids"]) for c in self.calls]),
+                         [1, 3, 3, 3])
+        self.assertTrue(all([c[1]["permissive"] for c in self.calls]))
+
+        # Order and None for missing bugs are preserved
+        self.assertEqual([b and b.bug_id for b in bugs],
+                         [10, 9, 8, None, 100, 5, 4, 3, 2, 1])
+
+        self.calls = []
+        self.bz.getbugs_chunk_size = None
+        bugs = self.bz.getbugs(idlist, include_fields=["summary"])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0][1]["include_fields"], ["summary"])
+        self.assertEqual(bugs[3], None)
+
+    def testThreads(self):
+        self.bz._proxy.token.value = "sometoken"
+
+        def _getbug(bugid):
+            return self.bz.getbug(bugid).summary
+
+        pool = ThreadPool(4)
+        try:
+            ret = pool.map(_getbug, range(10, 50))
+        finally:
+            pool.terminate()
+        self.assertEqual(ret, ["bug %s" % i for i in range(10, 50)])
+        self.assertEqual(len(self.calls), 40)
+        self.assertTrue(all([c[1]["Bugzilla_token"] == "sometoken"
+                             for c in self.calls]))
+
+    def testModify(self):
+        tests.clicomm("bugzilla modify 1,2 --flag needinfo? "
+                      "--tags foo --status POST", self.bz)
+
+        # Flags, tags and the field update all go in one request
+        self.assertEqual([c[0] for c in self.calls],
+            ["system.multicall", "Flag.update",
+             "Bug.update_tags", "Bug.update"])
+        self.assertEqual(self.calls[3][1],
+            {"ids": ["1", "2"], "status": "POST"})
+
+        # The server runs all of them, but a failure is still reported,
+        # and the whiteboard tags aren't changed
+        def _flag_update(params):
+            self.calls.append(("Flag.update", params))
+            raise Fault(32000, "Flag is locked")
+        self.server.funcs["Flag.update"] = _flag_update
+        self.calls = []
+        self.assertRaises(Fault, tests.clicomm,
+            "bugzilla modify 1 --flag needinfo? --status POST "
+            "--whiteboard +foo", self.bz)
+        self.assertEqual([c[0] for c in self.calls],
+            ["system.multicall", "Flag.update", "Bug.update"])
+
+    def testModifyOverriddenUpdates(self):
+        updates = []
+
+        class _RESTUpdates(Bugzilla44):
+            def update_bugs(self, ids, updates_):
+                updates.append((ids, updates_))
+                return {}
+
+        bz = _RESTUpdates(url=self.server.url,
+                          cookiefile=None, tokenfile=None)
+        try:
+            tests.clicomm("bugzilla modify 1,2 --tags foo --status POST",
+                          bz)
+        finally:
+            bz.close()
+
+        # Not batched, the subclass' own update_bugs is used
+        self.assertEqual([c[0] for c in self.calls], ["Bug.update_tags"])
+        self.assertEqual(updates, [(["1", "2"], {"status": "POST"})])
+
+    def testPlan(self):
+        def _bug_update(params):
+            self.calls.append(("Bug.update", params))
+            if 3 in params["ids"]:
+                raise Fault(51, "Bug 3 is locked")
+            return {}
+        self.server.funcs["Bug.update"] = _bug_update
+
+        plan = self.bz.plan()
+        plan.update([1, 2, 3], status="POST")
+        plan.update(1, keywords_add="Triaged")
+        plan.update("2", keywords_add=["Triaged"])
+        plan.update_flags([1, 2], [{"name": "needinfo", "status": "?"}])
+        plan.update_flags(2, [{"name": "needinfo", "status": "X"}])
+        plan.update_tags([2, 3], tags_add="foo")
+        self.assertRaises(ValueError, plan.update, 1, status="CLOSED")
+
+        calls = [
+            ("Bug.update", [1, 2],
+             {"status": "POST", "keywords": {"add": ["Triaged"]}}),
+            ("Bug.update", [3], {"status": "POST"}),
+            ("Flag.update", [1], [{"name": "needinfo", "status": "?"}]),
+            ("Flag.update", [2], [{"name": "needinfo", "status": "X"}]),
+            ("Bug.update_tags", [2, 3], {"add": ["foo"]}),
+        ]
+        self.assertEqual(plan.calls(), calls)
+
+        oldstdout = sys.stdout
+        sys.stdout = tests.StringIO()
+        try:
+            self.assertEqual(plan.dry_run(), calls)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = oldstdout
+        self.assertTrue('Bug.update_tags 2,3: {"add": ["foo"]}' in out)
+        self.assertEqual(self.calls, [])
+
+        errors = plan.execute()
+        self.assertEqual([errors[1], errors[2]], [None, None])
+        self.assertEqual(errors[3].faultCode, 51)
+        self.assertEqual(sorted([c[0] for c in self.calls]),
+            ["Bug.update", "Bug.update", "Bug.update_tags",
+             "Flag.update", "Flag.update"])
+        self.assertEqual(plan.calls(), [])
+
+    def testFlush(self):
+        bug = _Bug(self.bz, dict={"id": 1, "status": "NEW", "summary": "s",
+                                  "cc": ["a@example.com"], "blocks": [5],
+                                  "keywords": ["Triaged"]})
+        self.assertEqual(bug.flush(), None)
+
+        bug.bug_status = "POST"
+        bug.cc = bug.cc + ["b@example.com"]
+        bug.keywords = []
+        bug.blocks = [5]
+        bug.summary = "t"
+        bug.summary = "s"
+        bug.somethingelse = 1
+        self.assertEqual(bug.status, "POST")
+        self.assertEqual(self.calls, [])
+
+        # A refresh keeps unflushed changes
+        bug.refresh()
+        self.assertEqual(bug.status, "POST")
+        self.calls = []
+
+        changes = {"status": "POST", "cc": {"add": ["b@example.com"]},
+                   "keywords": {"remove": ["Triaged"]}}
+        self.assertEqual(bug.get_changes(), changes)
+        bug.flush()
+        changes["ids"] = [1]
+        self.assertEqual(self.calls, [("Bug.update", changes)])
+        self.assertEqual(bug.get_changes(), {})
+
+        def _bug_update(params):
+            self.calls.append(("Bug.update", params))
+            if 3 in params["ids"]:
+                raise Fault(51, "Bug 3 is locked")
+            return {}
+        self.server.funcs["Bug.update"] = _bug_update
+
+        bugs = [_Bug(self.bz, dict={"id": i, "status": "NEW"})
+                for i in range(1, 5)]
+        for bug in bugs[:3]:
+            bug.status = "POST"
+        bugs[2].status = "CLOSED"
+        self.calls = []
+        errors = self.bz.flush_all(bugs)
+        self.assertEqual(sorted([c[1]["ids"] for c in self.calls]),
+                         [[1, 2], [3]])
+        self.assertEqual(errors[3].faultCode, 51)
+        self.assertEqual([b.get_changes() for b in bugs],
+                         [{}, {}, {"status": "CLOSED"}, {}])
+
+    def testFlushUnloaded(self):
+        bug = _Bug(self.bz, dict={"id": 1, "status": "NEW",
+                                  "groups": ["a", "b"],
+                                  "flags": [{"name": "needinfo"}]})
+        bug.priority = "high"
+        bug.short_desc = "s"
+        bug.keywords = ["Triaged"]
+        bug.groups = ["b", "c"]
+        self.assertRaises(ValueError, setattr, bug, "cc", ["a@example.com"])
+        self.assertRaises(ValueError, setattr, bug, "see_also", ["url"])
+
+        # Attributes bugzilla can't update are left alone
+        bug.note = "mine"
+        bug.flags = []
+        self.assertEqual((bug.note, bug.flags), ("mine", []))
+
+        changes = {"priority": "high", "summary": "s",
+                   "keywords": {"set": ["Triaged"]},
+                   "groups": {"add": ["c"], "remove": ["a"]}}
+        self.assertEqual(bug.get_changes(), changes)
+        self.calls = []
+        bug.flush()
+        changes["ids"] = [1]
+        self.assertEqual(self.calls, [("Bug.update", changes)])
+
+        # Unpickled bugs have no bugzilla, assigning just sets the value
+        bug = pickle.loads(pickle.dumps(bug))
+        bug.status = "POST"
+        bug.priority = "low"
+        self.assertEqual((bug.status, bug.priority), ("POST", "low"))
+        self.assertEqual(bug.get_changes(), {})
+
+    def testModifyWhiteboardTags(self):
+        whiteboards = {1: ("bar baz", ""), 2: ("baz", ""), 3: ("bar", "x")}
+        def _bug_get(params):
+            self.calls.append(("Bug.get", params))
+            return {"bugs": [{"id": int(i),
+                              "whiteboard": whiteboards[int(i)][0],
+                              "cf_devel_whiteboard": whiteboards[int(i)][1]}
+                             for i in params["ids"] if i in whiteboards]}
+        self.server.funcs["Bug.get"] = _bug_get
+
+        # devel_whiteboard is RHBZ specific
+        rhbz = bugzilla.RHBugzilla(url=self.server.url,
+                                   cookiefile=None, tokenfile=None)
+        tests.clicomm("bugzilla modify 1,2,3,4 --whiteboard +foo "
+                      "--whiteboard -bar --devel_whiteboard +d", rhbz)
+        rhbz.close()
+        self.assertEqual(self.calls[0][0], "Bug.get")
+        self.assertEqual(self.calls[0][1]["ids"], [1, 2, 3, 4])
+        self.assertEqual(self.calls[0][1]["include_fields"],
+                         ["id", "whiteboard", "cf_devel_whiteboard"])
+
+        # Bugs ending up with the same values share an update
+        self.assertEqual(self.calls[1], ("system.multicall", 2))
+        updates = sorted([c[1] for c in self.calls[2:]],
+                         key=lambda u: u["ids"])
+        self.assertEqual(updates, [
+            {"ids": [1, 2], "whiteboard": "baz foo",
+             "cf_devel_whiteboard": "d"},
+            {"ids": [3], "whiteboard": "foo",
+             "cf_devel_whiteboard": "x d"}])
+
+    def testAttachfile(self):
+        # Several blocks and a partial base64 group, with some \r in it
+        data = b"\r\n\x00\xff" * (3 * 64 * 1024) + b"end"
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "foo.bin")
+            open(path, "wb").write(data)
+
+            attachid = self.bz.attachfile(1, path, "desc",
+                                          comment="some\r\ncomment")
+            self.assertEqual(attachid, 1234)
+            params = self.calls[0][1]
+            self.assertEqual(params["data"].data, data)
+            self.assertEqual(params["comment"], "some\r\ncomment")
+            self.assertEqual(params["file_name"], "foo.bin")
+            self.assertEqual(params["ids"], [1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # No known size, this is spooled to a temporary file first
+        self.bz.attachfile([2, 3], tests.StringIO("some text"), "desc",
+                           file_name="foo.txt")
+        self.assertEqual(self.calls[1][1]["data"].data, b"some text")
+        self.assertEqual(self.calls[1][1]["ids"], [2, 3])
+
+    def testDownloadAttachment(self):
+        data = b"\x00\xff" * 300000
+        self.server.attachments["5"] = ("foo.bin", data)
+        checksum = "sha256:" + hashlib.sha256(data).hexdigest()
+
+        f = self.bz.openattachment(5)
+        self.assertEqual(f.name, "foo.bin")
+        self.assertEqual(f.read(10), data[:10])
+        self.assertEqual(f.read(), data[10:])
+        f.close()
+        self.assertRaises(ValueError, f.read)
+
+        out = BytesIO()
+        out.write(data[:5])
+        self.bz.download_attachment(5, out, resume=True, checksum=checksum)
+        self.assertEqual(out.getvalue(), data)
+
+        tmpdir = tempfile.mkdtemp()
+        origdir = os.getcwd()
+        try:
+            path = os.path.join(tmpdir, "foo.bin")
+            name = self.bz.download_attachment(5, path, size=len(data),
+                                               checksum=checksum)
+            self.assertEqual(name, "foo.bin")
+            self.assertEqual(open(path, "rb").read(), data)
+
+            # Resumed, and already complete
+            open(path, "wb").write(data[:1001])
+            self.bz.download_attachment(5, path, resume=True,
+                                        checksum=checksum)
+            self.assertEqual(open(path, "rb").read(), data)
+            self.bz.download_attachment(5, path, resume=True,
+                                        size=len(data))
+
+            self.assertRaises(bugzilla.BugzillaError,
+                self.bz.download_attachment, 5, path, size=10)
+            self.assertRaises(bugzilla.BugzillaError,
+                self.bz.download_attachment, 5, path, checksum="md5:00")
+            self.assertRaises(bugzilla.BugzillaError,
+                self.bz.download_attachment, 6, path)
+
+            # Servers that ignore Range send everything again
+            self.server.ranges = False
+            open(path, "wb").write(b"garbage")
+            self.bz.download_attachment(5, path, resume=True,
+                                        checksum=checksum)
+            self.assertEqual(open(path, "rb").read(), data)
+
+            os.chdir(tmpdir)
+            out = tests.clicomm("bugzilla attach --get 5", self.bz)
+            self.assertTrue("Wrote foo.bin.1" in out)
+            self.assertEqual(open("foo.bin.1", "rb").read(), data)
+        finally:
+            os.chdir(origdir)
+            shutil.rmtree(tmpdir)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.desc = "first"
+
+        def _record(name, ret):
+            def _cb(*params):
+                self.calls.append((name, params))
+                return ret()
+            return _cb
+
+        def _product(pid, name):
+            return {"id": pid, "name": name, "description": self.desc,
+                    "components": [{
+                        "name": "comp", "description": "a component",
+                        "default_assigned_to": "me@example.com",
+                        "default_qa_contact": "qa@example.com"}]}
+
+        def _get_products(params):
+            self.calls.append(("Product.get_products", params))
+            products = [_product(1, "foo"), _product(2, "bar")]
+            return {"products": [p for p in products
+                                 if p["name"] in params.get("names", [])
+                                 or p["id"] in params.get("ids", [])]}
+
+        self.server = tests.start_xmlrpc_server({
+            "Bug.fields": _record("Bug.fields", lambda:
+                {"fields": [{"name": "status"}, {"name": "cf_foo"}]}),
+            "Bug.legal_values": _record("Bug.legal_values", lambda:
+                {"values": ["comp"]}),
+            "Product.get_accessible_products": _record(
+                "Product.get_accessible_products", lambda: {"ids": [1, 2]}),
+            "Product.get_products": _get_products,
+        })
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _bz(self):
+        return Bugzilla44(url=self.server.url, cachedir=self.cachedir,
+                          cookiefile=None, tokenfile=None)
+
+    def testCache(self):
+        bz = self._bz()
+        products = bz.getproducts()
+        self.assertEqual(bz.getbugfields(), ["cf_foo", "status"])
+        self.assertEqual(bz.getcomponents("foo"), ["comp"])
+        self.assertEqual(bz.getcomponentsdetails("foo")["comp"],
+                         {"description": "a component",
+                          "initialowner": "me@example.com",
+                          "initialqacontact": "qa@example.com"})
+        self.assertEqual(len(self.calls), 4)
+        bz.close()
+
+        # A new instance gets everything from the disk cache
+        self.calls = []
+        bz = self._bz()
+        self.assertEqual(bz.getproducts(), products)
+        self.assertEqual(bz.getbugfields(), ["cf_foo", "status"])
+        self.assertEqual(bz.getcomponents("foo"), ["comp"])
+        self.assertEqual(bz.getcomponentsdetails("foo")["comp"]["initialowner"],
+                         "me@example.com")
+        self.assertEqual(self.calls, [])
+
+        # Only the cache file is left behind
+        self.assertEqual(os.listdir(self.cachedir),
+                         ["127.0.0.1_%d_xmlrpc.cgi.json" %
+                          self.server.server_address[1]])
+
+        # refresh_products() updates the cache in place
+        self.desc = "second"
+        bz.refresh_products(names=["foo"])
+        bz.close()
+        bz = self._bz()
+        self.assertEqual(sorted([p["description"] for p in bz.products]),
+                         ["first", "second"])
+
+        # force_refresh skips the cache, and updates it
+        self.calls = []
+        bz.getbugfields(force_refresh=True)
+        bz.getproducts(force_refresh=True)
+        self.assertEqual(len(self.calls), 3)
+        bz.close()
+
+        # Each entry expires after the TTL it was stored with
+        self.calls = []
+        bz = self._bz()
+        bz.cache_ttl = {"products": -1, "components": 60, "bugfields": 60}
+        bz.getproducts(include_fields=["name"])
+        bz.getbugfields()
+        self.assertEqual(len(self.calls), 2)
+        bz.close()
+        bz = self._bz()
+        bz.getproducts(include_fields=["name"])
+        bz.getbugfields()
+        self.assertEqual(len(self.calls), 4)
+        bz.close()
+
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.bugs = {}
+        self.history = {}
+        for i in range(1, 6):
+            self._change(i, "foo", "20150101T00:00:00")
+
+        def _bug_search(params):
+            self.calls.append(("Bug.search", params.copy()))
+            products = params.get("product")
+            if not isinstance(products, list):
+                products = [products]
+            ret = []
+            for bug in self.bugs.values():
+                if "product" in params and bug["product"] not in products:
+                    continue
+                if "id" in params and bug["id"] not in params["id"]:
+                    continue
+                if ("last_change_time" in params and
+                    bug["last_change_time"].value <
+                    params["last_change_time"].value):
+                    continue
+                ret.append(dict([(k, bug[k])
+                                 for k in params["include_fields"]]))
+            return {"bugs": ret}
+
+        def _bug_get(params):
+            self.calls.append(("Bug.get", params["ids"]))
+            return {"bugs": [self.bugs[i] for i in params["ids"]]}
+
+        def _bug_comments(params):
+            return {"bugs": dict([(str(i), {"comments": [
+                {"id": i * 10, "count": 0, "creator": "me@example.com",
+                 "time": self.bugs[i]["last_change_time"],
+                 "is_private": False, "text": "comment on %d" % i}]})
+                for i in params["ids"]])}
+
+        def _bug_history(params):
+            self.calls.append(("Bug.history", params["ids"]))
+            since = params.get("new_since")
+            return {"bugs": [{"id": i, "history": [
+                h for h in self.history.get(i, [])
+                if not since or h["when"].value >= since.value]}
+                for i in params["ids"]]}
+
+        self.server = tests.start_xmlrpc_server({
+            "Bug.search": _bug_search,
+            "Bug.get": _bug_get,
+            "Bug.comments": _bug_comments,
+            "Bug.history": _bug_history,
+        })
+        self.bz = Bugzilla44(url=self.server.url,
+                             cookiefile=None, tokenfile=None)
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmpdir, "mirror.sqlite")
+
+    def tearDown(self):
+        self.bz.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _change(self, bugid, product, lastchange):
+        self.bugs[bugid] = {
+            "id": bugid, "product": product,
+            "summary": "bug %d in %s" % (bugid, product),
+            "last_change_time": DateTime(lastchange),
+            "flags": [{"name": "needinfo", "status": "?",
+                       "setter": "me@example.com",
+                       "requestee": "you@example.com"}],
+            "component": ["comp%d" % (bugid % 2)],
+            "status": bugid <= 2 and "NEW" or "CLOSED",
+            "resolution": bugid > 2 and "NOTABUG" or "",
+            "assigned_to": "dev%d@example.com" % (bugid % 3),
+            "keywords": bugid % 2 and ["Triaged", "Security"] or ["Triaged"],
+            "whiteboard": "abc-%d devel:review" % bugid,
+        }
+        if bugid == 5:
+            self.bugs[bugid]["flags"].append(
+                {"name": "fedora_review", "status": "+",
+                 "setter": "me@example.com"})
+
+    def testSync(self):
+        mirror = self.bz.mirror({"product": "foo"}, dbpath=self.dbpath,
+                                comments=True)
+        self.assertEqual(mirror.sync(), ([1, 2, 3, 4, 5], []))
+        self.assertEqual(len(mirror), 5)
+        self.assertEqual(mirror.getbug(3).summary, "bug 3 in foo")
+        self.assertEqual(mirror.getbug(3).last_change_time,
+                         DateTime("20150101T00:00:00"))
+        self.assertEqual(mirror.getbug(42), None)
+        self.assertEqual([b.id for b in mirror.bugs()], [1, 2, 3, 4, 5])
+        self.assertEqual(mirror.db.execute(
+            "SELECT * FROM flags WHERE bug_id = 2").fetchall(),
+            [(2, "needinfo", "?", "me@example.com", "you@example.com")])
+        self.assertEqual(mirror.db.execute(
+            "SELECT bug_id, text FROM comments WHERE id = 40").fetchall(),
+            [(4, "comment on 4")])
+        mirror.close()
+
+        # Nothing changed, so nothing is fetched
+        self.calls = []
+        mirror = self.bz.mirror({"product": "foo"}, dbpath=self.dbpath,
+                                comments=True)
+        self.assertEqual(mirror.sync(), ([], []))
+        self.assertEqual(self.calls[0][1]["last_change_time"],
+                         DateTime("20150101T00:00:00"))
+        self.assertFalse([c for c in self.calls if c[0] == "Bug.get"])
+
+        # One bug changed, one moved to another product
+        self._change(2, "foo", "20150201T00:00:00")
+        self._change(4, "bar", "20150202T00:00:00")
+        self.calls = []
+        self.assertEqual(mirror.sync(), ([2], [4]))
+        self.assertEqual(self.calls[-1], ("Bug.get", [2]))
+        # Only the mirrored bugs that weren't found are checked
+        searches = [c[1] for c in self.calls if c[0] == "Bug.search"]
+        self.assertEqual([(q.get("product"), q.get("id")) for q in searches],
+                         [("foo", None), (None, [4])])
+        self.assertEqual(searches[1]["last_change_time"],
+                         DateTime("20150101T00:00:00"))
+        self.assertEqual(len(mirror), 4)
+        self.assertEqual(mirror.getbug(4), None)
+        self.assertEqual(mirror.db.execute(
+            "SELECT COUNT(*) FROM flags WHERE bug_id = 4").fetchone()[0], 0)
+        mirror.close()
+
+        # A different query starts over
+        mirror = self.bz.mirror({"product": "bar"}, dbpath=self.dbpath)
+        self.assertEqual(mirror.sync(), ([4], []))
+        self.assertEqual([b.id for b in mirror.bugs()], [4])
+        mirror.close()
+
+    def testOfflineQuery(self):
+        mirror = self.bz.mirror({"product": "foo"}, dbpath=self.dbpath)
+        mirror.sync()
+        self.calls = []
+
+        def _ids(query):
+            return [b.id for b in mirror.query(query)]
+        build = self.bz.build_query
+        self.assertEqual(_ids(build(product="foo", component="comp1")),
+                         [1, 3, 5])
+        self.assertEqual(_ids(build(product="bar")), [])
+        self.assertEqual(_ids(build(status=["NEW"])), [1, 2])
+        self.assertEqual(_ids(build(assigned_to="DEV1@example.com")), [1, 4])
+        self.assertEqual(_ids(build(bug_id="2,4")), [2, 4])
+        self.assertEqual(_ids(build(keywords="Security",
+                                    keywords_type="allwords")), [1, 3, 5])
+        self.assertEqual(_ids(build(keywords="Triaged Security",
+                                    keywords_type="anywords")),
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(_ids(build(keywords="Security",
+                                    keywords_type="nowords")), [2, 4])
+        self.assertEqual(_ids(build(status_whiteboard="devel:review abc-3",
+            status_whiteboard_type="allwordssubstr")), [3])
+        self.assertEqual(_ids(build(status_whiteboard="abc-3,abc-4",
+            status_whiteboard_type="anywordssubstr")), [3, 4])
+        self.assertEqual(_ids(build(status_whiteboard="devel",
+            status_whiteboard_type="allwords")), [])
+        self.assertEqual(_ids({"product": "foo", "limit": 2, "offset": 1}),
+                         [2, 3])
+
+        # RHBZ email and boolean chart queries
+        rhbz = bugzilla.RHBugzilla(url=None, cookiefile=None, tokenfile=None)
+        self.assertEqual(_ids(rhbz.build_query(assigned_to="dev2")), [2, 5])
+        self.assertEqual(_ids(rhbz.build_query(flag="fedora_review+")), [5])
+        self.assertEqual(_ids(rhbz.build_query(flag="needinfo?",
+                                               component="comp0")), [2, 4])
+        self.assertEqual(_ids(rhbz.build_query(
+            boolean_query="! flagtypes.name-substring-fedora_review")),
+            [1, 2, 3, 4])
+
+        # Custom search URLs
+        self.assertEqual(_ids(self.bz.url_to_query(
+            "https://example.com/buglist.cgi?query_format=advanced&"
+            "f1=keywords&o1=substring&v1=secur&"
+            "f2=bug_status&o2=notequals&v2=CLOSED")), [1])
+        self.assertEqual(_ids(self.bz.url_to_query(
+            "https://example.com/buglist.cgi?j_top=OR&"
+            "f1=bug_id&o1=equals&v1=4&"
+            "f2=status_whiteboard&o2=regexp&v2=ABC-[23]")), [2, 3, 4])
+
+        # Meta statuses, closed bugs are the ones with a resolution
+        self.assertEqual(_ids(self.bz.url_to_query(
+            "https://example.com/buglist.cgi?bug_status=__open__")), [1, 2])
+        self.assertEqual(_ids({"bug_status": ["__closed__"]}), [3, 4, 5])
+        self.assertEqual(_ids({"bug_status": "NEW,__closed__",
+                               "component": "comp0"}), [2, 4])
+        self.assertEqual(_ids({"bug_status": "__all__"}), [1, 2, 3, 4, 5])
+        self.assertRaises(RuntimeError, mirror.query,
+                          {"f1": "bug_status", "o1": "notequals",
+                           "v1": "__open__"})
+
+        self.assertRaises(RuntimeError, mirror.query, {"longdesc": "foo"})
+        self.assertRaises(RuntimeError, mirror.query,
+                          {"f1": "OP", "f2": "product", "v2": "foo"})
+        bug = mirror.query({"id": 5})[0]
+        self.assertEqual(bug.whiteboard, "abc-5 devel:review")
+        self.assertEqual(self.calls, [])
+        mirror.close()
+
+        out = tests.clicomm("bugzilla query --offline --mirror-db %s "
+                            "--component comp1 --outputformat %%{id}" %
+                            self.dbpath, self.bz)
+        self.assertEqual(out.splitlines()[-3:], ["1", "3", "5"])
+        self.assertEqual(self.calls, [])
+
+        # No bugzilla is contacted, not even to detect its type
+        out = tests.clicomm("bugzilla --bugzilla http://127.0.0.1:1/xmlrpc.cgi "
+                            "query --offline --mirror-db %s --component "
+                            "comp1 --outputformat '%%{id} %%{weburl}'" %
+                            self.dbpath, None)
+        self.assertEqual(out.splitlines()[-1],
+                         "5 http://127.0.0.1:1/show_bug.cgi?id=5")
+        tests.clicomm("bugzilla query --offline --component comp1",
+                      self.bz, expectfail=True)
+
+    def testChangesSince(self):
+        query = {"product": "foo"}
+        statefile = os.path.join(self.tmpdir, "state.json")
+        self.assertRaises(ValueError, list, self.bz.changes_since(query))
+
+        def _entry(when, added):
+            return {"when": DateTime(when), "who": "me@example.com",
+                    "changes": [{"field_name": "status", "removed": "NEW",
+                                 "added": added}]}
+        self._change(2, "foo", "20150201T00:00:00")
+        self.history[2] = [_entry("20150101T00:00:00", "ASSIGNED"),
+                           _entry("20150201T00:00:00", "MODIFIED")]
+        changes = list(self.bz.changes_since(
+            query, since=datetime.datetime(2015, 1, 15), statefile=statefile))
+        self.assertEqual(changes, [(2, [self.history[2][1]])])
+        self.assertEqual(self.calls[0][1]["include_fields"],
+                         ["id", "last_change_time"])
+        self.assertEqual(self.calls[0][1]["last_change_time"],
+                         DateTime("20150115T00:00:00"))
+
+        # The saved position is picked up, bug 2 isn't reported again
+        self.calls = []
+        self.assertEqual(list(self.bz.changes_since(query,
+                                                    statefile=statefile)), [])
+        self.assertEqual(self.calls, [("Bug.search", {
+            "product": "foo", "include_fields": ["id", "last_change_time"],
+            "last_change_time": DateTime("20150201T00:00:00")})])
+
+        # Changes in the same second as the mark, and later ones
+        self._change(3, "foo", "20150201T00:00:00")
+        self._change(5, "foo", "20150301T00:00:00")
+        self._change(4, "bar", "20150301T00:00:00")
+        self.bz.getbugs_chunk_size = 1
+        self.calls = []
+        self.assertEqual(list(self.bz.changes_since(query,
+                                                    statefile=statefile)),
+                         [(3, []), (5, [])])
+        self.assertEqual([c for c in self.calls if c[0] == "Bug.history"],
+                         [("Bug.history", [3]), ("Bug.history", [5])])
+        self.assertEqual(list(self.bz.changes_since(query,
+                                                    statefile=statefile)), [])
+
+        # A different query doesn't use the saved position
+        self.assertEqual(len(list(self.bz.changes_since(
+            {"product": "bar"}, since="20150101T00:00:00",
+            statefile=statefile))), 1)
+
+    def testChangesSinceChunks(self):
+        query = {"product": "foo"}
+        statefile = os.path.join(self.tmpdir, "state.json")
+        self.bz.getbugs_chunk_size = 1
+
+        entry = {"when": DateTime("20150205T00:00:00"),
+                 "who": "me@example.com",
+                 "changes": [{"field_name": "status", "removed": "NEW",
+                              "added": "POST"}]}
+        self._change(3, "foo", "20150210T00:00:00")
+        self._change(5, "foo", "20150301T00:00:00")
+        self.history[5] = [entry]
+
+        # Stopping in the middle of a poll doesn't move the position
+        changes = self.bz.changes_since(query, since="20150201T00:00:00",
+                                        statefile=statefile)
+        self.assertEqual(next(changes), (3, []))
+        changes.close()
+        self.assertFalse(os.path.exists(statefile))
+
+        # Later chunks still get the history since the start of the poll
+        self.calls = []
+        changes = list(self.bz.changes_since(query, since="20150201T00:00:00",
+                                             statefile=statefile))
+        self.assertEqual(changes, [(3, []), (5, [entry])])
+        self.assertEqual([c[1] for c in self.calls if c[0] == "Bug.history"],
+                         [[3], [5]])
+        self.assertEqual(list(self.bz.changes_since(query,
+                                                    statefile=statefile)), [])
+
+    def testMirrorCLI(self):
+        out = tests.clicomm("bugzilla mirror sync --mirror-db %s "
+                            "--product foo" % self.dbpath, self.bz)
+        self.assertTrue("Mirrored 5 bugs in %s: 5 updated, 0 removed" %
+                        self.dbpath in out)
+
+
+class AutodetectTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.version = "4.4.1"
+
+        def _extensions():
+            self.calls.append("Bugzilla.extensions")
+            return {"extensions": {}}
+
+        def _version():
+            self.calls.append("Bugzilla.version")
+            return {"version": self.version}
+
+        self.server = tests.start_xmlrpc_server({
+            "Bugzilla.extensions": _extensions,
+            "Bugzilla.version": _version,
+        })
+        multicall = self.server.funcs["system.multicall"]
+        def _multicall(calls):
+            self.calls.append("system.multicall")
+            return multicall(calls)
+        self.server.funcs["system.multicall"] = _multicall
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _bz(self, cachedir):
+        return bugzilla.Bugzilla(url=self.server.url, cachedir=cachedir,
+                                 cookiefile=None, tokenfile=None)
+
+    def _stale_reprobe(self, expect):
+        # A stale result is still used, but refreshed in the background
+        cache = _BugzillaCache(self.cachedir, self.server.url)
+        cache.set("autodetect", "Bugzilla3", -1)
+        self.assertEqual(self._bz(self.cachedir).__class__,
+                         bugzilla.Bugzilla3)
+        for ignore in range(100):
+            if cache.get("autodetect"):
+                break
+            time.sleep(.05)
+        self.assertEqual(cache.get("autodetect"), expect.__name__)
+        self.assertEqual(self._bz(self.cachedir).__class__, expect)
+
+    def testAutodetect(self):
+        # Without a cache, multicall support is unknown, so the probes
+        # are sent separately
+        self.assertEqual(self._bz(None).__class__, bugzilla.Bugzilla44)
+        self.assertEqual(self._bz(None).__class__, bugzilla.Bugzilla44)
+        self.assertEqual(self.calls,
+                         2 * ["Bugzilla.extensions", "Bugzilla.version"])
+
+        # With one, only the first time
+        self.calls = []
+        self.assertEqual(self._bz(self.cachedir).__class__,
+                         bugzilla.Bugzilla44)
+        self.assertEqual(self._bz(self.cachedir).__class__,
+                         bugzilla.Bugzilla44)
+        self.assertEqual(self.calls,
+                         ["Bugzilla.extensions", "Bugzilla.version"])
+
+        # The background refresh finds out about multicall, which is
+        # used from then on
+        self.calls = []
+        self.version = "5.0"
+        self._stale_reprobe(bugzilla.Bugzilla5)
+        self._stale_reprobe(bugzilla.Bugzilla5)
+        self.assertEqual(self.calls, 2 * ["system.multicall",
+            "Bugzilla.extensions", "Bugzilla.version"])
+
+    def testAutodetectNoMulticall(self):
+        def _multicall(calls):
+            self.calls.append("system.multicall")
+            raise Fault(-32601, "Method not found: system.multicall")
+        self.server.funcs["system.multicall"] = _multicall
+
+        # Two requests for a cold probe, like without multicall support
+        self.assertEqual(self._bz(self.cachedir).__class__,
+                         bugzilla.Bugzilla44)
+        self.assertEqual(self.calls,
+                         ["Bugzilla.extensions", "Bugzilla.version"])
+
+        # Trying multicall costs a request once, in the background
+        self.calls = []
+        self._stale_reprobe(bugzilla.Bugzilla44)
+        self._stale_reprobe(bugzilla.Bugzilla44)
+        self.assertEqual(self.calls, ["system.multicall"] +
+            2 * ["Bugzilla.extensions", "Bugzilla.version"])
+
+
+class JSONRPCTest(unittest.TestCase):
+    def setUp(self):
+        def _bug_search(params):
+            if "product" not in params:
+                raise Fault(32000, "Search needs a product")
+            return {"bugs": [{
+                "id": 1,
+                "product": params["product"],
+                "keywords": ["Triaged"],
+                "last_change_time": "2015-01-02T03:04:05Z",
+            }]}
+
+        def _bug_add_attachment(params):
+            return {"ids": [len(base64.b64decode(params["data"]))]}
+
+        self.server = tests.start_jsonrpc_server({
+            "Bug.search": _bug_search,
+            "Bug.add_attachment": _bug_add_attachment,
+            "Bug.history": lambda params: params,
+        })
+        self.bz = Bugzilla44(url=self.server.url, transport="jsonrpc",
+                             cookiefile=None, tokenfile=None)
+
+    def tearDown(self):
+        self.bz.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testQuery(self):
+        bugs = self.bz.query(self.bz.build_query(product="foo"))
+        self.assertEqual(self.server.paths, ["/jsonrpc.cgi"])
+        self.assertEqual(bugs[0].product, ["foo"])
+        self.assertEqual(bugs[0].keywords, ["Triaged"])
+        # Same type the XMLRPC interface would return
+        self.assertEqual(bugs[0].last_change_time,
+                         DateTime("20150102T03:04:05"))
+
+        self.assertRaises(Fault, self.bz.query, {})
+
+        bugs = list(self.bz.iterquery(self.bz.build_query(product="foo")))
+        self.assertEqual(bugs[0].product, ["foo"])
+        self.assertRaises(Fault, list, self.bz.iterquery({}))
+
+    def testEncoding(self):
+        # Params go straight to JSON, not through XMLRPC, which can't
+        # even encode a number this big
+        params = {"ids": [2 ** 40],
+                  "new_since": DateTime("20150102T03:04:05"),
+                  "until": datetime.datetime(2015, 1, 2, 3, 4, 5)}
+        self.assertEqual(self.bz._proxy.Bug.history(params),
+                         {"ids": [2 ** 40],
+                          "new_since": DateTime("20150102T03:04:05"),
+                          "until": DateTime("20150102T03:04:05")})
+
+    def testAttachfile(self):
+        attachid = self.bz.attachfile(1, BytesIO(b"x" * 100000), "desc",
+                                      file_name="foo.txt")
+        self.assertEqual(attachid, 100000)
+
+    def testBadTransport(self):
+        self.assertRaises(ValueError, Bugzilla44,
+                          transport="soap", cookiefile=None, tokenfile=None)
+
+
+class RESTTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+
+        def _callback(method, path, query, body):
+            self.requests.append((method, path, query, body))
+            if path == "/rest.cgi/bug/999":
+                return 404, {"error": True, "code": 101,
+                             "message": "Bug #999 does not exist."}
+            if path == "/rest.cgi/product":
+                return 200, {"products": [{"id": 1, "name": "foo"}]}
+            if method == "PUT":
+                return 200, {"bugs": [{"id": i} for i in body["ids"]]}
+            return 200, {"bugs": [{"id": 1, "summary": "foo",
+                "last_change_time": "2015-01-02T03:04:05Z"}]}
+
+        self.server = tests.start_rest_server(_callback)
+        self.bz = Bugzilla5(url=self.server.url,
+                            cookiefile=None, tokenfile=None)
+
+    def tearDown(self):
+        self.bz.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testGET(self):
+        self.bz._proxy.token.value = "sometoken"
+        bugs = self.bz.getbugs([1, 2], include_fields=["summary"])
+        self.assertEqual(bugs[0].summary, "foo")
+        self.assertEqual(bugs[0].last_change_time,
+                         DateTime("20150102T03:04:05"))
+        self.assertEqual(bugs[1], None)
+
+        method, path, query, ignore = self.requests[-1]
+        self.assertEqual((method, path), ("GET", "/rest.cgi/bug"))
+        self.assertEqual(query["id"], ["1,2"])
+        self.assertEqual(query["include_fields"], ["summary"])
+        self.assertEqual(query["token"], ["sometoken"])
+
+        self.assertRaises(Fault, self.bz.getbug, 999)
+
+        self.bz.query({"product": ["foo", "bar"], "limit": 10})
+        self.assertEqual(self.requests[-1][2],
+                         {"product": ["foo", "bar"], "limit": ["10"],
+                          "token": ["sometoken"]})
+        bugs = list(self.bz.iterquery({"product": "foo"}))
+        self.assertEqual(bugs[0].summary, "foo")
+
+        self.bz.refresh_products(names=["foo"])
+        self.assertEqual(self.bz.products, [{"id": 1, "name": "foo"}])
+        self.assertEqual(self.requests[-1][2]["names"], ["foo"])
+
+    def testUpdate(self):
+        self.bz.update_bugs([1, 2], self.bz.build_update(status="POST"))
+        self.assertEqual(self.requests[-1],
+                         ("PUT", "/rest.cgi/bug/1", {},
+                          {"ids": [1, 2], "status": "POST"}))
+
+
+class AsyncTest(unittest.TestCase):
+    # None picks aiohttp if it's installed
+    use_aiohttp = None
+
+    def setUp(self):
+        self.calls = []
+
+        def _bug_get(params):
+            self.calls.append(("Bug.get", params))
+            return {"bugs": [{"id": i, "summary": "bug %s" % i}
+                             for i in params["ids"] if i != 7]}
+
+        def _bug_search(params):
+            self.calls.append(("Bug.search", params))
+            if "product" not in params:
+                raise Fault(32000, "Search needs a product")
+            return {"bugs": [{"id": 1, "product": params["product"]}]}
+
+        def _add_attachment(params):
+            self.calls.append(("Bug.add_attachment", params))
+            return {"ids": [1234]}
+
+        def _user_get(params):
+            self.calls.append(("User.get", params))
+            return {"users": [{"id": 2, "name": n, "email": n}
+                              for n in reversed(params["names"])]}
+
+        def _record(name):
+            def _cb(params):
+                self.calls.append((name, params))
+                return {"ok": 1}
+            return _cb
+
+        self.server = tests.start_xmlrpc_server({
+            "Bug.add_attachment": _add_attachment,
+            "Bug.get": _bug_get,
+            "Bug.search": _bug_search,
+            "Bug.update": _record("Bug.update"),
+            "Flag.update": _record("Flag.update"),
+            "User.get": _user_get,
+        })
+        self.server.attachments["1234"] = ("foo.txt", b"hello\x00world")
+
+        self.bz = Bugzilla44(url=self.server.url,
+                             cookiefile=None, tokenfile=None)
+        self.bz._proxy.token.value = "sometoken"
+        self.abz = AsyncBugzilla(self.bz, max_concurrency=2,
+                                 use_aiohttp=self.use_aiohttp)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self._run(self.abz.close())
+        self.loop.close()
+        self.bz.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def testGetbugs(self):
+        bug = self._run(self.abz.getbug(1, include_fields=["summary"]))
+        self.assertEqual(bug.summary, "bug 1")
+        self.assertEqual(self.calls[-1][1], {"ids": [1],
+            "include_fields": ["summary"], "Bugzilla_token": "sometoken"})
+
+        # Chunks are fetched concurrently, order and missing bugs kept
+        self.calls = []
+        self.bz.getbugs_chunk_size = 2
+        bugs = self._run(self.abz.getbugs([9, 8, 7, 6, 5]))
+        self.assertEqual([b and b.bug_id for b in bugs], [9, 8, None, 6, 5])
+        self.assertEqual(len(self.calls), 3)
+
+    def testQuery(self):
+        bugs = self._run(self.abz.query(self.abz.build_query(product="foo")))
+        self.assertEqual(bugs[0].product, ["foo"])
+        self.assertRaises(Fault, self._run, self.abz.query({}))
+
+    def testUpdate(self):
+        ret = self._run(self.abz.update_bugs([1, 2],
+                        self.abz.build_update(status="POST")))
+        self.assertEqual(ret, {"ok": 1})
+        self._run(self.abz.update_flags(1, [{"name": "needinfo"}]))
+        self.assertEqual([c[1]["ids"] for c in self.calls], [[1, 2], [1]])
+
+    def testAttachments(self):
+        attachid = self._run(self.abz.attachfile(
+            1, tests.StringIO("some text"), "desc", file_name="foo.txt",
+            content_type="text/plain"))
+        self.assertEqual(attachid, 1234)
+        self.assertEqual(self.calls[0][1]["data"].data, b"some text")
+
+        f = self._run(self.abz.openattachment(1234))
+        self.assertEqual(f.name, "foo.txt")
+        self.assertEqual(f.read(), b"hello\x00world")
+
+    def testGetusers(self):
+        users = self._run(self.abz.getusers(["a@example.com",
+                                             "b@example.com"]))
+        self.assertEqual([u.email for u in users],
+                         ["a@example.com", "b@example.com"])
+
+
+class AsyncThreadedTest(AsyncTest):
+    use_aiohttp = False
+
+
+if not AsyncBugzilla:
+    del(AsyncTest)
+    del(AsyncThreadedTest)